@@ -1,38 +1,380 @@
 # analyze_logs.py
+"""
+日志分析：流式读取 logs/chat_api.log 及其轮转备份（chat_api.log.1 … 以及 .gz 压缩文件），
+以及 gunicorn 访问日志，内存占用不随日志大小增长（延迟用对数分桶直方图近似分位数）。
+应用日志可以是 JSON 行（logger.py 的 LOG_JSON = True）或文本格式，同一批文件中可以混合出现。
+
+统计内容：
+- chat_completions execution took / first token took / stream took 的延迟分位数
+- 缓存命中与未命中（按请求的 cache= 结果；旧日志按 Cache hit / Loaded conversation context 行推断）
+- ERROR / WARNING 行数及最常见的错误
+- 按时间分桶的吞吐（每桶完成的请求数）
+- 访问日志：按路径与状态码统计、5xx 比例；含时间戳时按时间分桶，含耗时字段时计算分位数
+
+用法：
+    python analyze_logs.py
+    python analyze_logs.py --log logs/chat_api.log --access logs/gunicorn_access.log --bucket 300
+    python analyze_logs.py --json
+"""
+import argparse
+import glob
+import gzip
+import json
+import math
+import os
 import re
-from collections import defaultdict
-
-def analyze_logs(log_file):
-    response_times = []
-    accuracy_scores = []
-    api_calls = defaultdict(int)
-
-    with open(log_file, 'r') as f:
-        for line in f:
-            # 分析响应时间
-            if 'API call to chat took' in line:
-                time = float(re.search(r'took (\d+\.\d+) seconds', line).group(1))
-                response_times.append(time)
-
-            # 分析记忆准确率
-            if 'Memory accuracy for user' in line:
-                accuracy = float(re.search(r'accuracy for user .+: (\d+\.\d+)', line).group(1))
-                accuracy_scores.append(accuracy)
-
-            # 统计API调用次数
-            if 'API call to' in line:
-                api_name = re.search(r'API call to (\w+)', line).group(1)
-                api_calls[api_name] += 1
-
-    # 计算统计数据
-    avg_response_time = sum(response_times) / len(response_times) if response_times else 0
-    avg_accuracy = sum(accuracy_scores) / len(accuracy_scores) if accuracy_scores else 0
-
-    print(f"Average response time: {avg_response_time:.2f} seconds")
-    print(f"Average memory accuracy: {avg_accuracy:.2f}")
-    print("API call statistics:")
-    for api, count in api_calls.items():
-        print(f"  {api}: {count} calls")
+from collections import Counter, defaultdict
+from datetime import datetime
+
+# logger.py 的格式：%(asctime)s - %(name)s - %(levelname)s - %(message)s
+APP_LINE_RE = re.compile(r"^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2})(?:,\d+)? - (\S+) - (\w+) - (.*)$")
+EXECUTION_RE = re.compile(r"chat_completions execution took (\d+(?:\.\d+)?) seconds(?: \(cache=(\w+)\))?")
+FIRST_TOKEN_RE = re.compile(r"chat_completions first token took (\d+(?:\.\d+)?) seconds")
+STREAM_RE = re.compile(r"chat_completions stream took (\d+(?:\.\d+)?) seconds")
+# gunicorn 默认访问日志格式：%(h)s %(l)s %(u)s %(t)s "%(r)s" %(s)s %(b)s "%(f)s" "%(a)s"，
+# 末尾可选的耗时字段对应 access_log_format 中追加的 %(L)s（秒）或 %(D)s（微秒）
+GUNICORN_ACCESS_RE = re.compile(
+    r'^(\S+) \S+ \S+ \[([^\]]+)\] "(\S+) (\S+)[^"]*" (\d{3}) \S+(?: "[^"]*" "[^"]*")?(?: (\d+(?:\.\d+)?))?\s*$'
+)
+# UvicornWorker 写入的访问日志：127.0.0.1:54321 - "POST /v1/chat/completions HTTP/1.1" 200（不含时间戳）
+UVICORN_ACCESS_RE = re.compile(r'^(\S+) - "(\S+) (\S+)[^"]*" (\d{3})')
+# 归并错误消息时去掉数字、十六进制串与引号中的内容
+_NORMALIZE_RE = re.compile(r"0x[0-9a-f]+|[0-9a-f]{16,}|\d+|'[^']*'|\"[^\"]*\"", re.IGNORECASE)
+
+
+class LatencyHistogram:
+    """
+    对数分桶直方图：相邻分桶相差 1%，分位数的相对误差不超过约 1%，内存只与取值范围有关
+    """
+
+    GROWTH = 1.01
+    MIN_VALUE = 1e-6
+
+    def __init__(self):
+        self.buckets = Counter()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value: float):
+        index = int(math.log(max(value, self.MIN_VALUE) / self.MIN_VALUE, self.GROWTH))
+        self.buckets[index] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, pct: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = max(1, math.ceil(pct / 100 * self.count))
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                # 取分桶上界，且不超过观测到的最大值
+                return min(self.max, self.MIN_VALUE * self.GROWTH ** (index + 1))
+        return self.max
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "avg": self.total / self.count if self.count else 0.0,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+            "max": self.max,
+        }
+
+
+def log_files(path: str):
+    """
+    返回 path 及其轮转备份（含 .gz），按从旧到新排列：RotatingFileHandler 中 .N 越大越旧
+    """
+    def rotation_index(name):
+        suffix = name[len(path):]
+        if suffix.endswith(".gz"):
+            suffix = suffix[:-3]
+        return int(suffix[1:]) if suffix[1:].isdigit() else 0
+
+    candidates = set(glob.glob(glob.escape(path) + ".*")) | set(glob.glob(glob.escape(path)))
+    files = [name for name in candidates
+             if name == path or name == path + ".gz" or re.fullmatch(r"\.\d+(\.gz)?", name[len(path):])]
+    return sorted(files, key=rotation_index, reverse=True)
+
+
+def read_lines(paths):
+    """
+    逐行读取（.gz 透明解压），不把整个文件读入内存
+    """
+    for path in paths:
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rt", encoding="utf-8", errors="replace") as f:
+            for line in f:
+                yield line.rstrip("\n")
+
+
+def bucket_start(timestamp: datetime, bucket_seconds: int) -> int:
+    epoch = int(timestamp.timestamp())
+    return epoch - epoch % bucket_seconds
+
+
+def throughput_series(counts: Counter, bucket_seconds: int, max_buckets: int = 100000) -> dict:
+    """
+    按时间顺序输出每个分桶的请求数，没有请求的分桶补 0（便于看出中断）
+    """
+    if not counts:
+        return {}
+    first, last = min(counts), max(counts)
+    if (last - first) // bucket_seconds < max_buckets:
+        starts = range(first, last + bucket_seconds, bucket_seconds)
+    else:
+        starts = sorted(counts)
+    return {datetime.fromtimestamp(start).strftime("%Y-%m-%d %H:%M:%S"): counts.get(start, 0) for start in starts}
+
+
+def parse_app_line(line: str):
+    """
+    解析一行应用日志，返回 (时间 "YYYY-mm-dd HH:MM:SS", 级别, 消息)，无法识别时返回 None
+    """
+    if line.startswith("{"):
+        try:
+            entry = json.loads(line)
+            return entry["ts"][:19].replace("T", " "), entry["level"], entry["msg"]
+        except (ValueError, KeyError, TypeError):
+            return None
+    match = APP_LINE_RE.match(line)
+    if not match:
+        return None
+    timestamp_text, _, level, message = match.groups()
+    return timestamp_text, level, message
+
+
+def normalize_error(message: str) -> str:
+    return _NORMALIZE_RE.sub("#", message.split("\n", 1)[0])[:120]
+
+
+class AppLogStats:
+    """
+    应用日志（chat_api.log）的统计
+    """
+
+    def __init__(self, bucket_seconds: int = 60):
+        self.bucket_seconds = bucket_seconds
+        self.lines = 0
+        self.execution = LatencyHistogram()
+        self.execution_by_cache = defaultdict(LatencyHistogram)
+        self.first_token = LatencyHistogram()
+        self.stream = LatencyHistogram()
+        self.cache = Counter()
+        # 旧日志没有 cache= 字段时的推断计数
+        self.legacy_hits = 0
+        self.legacy_misses = 0
+        self.levels = Counter()
+        self.errors = Counter()
+        self.throughput = Counter()
+        self.first_seen = None
+        self.last_seen = None
+
+    def add(self, line: str):
+        parsed = parse_app_line(line)
+        if parsed is None:
+            return
+        self.lines += 1
+        timestamp_text, level, message = parsed
+        self.levels[level] += 1
+        if level in ("ERROR", "CRITICAL"):
+            self.errors[normalize_error(message)] += 1
+
+        if "chat_completions" in message:
+            execution = EXECUTION_RE.search(message)
+            if execution:
+                seconds = float(execution.group(1))
+                self.execution.add(seconds)
+                cache = execution.group(2)
+                if cache:
+                    self.cache[cache] += 1
+                    self.execution_by_cache[cache].add(seconds)
+                timestamp = datetime.strptime(timestamp_text, "%Y-%m-%d %H:%M:%S")
+                self.throughput[bucket_start(timestamp, self.bucket_seconds)] += 1
+                self.first_seen = self.first_seen or timestamp
+                self.last_seen = timestamp
+                return
+            first_token = FIRST_TOKEN_RE.search(message)
+            if first_token:
+                self.first_token.add(float(first_token.group(1)))
+                return
+            stream = STREAM_RE.search(message)
+            if stream:
+                self.stream.add(float(stream.group(1)))
+                return
+        if message.startswith("Cache hit for key"):
+            self.legacy_hits += 1
+        elif message.startswith("Loaded conversation context"):
+            self.legacy_misses += 1
+
+    def report(self) -> dict:
+        cache = dict(self.cache)
+        if not cache and (self.legacy_hits or self.legacy_misses):
+            cache = {"hit": self.legacy_hits, "miss": self.legacy_misses}
+        lookups = sum(count for status, count in cache.items() if status != "none")
+        hits = sum(count for status, count in cache.items() if status in ("hit", "coalesced", "semantic"))
+        requests = self.execution.count
+        span = (self.last_seen - self.first_seen).total_seconds() if self.first_seen else 0
+        return {
+            "lines": self.lines,
+            "requests": requests,
+            "latency_s": self.execution.summary(),
+            "latency_by_cache_s": {status: h.summary() for status, h in sorted(self.execution_by_cache.items())},
+            "first_token_s": self.first_token.summary(),
+            "stream_s": self.stream.summary(),
+            "cache": cache,
+            "cache_hit_rate": hits / lookups if lookups else 0.0,
+            "levels": dict(self.levels),
+            "error_rate": self.levels.get("ERROR", 0) / requests if requests else 0.0,
+            "top_errors": self.errors.most_common(10),
+            "avg_rps": requests / span if span > 0 else 0.0,
+            "throughput": throughput_series(self.throughput, self.bucket_seconds),
+        }
+
+
+class AccessLogStats:
+    """
+    gunicorn 访问日志的统计（兼容 gunicorn 默认格式与 UvicornWorker 的格式）
+    """
+
+    def __init__(self, bucket_seconds: int = 60):
+        self.bucket_seconds = bucket_seconds
+        self.requests = 0
+        self.unparsed = 0
+        self.paths = Counter()
+        self.statuses = Counter()
+        self.latency = LatencyHistogram()
+        self.throughput = Counter()
+
+    def add(self, line: str):
+        if not line.strip():
+            return
+        match = GUNICORN_ACCESS_RE.match(line)
+        if match:
+            _, timestamp_text, method, path, status, duration = match.groups()
+            try:
+                timestamp = datetime.strptime(timestamp_text, "%d/%b/%Y:%H:%M:%S %z")
+                self.throughput[bucket_start(timestamp, self.bucket_seconds)] += 1
+            except ValueError:
+                pass
+            if duration:
+                # 整数视为 %(D)s（微秒），小数视为 %(L)s（秒）
+                self.latency.add(float(duration) if "." in duration else int(duration) / 1e6)
+        else:
+            match = UVICORN_ACCESS_RE.match(line)
+            if not match:
+                self.unparsed += 1
+                return
+            _, method, path, status = match.groups()
+        self.requests += 1
+        self.paths[f"{method} {path.split('?', 1)[0]}"] += 1
+        self.statuses[status] += 1
+
+    def report(self) -> dict:
+        server_errors = sum(count for status, count in self.statuses.items() if status.startswith("5"))
+        report = {
+            "requests": self.requests,
+            "unparsed_lines": self.unparsed,
+            "paths": dict(self.paths.most_common(20)),
+            "statuses": dict(sorted(self.statuses.items())),
+            "server_error_rate": server_errors / self.requests if self.requests else 0.0,
+            "throughput": throughput_series(self.throughput, self.bucket_seconds),
+        }
+        if self.latency.count:
+            report["latency_s"] = self.latency.summary()
+        return report
+
+
+def analyze_logs(log_file="logs/chat_api.log", access_log=None, bucket_seconds=60) -> dict:
+    """
+    分析应用日志（及其轮转备份），可选地同时分析访问日志，返回统计结果
+    """
+    result = {}
+    app_files = log_files(log_file)
+    app = AppLogStats(bucket_seconds)
+    for line in read_lines(app_files):
+        app.add(line)
+    result["app"] = dict(files=app_files, **app.report())
+    if access_log:
+        access_files = log_files(access_log)
+        access = AccessLogStats(bucket_seconds)
+        for line in read_lines(access_files):
+            access.add(line)
+        result["access"] = dict(files=access_files, **access.report())
+    return result
+
+
+def format_latency(name: str, summary: dict) -> str:
+    return (f"  {name:<16} n={summary['count']:<8} avg={summary['avg'] * 1000:.1f}ms "
+            f"p50={summary['p50'] * 1000:.1f}ms p95={summary['p95'] * 1000:.1f}ms "
+            f"p99={summary['p99'] * 1000:.1f}ms max={summary['max'] * 1000:.1f}ms")
+
+
+def print_throughput(throughput: dict, bucket_seconds: int, limit: int = 48):
+    if not throughput:
+        return
+    peak = max(throughput.values())
+    items = list(throughput.items())
+    if len(items) > limit:
+        print(f"  (showing the last {limit} of {len(items)} buckets)")
+        items = items[-limit:]
+    for start, count in items:
+        bar = "#" * round(40 * count / peak) if peak else ""
+        print(f"  {start}  {count:>6}  {count / bucket_seconds:>7.2f}/s  {bar}")
+
+
+def print_report(result: dict, bucket_seconds: int):
+    app = result["app"]
+    print(f"Application log: {len(app['files'])} file(s), {app['lines']} lines, {app['requests']} requests")
+    if app["latency_s"]["count"]:
+        print("Latency:")
+        print(format_latency("execution", app["latency_s"]))
+        for status, summary in app["latency_by_cache_s"].items():
+            print(format_latency(f"cache={status}", summary))
+    if app["first_token_s"]["count"]:
+        print(format_latency("first token", app["first_token_s"]))
+        print(format_latency("stream", app["stream_s"]))
+    print(f"Cache: hit rate {app['cache_hit_rate']:.1%} {app['cache']}")
+    print(f"Levels: {app['levels']}  error rate {app['error_rate']:.2%} of requests")
+    for message, count in app["top_errors"]:
+        print(f"  {count:>6}  {message}")
+    print(f"Throughput ({bucket_seconds}s buckets, avg {app['avg_rps']:.2f} req/s):")
+    print_throughput(app["throughput"], bucket_seconds)
+
+    access = result.get("access")
+    if access is not None:
+        print(f"\nAccess log: {len(access['files'])} file(s), {access['requests']} requests "
+              f"({access['unparsed_lines']} unparsed lines), 5xx rate {access['server_error_rate']:.2%}")
+        print(f"Statuses: {access['statuses']}")
+        for path, count in access["paths"].items():
+            print(f"  {count:>6}  {path}")
+        if "latency_s" in access:
+            print(format_latency("request", access["latency_s"]))
+        if access["throughput"]:
+            print(f"Throughput ({bucket_seconds}s buckets):")
+            print_throughput(access["throughput"], bucket_seconds)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="分析应用日志与访问日志")
+    parser.add_argument("--log", default="logs/chat_api.log", help="应用日志（自动包含轮转备份与 .gz）")
+    parser.add_argument("--access", default="logs/gunicorn_access.log", help="访问日志，传空字符串跳过")
+    parser.add_argument("--bucket", type=int, default=60, help="吞吐统计的时间分桶（秒）")
+    parser.add_argument("--json", action="store_true", help="以 JSON 输出结果")
+    args = parser.parse_args()
+
+    access = args.access if args.access and os.path.exists(args.access) else None
+    result = analyze_logs(args.log, access, args.bucket)
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+    else:
+        print_report(result, args.bucket)
+
 
 if __name__ == "__main__":
-    analyze_logs('logs/chat_api.log')
+    main()
@@ -0,0 +1,155 @@
+"""
+嵌入后端基准测试：比较各后端的冷启动时间、单条/批量编码延迟与常驻内存。
+每个后端在独立的子进程中测试，互不影响冷启动与内存统计。
+
+用法：
+    python bench_embedding.py                          # 测试 torch 与 onnx 后端
+    python bench_embedding.py --backends torch --texts 500
+    python bench_embedding.py --export                 # 先导出 int8 ONNX 模型再测试
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from utils import percentile
+
+DEFAULT_MODEL_PATH = "./text2vec-large-chinese"
+SAMPLE_TEXTS = [
+    "今天天气怎么样？",
+    "帮我总结一下这篇文章的主要内容。",
+    "如何在 Python 中读取一个很大的 CSV 文件？",
+    "我想预订明天下午三点的会议室。",
+    "请解释一下向量数据库的工作原理，以及它和传统数据库的区别。",
+]
+
+
+def rss_mb() -> float:
+    """
+    当前进程的常驻内存（MB）
+    """
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def make_texts(count):
+    return [f"{SAMPLE_TEXTS[i % len(SAMPLE_TEXTS)]}（样本 {i}）" for i in range(count)]
+
+
+def run_worker(backend_name, model_path, count, batch_size):
+    """
+    子进程：加载、预热并测量一个后端，结果以一行 JSON 输出
+    """
+    start = time.perf_counter()
+    from embedding_backend import create_backend
+    import_seconds = time.perf_counter() - start
+    rss_before = rss_mb()
+
+    backend = create_backend(backend_name, model_path)
+    backend.prepare(warm_up=False)
+    rss_loaded = rss_mb()
+
+    texts = make_texts(count)
+    first_start = time.perf_counter()
+    backend.encode(texts[:1])
+    first_ms = (time.perf_counter() - first_start) * 1000
+    backend.prepare()
+    cold_start = time.perf_counter() - start
+
+    single = []
+    for text in texts:
+        t = time.perf_counter()
+        backend.encode([text])
+        single.append((time.perf_counter() - t) * 1000)
+
+    batch_start = time.perf_counter()
+    for i in range(0, count, batch_size):
+        backend.encode(texts[i:i + batch_size])
+    batch_seconds = time.perf_counter() - batch_start
+
+    return {
+        "backend": backend_name,
+        "import_s": import_seconds,
+        "load_s": backend.load_seconds,
+        "warmup_s": backend.warmup_seconds,
+        "cold_start_s": cold_start,
+        "first_encode_ms": first_ms,
+        "p50_ms": statistics.median(single),
+        "p95_ms": percentile(single, 95),
+        "p99_ms": percentile(single, 99),
+        "batch_texts_per_s": count / batch_seconds if batch_seconds > 0 else 0.0,
+        "rss_base_mb": rss_before,
+        "rss_loaded_mb": rss_loaded,
+        "rss_peak_mb": rss_mb(),
+        "dimension": backend.dimension,
+    }
+
+
+def print_table(results):
+    columns = [
+        ("backend", "{}"), ("cold_start_s", "{:.2f}"), ("load_s", "{:.2f}"), ("warmup_s", "{:.2f}"),
+        ("first_encode_ms", "{:.1f}"), ("p50_ms", "{:.1f}"), ("p95_ms", "{:.1f}"), ("p99_ms", "{:.1f}"),
+        ("batch_texts_per_s", "{:.1f}"), ("rss_loaded_mb", "{:.0f}"), ("rss_peak_mb", "{:.0f}"),
+    ]
+    rows = [[name for name, _ in columns]]
+    for result in results:
+        if "error" not in result:
+            rows.append([fmt.format(result[name]) if result.get(name) is not None else "-"
+                         for name, fmt in columns])
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    for row in rows:
+        print("  ".join(cell.ljust(width) for cell, width in zip(row, widths)))
+    for result in results:
+        if "error" in result:
+            print(f"{result['backend']}: error: {result['error']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="比较嵌入后端的冷启动时间、延迟与内存")
+    parser.add_argument("--backends", nargs="+", default=["torch", "onnx"])
+    parser.add_argument("--model-path", default=DEFAULT_MODEL_PATH)
+    parser.add_argument("--texts", type=int, default=200, help="测量用的文本条数")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--export", action="store_true", help="先导出 int8 量化的 ONNX 模型")
+    parser.add_argument("--json", action="store_true", help="以 JSON 输出结果")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_worker(args.worker, args.model_path, args.texts, args.batch_size)))
+        return
+
+    if args.export:
+        from embedding_backend import export_onnx_int8
+        export_onnx_int8(args.model_path)
+
+    results = []
+    for backend_name in args.backends:
+        cmd = [sys.executable, os.path.abspath(__file__), "--worker", backend_name,
+               "--model-path", args.model_path, "--texts", str(args.texts), "--batch-size", str(args.batch_size)]
+        proc = subprocess.run(cmd, capture_output=True, text=True)
+        lines = [line for line in proc.stdout.splitlines() if line.startswith("{")]
+        if proc.returncode != 0 or not lines:
+            error = (proc.stderr.strip().splitlines() or ["unknown error"])[-1]
+            results.append({"backend": backend_name, "error": error})
+        else:
+            results.append(json.loads(lines[-1]))
+
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+    else:
+        print_table(results)
+
+
+if __name__ == "__main__":
+    main()
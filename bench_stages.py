@@ -0,0 +1,196 @@
+"""
+分阶段微基准：在临时目录中分别测量请求路径上的各个阶段，
+get_embedding（未命中/命中嵌入缓存）、search、add_to_conversation、add_chat_history（逐条提交/批量写入），
+报告 p50/p95/p99 与每秒操作数。保存结果后，下次运行可与之对比，变慢超过阈值的阶段标为 REGRESSION。
+
+用法（在项目根目录运行，需能加载 ./text2vec-large-chinese）：
+    python bench_stages.py --save bench_baseline.json
+    python bench_stages.py --baseline bench_baseline.json --threshold 0.2
+    python bench_stages.py --stages search add_chat_history --iterations 500 --json
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+import database
+from database import Base, add_chat_histories, add_chat_history
+from utils import percentile
+from vector_store import VectorStore
+
+STAGES = ("get_embedding", "get_embedding_cached", "search", "add_to_conversation",
+          "add_chat_history", "add_chat_histories")
+# 需要加载嵌入模型与 VectorStore 的阶段
+VECTOR_STAGES = ("get_embedding", "get_embedding_cached", "search", "add_to_conversation")
+SAMPLE_TEXTS = [
+    "我家有5口人",
+    "昨天下午我吃了两个鸡蛋。",
+    "请帮我记住明天上午十点要开会。",
+    "我最喜欢的颜色是蓝色，最喜欢的季节是秋天。",
+    "向量数据库如何在大量对话记录中快速找到相关内容？",
+]
+
+
+def make_text(i):
+    return f"{SAMPLE_TEXTS[i % len(SAMPLE_TEXTS)]}（第 {i} 条）"
+
+
+def measure(name, func, iterations):
+    """
+    调用 func(i) iterations 次，返回该阶段的延迟统计（毫秒）
+    """
+    latencies = []
+    start = time.perf_counter()
+    for i in range(iterations):
+        t = time.perf_counter()
+        func(i)
+        latencies.append((time.perf_counter() - t) * 1000)
+    elapsed = time.perf_counter() - start
+    return {
+        "stage": name,
+        "iterations": iterations,
+        "p50_ms": statistics.median(latencies),
+        "p95_ms": percentile(latencies, 95),
+        "p99_ms": percentile(latencies, 99),
+        "ops_per_s": iterations / elapsed if elapsed > 0 else 0.0,
+    }
+
+
+def make_session_factory(path):
+    """
+    在临时文件上创建与 database.engine 配置一致的 SQLite 引擎（WAL 等 PRAGMA 相同）
+    """
+    engine = create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False, "timeout": 30})
+    event.listen(engine, "connect", database._set_sqlite_pragmas)
+    Base.metadata.create_all(engine)
+    return engine, sessionmaker(bind=engine, autocommit=False, autoflush=False)
+
+
+def run_stages(stages, iterations, history, workdir):
+    results = []
+    store = None
+    if any(stage in VECTOR_STAGES for stage in stages):
+        store = VectorStore(save_path=os.path.join(workdir, "vector_store"))
+        store.load_model()
+        # 预先写入一段对话历史，search 在有数据的分区上测量
+        for i in range(history):
+            store.add_to_conversation("bench", "user" if i % 2 == 0 else "assistant", make_text(i))
+
+    try:
+        for stage in stages:
+            if stage == "get_embedding":
+                # 每次使用不同文本，测量编码本身（不命中嵌入缓存）
+                result = measure(stage, lambda i: store.get_embedding(f"未缓存的文本 {i} {time.time()}"), iterations)
+            elif stage == "get_embedding_cached":
+                store.get_embedding(make_text(0))
+                result = measure(stage, lambda i: store.get_embedding(make_text(0)), iterations)
+            elif stage == "search":
+                # 先缓存查询文本的嵌入，只测量 FAISS 检索与结果组装
+                store.get_embeddings([make_text(i) for i in range(20)])
+                result = measure(stage, lambda i: store.search("bench", make_text(i % 20)), iterations)
+            elif stage == "add_to_conversation":
+                result = measure(stage, lambda i: store.add_to_conversation("bench", "user", make_text(history + i)),
+                                 iterations)
+            elif stage == "add_chat_history":
+                engine, session_factory = make_session_factory(os.path.join(workdir, "single.db"))
+                with session_factory() as db:
+                    result = measure(stage, lambda i: add_chat_history(db, "bench", make_text(i), "回复"), iterations)
+                engine.dispose()
+            else:
+                # 与 ChatHistoryWriter 相同的批量写入：每次 50 行一个事务，统计按行折算
+                engine, session_factory = make_session_factory(os.path.join(workdir, "batch.db"))
+                batch = 50
+                rows = [{"user_id": "bench", "message": make_text(i), "response": "回复"} for i in range(batch)]
+                with session_factory() as db:
+                    result = measure(stage, lambda i: add_chat_histories(db, rows), max(1, iterations // batch))
+                engine.dispose()
+                result["iterations"] *= batch
+                result["ops_per_s"] *= batch
+                for key in ("p50_ms", "p95_ms", "p99_ms"):
+                    result[key] /= batch
+            results.append(result)
+    finally:
+        if store is not None:
+            store.close()
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    与基线对比 p50 / p95，变慢超过 threshold（比例）时标记为回归
+    """
+    previous = {r["stage"]: r for r in baseline}
+    regressions = []
+    for result in results:
+        old = previous.get(result["stage"])
+        if not old:
+            continue
+        result["baseline_p50_ms"] = old["p50_ms"]
+        result["change"] = result["p50_ms"] / old["p50_ms"] - 1 if old["p50_ms"] > 0 else 0.0
+        p95_change = result["p95_ms"] / old["p95_ms"] - 1 if old["p95_ms"] > 0 else 0.0
+        result["regression"] = result["change"] > threshold or p95_change > threshold
+        if result["regression"]:
+            regressions.append(result["stage"])
+    return regressions
+
+
+def print_table(results):
+    columns = [("stage", "{}"), ("iterations", "{}"), ("p50_ms", "{:.3f}"), ("p95_ms", "{:.3f}"),
+               ("p99_ms", "{:.3f}"), ("ops_per_s", "{:.1f}")]
+    if any("change" in r for r in results):
+        columns += [("baseline_p50_ms", "{:.3f}"), ("change", "{:+.1%}")]
+    rows = [[name for name, _ in columns] + ([""] if len(columns) > 6 else [])]
+    for r in results:
+        row = [fmt.format(r[name]) if name in r else "-" for name, fmt in columns]
+        if len(columns) > 6:
+            row.append("REGRESSION" if r.get("regression") else "")
+        rows.append(row)
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    for row in rows:
+        print("  ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="请求路径各阶段的微基准")
+    parser.add_argument("--stages", nargs="+", default=list(STAGES), choices=STAGES)
+    parser.add_argument("--iterations", type=int, default=200, help="每个阶段的调用次数")
+    parser.add_argument("--history", type=int, default=500, help="search 前预先写入的消息数")
+    parser.add_argument("--save", help="把结果保存为基线文件")
+    parser.add_argument("--baseline", help="与之前保存的基线对比")
+    parser.add_argument("--threshold", type=float, default=0.2, help="判定为回归的变慢比例")
+    parser.add_argument("--json", action="store_true", help="以 JSON 输出结果")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_stages_")
+    try:
+        results = run_stages(args.stages, args.iterations, args.history, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.threshold)
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+    else:
+        print_table(results)
+        if regressions:
+            print(f"regressions (> {args.threshold:.0%} slower): {', '.join(regressions)}")
+    # 有回归时以非零状态退出，便于在 CI 中使用
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
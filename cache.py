@@ -0,0 +1,187 @@
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import redis.asyncio as aioredis
+
+from logger import logger  # 日志模块
+
+
+class L1Cache:
+    """
+    进程内 LRU 缓存，每条记录带 TTL
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 300):
+        """
+        :param max_size: 最多保存的记录数
+        :param ttl: 记录生存时间（秒）
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (到期时间, 值)
+
+    def get(self, key: str) -> Optional[str]:
+        item = self._data.get(key)
+        if item is None:
+            return None
+        expires_at, value = item
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: str, ttl: float = None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+
+class ResponseCache:
+    """
+    非阻塞的两级响应缓存：
+    - L1：进程内 LRU + TTL，Redis 不可用时仍可继续命中
+    - L2：asyncio Redis 客户端（连接池），批量读取使用 pipeline
+    缓存键由对话摘要与输入决定，同一个键的内容不会变化，只会随对话推进不再被访问，由 TTL 回收，因此不需要失效广播。
+    """
+
+    def __init__(self, host: str = "localhost", port: int = 6379, db: int = 0, max_connections: int = 32,
+                 l1_size: int = 1024, l1_ttl: float = 300, socket_timeout: float = 0.5,
+                 retry_interval: float = 5.0):
+        """
+        :param max_connections: Redis 连接池大小
+        :param l1_size: L1 最多保存的记录数
+        :param l1_ttl: L1 记录的最长生存时间（秒）
+        :param socket_timeout: Redis 连接/读写超时（秒）
+        :param retry_interval: Redis 出错后暂停访问的时间（秒），期间只使用 L1
+        """
+        self.host = host
+        self.port = port
+        self.db = db
+        self.max_connections = max_connections
+        self.socket_timeout = socket_timeout
+        self.retry_interval = retry_interval
+        self.l1 = L1Cache(max_size=l1_size, ttl=l1_ttl)
+        self.redis: Optional[aioredis.Redis] = None
+        self._retry_after = 0.0
+        # 统计信息
+        self.l1_hits = 0
+        self.l2_hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    async def connect(self):
+        """
+        创建连接池并测试连接（需在事件循环中调用）
+        """
+        pool = aioredis.ConnectionPool(
+            host=self.host, port=self.port, db=self.db, decode_responses=True,
+            max_connections=self.max_connections,
+            socket_timeout=self.socket_timeout, socket_connect_timeout=self.socket_timeout,
+        )
+        self.redis = aioredis.Redis(connection_pool=pool)
+        if await self.ping():
+            logger.info("Connected to Redis successfully.")
+        else:
+            logger.error("Failed to connect to Redis, serving from the in-process cache only.")
+
+    async def close(self):
+        if self.redis is not None:
+            await self.redis.close()
+            await self.redis.connection_pool.disconnect()
+            self.redis = None
+            logger.info("Redis connection closed successfully.")
+
+    @property
+    def available(self) -> bool:
+        return self.redis is not None and time.monotonic() >= self._retry_after
+
+    def _mark_error(self, action: str, error: Exception):
+        self.errors += 1
+        self._retry_after = time.monotonic() + self.retry_interval
+        logger.error(f"Redis error while {action}: {error}")
+
+    async def ping(self) -> bool:
+        if self.redis is None:
+            return False
+        try:
+            await self.redis.ping()
+            self._retry_after = 0.0
+            return True
+        except Exception as e:
+            self._mark_error("pinging", e)
+            return False
+
+    async def get(self, key: str) -> Optional[str]:
+        value = self.l1.get(key)
+        if value is not None:
+            self.l1_hits += 1
+            return value
+        if self.available:
+            try:
+                value = await self.redis.get(key)
+            except Exception as e:
+                self._mark_error("fetching cache", e)
+                value = None
+            if value is not None:
+                self.l2_hits += 1
+                self.l1.set(key, value)
+                return value
+        self.misses += 1
+        return None
+
+    async def set(self, key: str, value: str, ttl: int = 3600):
+        self.l1.set(key, value, ttl)
+        if self.available:
+            try:
+                await self.redis.setex(key, ttl, value)
+            except Exception as e:
+                self._mark_error("caching response", e)
+
+    async def get_many(self, keys: List[str]) -> Dict[str, str]:
+        """
+        批量读取：先查 L1，其余键用一次 pipeline 从 Redis 读取
+        """
+        found = {}
+        missing = []
+        for key in keys:
+            value = self.l1.get(key)
+            if value is not None:
+                self.l1_hits += 1
+                found[key] = value
+            else:
+                missing.append(key)
+        if missing and self.available:
+            try:
+                async with self.redis.pipeline(transaction=False) as pipe:
+                    for key in missing:
+                        pipe.get(key)
+                    values = await pipe.execute()
+                for key, value in zip(missing, values):
+                    if value is not None:
+                        self.l2_hits += 1
+                        self.l1.set(key, value)
+                        found[key] = value
+            except Exception as e:
+                self._mark_error("fetching cache", e)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def stats(self) -> dict:
+        hits = self.l1_hits + self.l2_hits
+        lookups = hits + self.misses
+        return {
+            "l1_hits": self.l1_hits,
+            "l2_hits": self.l2_hits,
+            "misses": self.misses,
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "errors": self.errors,
+            "l1_size": len(self.l1),
+            "redis_available": self.available,
+        }
@@ -0,0 +1,110 @@
+import re
+from typing import Callable, Dict, List
+
+from logger import logger  # 日志模块
+
+# 中日韩字符、全角标点：大多数中文分词器约 1 字符 ≈ 1 token
+_CJK_RE = re.compile(r"[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff00-\uffef]")
+# 每条消息的角色标记、分隔符等固定开销
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    估算文本的 token 数：中日韩字符按 1 字符 1 token，其余字符按约 4 字符 1 token
+    """
+    cjk = len(_CJK_RE.findall(text))
+    other = len(text) - cjk
+    return cjk + (other + 3) // 4
+
+
+def make_token_counter(tokenizer_path: str = None) -> Callable[[str], int]:
+    """
+    返回 token 计数函数：给出分词器路径且安装了 transformers 时使用真实分词器，否则使用估算
+    """
+    if not tokenizer_path:
+        return estimate_tokens
+    try:
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(tokenizer_path)
+        logger.info(f"Context builder uses tokenizer from {tokenizer_path}")
+        return lambda text: len(tokenizer.encode(text, add_special_tokens=False))
+    except Exception as e:
+        logger.warning(f"Failed to load tokenizer from {tokenizer_path}, falling back to estimation: {e}")
+        return estimate_tokens
+
+
+class ContextBuilder:
+    """
+    在 token 预算内组装发送给模型的上下文：
+    最近 K 轮对话 + 从 VectorStore.search 语义检索到的更早的相关轮次，去重后按时间顺序排列。
+    预算固定，因此无论对话多长，预填充（prefill）开销都保持不变。
+    """
+
+    def __init__(self, vector_store, max_tokens: int = 2048, recent_turns: int = 6, retrieve_k: int = 4,
+                 token_counter: Callable[[str], int] = estimate_tokens):
+        """
+        :param vector_store: VectorStore 实例
+        :param max_tokens: 上下文（含当前用户输入）的 token 预算
+        :param recent_turns: 优先保留的最近轮数（每轮为一问一答）
+        :param retrieve_k: 语义检索的更早轮次数量
+        :param token_counter: 文本 -> token 数 的函数
+        """
+        self.vector_store = vector_store
+        self.max_tokens = max_tokens
+        self.recent_turns = recent_turns
+        self.retrieve_k = retrieve_k
+        self.token_counter = token_counter
+
+    def message_tokens(self, message: Dict) -> int:
+        return self.token_counter(message["content"]) + MESSAGE_OVERHEAD_TOKENS
+
+    def build(self, user_id: str, user_input: str) -> List[Dict[str, str]]:
+        """
+        返回不含当前用户输入的历史上下文（role/content 列表），总 token 数不超过预算
+        """
+        budget = self.max_tokens - self.token_counter(user_input) - MESSAGE_OVERHEAD_TOKENS
+        if budget <= 0:
+            return []
+
+        # 1. 最近的轮次：从新到旧依次放入，直到预算用完
+        recent = self.vector_store.get_recent_messages(user_id, self.recent_turns * 2)
+        selected = []
+        used = 0
+        for message in reversed(recent):
+            cost = self.message_tokens(message)
+            if used + cost > budget:
+                break
+            selected.append(message)
+            used += cost
+        selected.reverse()
+        # 最近窗口中最早的消息被截断后，检索结果只取窗口之前的轮次
+        seen = {id(message) for message in selected}
+        oldest_recent = recent[len(recent) - len(selected)] if selected else None
+        oldest_recent_id = oldest_recent.get("id") if oldest_recent is not None else None
+
+        # 2. 语义检索的更早轮次：按相关度依次放入（整轮放入或跳过）
+        retrieved = []
+        if self.retrieve_k > 0 and used < budget:
+            for hit in self.vector_store.search(user_id, user_input, top_k=self.retrieve_k):
+                hit_id = hit.get("id")
+                if oldest_recent_id is not None and hit_id is not None and hit_id >= oldest_recent_id:
+                    continue
+                turn = [m for m in self.vector_store.get_turn(hit_id) if id(m) not in seen]
+                if not turn:
+                    continue
+                cost = sum(self.message_tokens(m) for m in turn)
+                if used + cost > budget:
+                    continue
+                retrieved.extend(turn)
+                seen.update(id(m) for m in turn)
+                used += cost
+
+        # 3. 检索到的轮次按时间顺序排在最近轮次之前
+        retrieved.sort(key=lambda m: m.get("id") or 0)
+        context = [{"role": m["role"], "content": m["content"]} for m in retrieved + selected]
+        logger.info(
+            f"Built context for user {user_id}: {len(selected)} recent + {len(retrieved)} retrieved messages, "
+            f"~{used} tokens of {budget}"
+        )
+        return context
@@ -1,9 +1,16 @@
 # E:\work\metahuman-stream\langchain\jiyi\database.py
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Text
+import asyncio
+import base64
+import time
+from sqlalchemy import create_engine, event, insert, select, text, tuple_, Column, Index, Integer, String, DateTime, Text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.orm import Session
+from sqlalchemy.pool import QueuePool
 from datetime import datetime
+from typing import List, Optional, Tuple
+from logger import logger  # 日志模块
+from metrics import stage_timer
 
 # ---------- 初始化 SQLAlchemy ----------
 # SQLAlchemy 基础类
@@ -22,13 +29,34 @@ class ChatHistory(Base):
     response = Column(Text, nullable=False)                    # AI 回复
     timestamp = Column(DateTime, default=datetime.utcnow, index=True)  # 时间戳
 
+    # 按用户分页/导出使用的复合索引（SQLite 索引末尾隐含 rowid，即 id，可直接支持 (timestamp, id) 游标）
+    __table_args__ = (Index("ix_chat_history_user_id_timestamp", "user_id", "timestamp"),)
+
 # ---------- 配置数据库引擎 ----------
 # SQLite 数据库，数据库文件名为 'chat_history.db'
 DATABASE_URL = 'sqlite:///chat_history.db'
-engine = create_engine(DATABASE_URL, echo=False)
+# 连接池：允许跨线程使用连接（读写都在执行器线程池中进行）
+engine = create_engine(
+    DATABASE_URL, echo=False, poolclass=QueuePool, pool_size=8, max_overflow=8, pool_pre_ping=True,
+    connect_args={"check_same_thread": False, "timeout": 30},
+)
+
+@event.listens_for(engine, "connect")
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    """
+    WAL 模式：写入不阻塞并发读取；synchronous=NORMAL 在 WAL 下既安全又减少 fsync
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=30000")
+    cursor.close()
 
 # 创建所有表（如果表不存在的话）
 Base.metadata.create_all(engine)
+# create_all 不会给已存在的表补建索引，旧数据库在这里补上复合索引
+for _index in ChatHistory.__table__.indexes:
+    _index.create(bind=engine, checkfirst=True)
 
 # 创建数据库会话类
 SessionLocal = sessionmaker(bind=engine, autocommit=False, autoflush=False)
@@ -59,6 +87,19 @@ def add_chat_history(db: Session, user_id: str, message: str, response: str):
         db.rollback()  # 出现错误时回滚
         raise e
 
+def add_chat_histories(db: Session, rows: List[dict]):
+    """
+    在一个事务中批量插入多条聊天记录（多行 INSERT）
+    """
+    if not rows:
+        return
+    try:
+        db.execute(insert(ChatHistory), rows)
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        raise e
+
 def get_chat_history(db: Session, user_id: str, limit: int = 5):
     """
     从数据库中获取某用户的聊天记录，按时间倒序排列
@@ -68,3 +109,180 @@ def get_chat_history(db: Session, user_id: str, limit: int = 5):
         .order_by(ChatHistory.timestamp.desc()) \
         .limit(limit) \
         .all()
+
+def encode_cursor(timestamp: datetime, row_id: int) -> str:
+    """
+    把一行的 (timestamp, id) 编码为不透明的分页游标
+    """
+    return base64.urlsafe_b64encode(f"{timestamp.isoformat()}|{row_id}".encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    """
+    解析分页游标，格式错误时抛出 ValueError
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        timestamp, row_id = raw.rsplit("|", 1)
+        return datetime.fromisoformat(timestamp), int(row_id)
+    except Exception:
+        raise ValueError(f"Invalid cursor: {cursor!r}")
+
+def get_chat_history_page(db: Session, user_id: str, limit: int = 50, cursor: Optional[str] = None,
+                          order: str = "desc") -> Tuple[list, Optional[str]]:
+    """
+    按 (timestamp, id) 键集分页读取某用户的聊天记录，返回 (行, 下一页游标)；没有更多记录时游标为 None。
+    每页都是复合索引上的一次范围扫描，翻到多深都不需要 OFFSET；只查询列，不构造 ORM 对象
+    :param cursor: 上一页返回的游标
+    :param order: desc 从新到旧，asc 从旧到新
+    """
+    key = tuple_(ChatHistory.timestamp, ChatHistory.id)
+    query = select(ChatHistory.id, ChatHistory.user_id, ChatHistory.message, ChatHistory.response,
+                   ChatHistory.timestamp).where(ChatHistory.user_id == user_id)
+    if cursor is not None:
+        position = tuple_(*decode_cursor(cursor))
+        query = query.where(key < position if order == "desc" else key > position)
+    if order == "desc":
+        query = query.order_by(ChatHistory.timestamp.desc(), ChatHistory.id.desc())
+    else:
+        query = query.order_by(ChatHistory.timestamp.asc(), ChatHistory.id.asc())
+    # 多取一行判断是否还有下一页
+    rows = db.execute(query.limit(limit + 1)).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].timestamp, rows[-1].id)
+    return rows, next_cursor
+
+def check_connection() -> None:
+    """
+    执行一次简单查询以确认数据库可用
+    """
+    with SessionLocal() as db:
+        db.execute(text("SELECT 1"))
+
+# ---------- 写后（write-behind）批量持久化 ----------
+class ChatHistoryWriter:
+    """
+    聊天记录的写后持久化：请求只把记录放入队列，
+    后台任务按数量或时间攒批，在一个事务中批量写入 SQLite。
+    """
+
+    def __init__(self, batch_size: int = 200, flush_interval: float = 0.5, max_queue: int = 10000,
+                 max_retries: int = 3):
+        """
+        :param batch_size: 每批最多写入的记录数
+        :param flush_interval: 队列中最早的记录最多等待多久（秒）就写入
+        :param max_queue: 队列上限，写入跟不上时入队会等待（背压）
+        :param max_retries: 单批写入失败时的重试次数
+        """
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.max_retries = max_retries
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._executor = None
+        # 统计信息
+        self.written = 0
+        self.batches = 0
+        self.failed = 0
+        self.last_flush_ms = 0.0
+
+    def start(self, executor=None):
+        """
+        启动后台写入任务（需在事件循环中调用）
+        :param executor: 执行写入的线程池，None 时使用事件循环的默认执行器
+        """
+        if self._task is not None:
+            return
+        self._executor = executor
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._task = asyncio.ensure_future(self._run())
+        logger.info(f"Chat history writer started: batch_size={self.batch_size}, flush_interval={self.flush_interval}s")
+
+    async def enqueue(self, user_id: str, message: str, response: str):
+        """
+        将一条聊天记录放入写入队列（时间戳取入队时刻）
+        """
+        row = {"user_id": user_id, "message": message, "response": response, "timestamp": datetime.utcnow()}
+        if self._queue is None:
+            # 未启动后台任务时直接写入
+            await asyncio.get_running_loop().run_in_executor(self._executor, self._write_batch, [row])
+            return
+        await self._queue.put(row)
+
+    async def _collect(self):
+        """
+        攒一批记录，返回 (记录列表, 是否收到停止信号)
+        """
+        batch = []
+        row = await self._queue.get()
+        if row is None:
+            return batch, True
+        batch.append(row)
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            if self._queue.empty():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                # 短暂让出事件循环等待更多记录（不对 get() 做超时取消，避免丢失记录）
+                await asyncio.sleep(min(remaining, 0.05))
+                continue
+            row = self._queue.get_nowait()
+            if row is None:
+                return batch, True
+            batch.append(row)
+        return batch, False
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch, stopping = await self._collect()
+            if batch:
+                await self._flush(loop, batch)
+            if stopping:
+                break
+
+    async def _flush(self, loop, batch: List[dict]):
+        for attempt in range(1, self.max_retries + 1):
+            try:
+                await loop.run_in_executor(self._executor, self._write_batch, batch)
+                return
+            except Exception as e:
+                logger.error(f"Failed to write {len(batch)} chat history rows (attempt {attempt}): {e}")
+                await asyncio.sleep(0.1 * attempt)
+        self.failed += len(batch)
+
+    def _write_batch(self, rows: List[dict]):
+        start = time.perf_counter()
+        with stage_timer("sqlite_flush"), SessionLocal() as db:
+            add_chat_histories(db, rows)
+        self.last_flush_ms = (time.perf_counter() - start) * 1000
+        self.written += len(rows)
+        self.batches += 1
+
+    async def stop(self):
+        """
+        停止后台任务，并把队列中剩余的记录全部写入
+        """
+        if self._task is None:
+            return
+        pending = self._queue.qsize()
+        # 停止信号排在所有已入队记录之后，后台任务写完它们后退出
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+        self._queue = None
+        logger.info(f"Chat history writer stopped, flushed {pending} pending rows")
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "written": self.written,
+            "batches": self.batches,
+            "failed": self.failed,
+            "last_flush_ms": self.last_flush_ms,
+        }
+
+chat_history_writer = ChatHistoryWriter()
@@ -0,0 +1,275 @@
+import os
+import threading
+import time
+from typing import List, Optional
+
+import numpy as np
+
+from logger import get_logger
+
+logger = get_logger("EmbeddingBackend")
+
+# 后端状态：unloaded -> loading -> loaded -> warming -> ready，任一阶段出错为 failed
+STATE_UNLOADED = "unloaded"
+STATE_LOADING = "loading"
+STATE_LOADED = "loaded"
+STATE_WARMING = "warming"
+STATE_READY = "ready"
+STATE_FAILED = "failed"
+
+
+def build_model(model_path: str, max_seq_length: int = 128):
+    """
+    构建 SentenceTransformer 模型（Transformer + 平均池化）
+    """
+    from sentence_transformers import SentenceTransformer, models
+    transformer = models.Transformer(model_path, max_seq_length=max_seq_length)
+    pooling = models.Pooling(transformer.get_word_embedding_dimension())
+    return SentenceTransformer(modules=[transformer, pooling])
+
+
+class EmbeddingBackend:
+    """
+    嵌入后端接口：load() 加载模型，warm_up() 预热，encode() 批量编码。
+    prepare() 幂等地完成加载与预热；start() 在后台线程中执行 prepare()，
+    服务可以先响应存活检查（/health），就绪（ready）之后再接收流量。
+    未就绪时调用 encode() 会同步加载（或等待正在进行的加载）。
+    """
+
+    name = "base"
+    # 嵌入缓存键的附加标识：不同后端的向量存在细微差别，不能互相复用缓存
+    cache_tag = ""
+    WARMUP_TEXTS = ["预热", "这是一条用于预热嵌入模型的句子。", "warm up " * 64]
+
+    def __init__(self, model_path: str, max_seq_length: int = 128, ready_timeout: float = 600):
+        """
+        :param model_path: 模型目录
+        :param max_seq_length: 最大序列长度
+        :param ready_timeout: encode() 等待加载完成的最长时间（秒）
+        """
+        self.model_path = model_path
+        self.max_seq_length = max_seq_length
+        self.ready_timeout = ready_timeout
+        self.dimension: Optional[int] = None
+        self.state = STATE_UNLOADED
+        self.error: Optional[str] = None
+        self.load_seconds: Optional[float] = None
+        self.warmup_seconds: Optional[float] = None
+        self._prepare_lock = threading.Lock()
+        self._thread = None
+
+    def _load(self) -> int:
+        """
+        加载模型，返回向量维度
+        """
+        raise NotImplementedError
+
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        raise NotImplementedError
+
+    @property
+    def ready(self) -> bool:
+        return self.state == STATE_READY
+
+    def _fail(self, stage: str, error: Exception):
+        self.state = STATE_FAILED
+        self.error = f"{stage}: {error}"
+        logger.error(f"嵌入后端 {self.name} {stage}失败: {error}")
+
+    def prepare(self, warm_up: bool = True):
+        """
+        加载模型并（可选）预热，已完成的阶段不会重复执行。
+        gunicorn preload_app=True 时可在 master 中只加载（warm_up=False），
+        预热放到 fork 之后的 worker 中进行，避免在 fork 前运行推理线程池。
+        """
+        if self.state == STATE_READY or (not warm_up and self.state == STATE_LOADED):
+            return
+        if not self._prepare_lock.acquire(timeout=self.ready_timeout):
+            raise RuntimeError(f"等待嵌入后端 {self.name} 加载超时")
+        try:
+            if self.state == STATE_FAILED:
+                raise RuntimeError(f"嵌入后端 {self.name} 不可用: {self.error}")
+            if self.state == STATE_UNLOADED:
+                self.state = STATE_LOADING
+                start = time.perf_counter()
+                try:
+                    self.dimension = self._load()
+                except Exception as e:
+                    self._fail("加载", e)
+                    raise
+                self.load_seconds = time.perf_counter() - start
+                self.state = STATE_LOADED
+                logger.info(f"嵌入后端 {self.name} 加载完成，维度 {self.dimension}，耗时 {self.load_seconds:.2f}s")
+            if warm_up and self.state == STATE_LOADED:
+                self.state = STATE_WARMING
+                start = time.perf_counter()
+                try:
+                    # 单条与整批各跑一次，触发算子初始化与内存分配
+                    self._encode(self.WARMUP_TEXTS[:1])
+                    self._encode(self.WARMUP_TEXTS)
+                except Exception as e:
+                    self._fail("预热", e)
+                    raise
+                self.warmup_seconds = time.perf_counter() - start
+                self.state = STATE_READY
+                logger.info(f"嵌入后端 {self.name} 预热完成，耗时 {self.warmup_seconds:.2f}s")
+        finally:
+            self._prepare_lock.release()
+
+    def start(self):
+        """
+        在后台线程中加载并预热（需在 fork 之后调用）
+        """
+        if self.ready or (self._thread is not None and self._thread.is_alive()):
+            return
+        self._thread = threading.Thread(target=self._prepare_quietly, name="embedding-warmup", daemon=True)
+        self._thread.start()
+
+    def _prepare_quietly(self):
+        try:
+            self.prepare()
+        except Exception:
+            pass  # 错误已记录在 state/error 中
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        """
+        批量编码，返回 (len(texts), dimension) 的 float32 数组
+        """
+        if self.state != STATE_READY:
+            self.prepare(warm_up=False)
+        return np.asarray(self._encode(texts), dtype="float32")
+
+    def stats(self) -> dict:
+        return {
+            "backend": self.name,
+            "state": self.state,
+            "dimension": self.dimension,
+            "load_seconds": self.load_seconds,
+            "warmup_seconds": self.warmup_seconds,
+            "error": self.error,
+        }
+
+
+class TorchBackend(EmbeddingBackend):
+    """
+    PyTorch 后端：sentence-transformers（Transformer + 平均池化），与原有行为一致
+    """
+
+    name = "torch"
+
+    def __init__(self, model_path: str, max_seq_length: int = 128, ready_timeout: float = 600):
+        super().__init__(model_path, max_seq_length, ready_timeout)
+        self.model = None
+
+    def _load(self) -> int:
+        self.model = build_model(self.model_path, self.max_seq_length)
+        return self.model.get_sentence_embedding_dimension()
+
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        return self.model.encode(texts, batch_size=len(texts))
+
+
+class OnnxBackend(EmbeddingBackend):
+    """
+    ONNX Runtime 后端：CPU 上运行 int8 动态量化的模型（由 export_onnx_int8 导出），
+    启动更快、占用内存更少，向量与 PyTorch 后端略有差异。
+    需要安装 onnxruntime 与 transformers（分词器）。
+    """
+
+    name = "onnx"
+    cache_tag = "onnx-int8"
+
+    def __init__(self, model_path: str, max_seq_length: int = 128, ready_timeout: float = 600,
+                 onnx_path: Optional[str] = None, intra_op_threads: int = 0):
+        """
+        :param onnx_path: 量化模型文件，默认为 <model_path>/onnx/model_int8.onnx
+        :param intra_op_threads: ONNX Runtime 算子内线程数，0 表示由运行时决定
+        """
+        super().__init__(model_path, max_seq_length, ready_timeout)
+        self.onnx_path = onnx_path or default_onnx_path(model_path)
+        self.intra_op_threads = intra_op_threads
+        self.session = None
+        self.tokenizer = None
+        self.input_names: List[str] = []
+
+    def _load(self) -> int:
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        if not os.path.exists(self.onnx_path):
+            raise FileNotFoundError(f"{self.onnx_path} 不存在，请先运行 python bench_embedding.py --export")
+        self.tokenizer = AutoTokenizer.from_pretrained(self.model_path)
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if self.intra_op_threads > 0:
+            options.intra_op_num_threads = self.intra_op_threads
+        self.session = ort.InferenceSession(self.onnx_path, options, providers=["CPUExecutionProvider"])
+        self.input_names = [i.name for i in self.session.get_inputs()]
+        hidden = self.session.get_outputs()[0].shape[-1]
+        return hidden if isinstance(hidden, int) else int(self._encode(["维度"]).shape[1])
+
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        encoded = self.tokenizer(texts, padding=True, truncation=True, max_length=self.max_seq_length,
+                                 return_tensors="np")
+        feeds = {}
+        for name in self.input_names:
+            if name in encoded:
+                feeds[name] = encoded[name].astype("int64")
+            else:
+                feeds[name] = np.zeros_like(encoded["input_ids"], dtype="int64")
+        token_embeddings = self.session.run(None, feeds)[0]
+        # 与 sentence-transformers 的 Pooling 一致：按 attention_mask 做平均池化
+        mask = encoded["attention_mask"][..., None].astype("float32")
+        summed = (token_embeddings * mask).sum(axis=1)
+        counts = np.clip(mask.sum(axis=1), 1e-9, None)
+        return summed / counts
+
+
+BACKENDS = {
+    TorchBackend.name: TorchBackend,
+    OnnxBackend.name: OnnxBackend,
+}
+
+
+def create_backend(name: str, model_path: str, max_seq_length: int = 128, **kwargs) -> EmbeddingBackend:
+    """
+    按名称创建嵌入后端（torch / onnx），此时不加载模型
+    """
+    if name not in BACKENDS:
+        raise ValueError(f"未知的嵌入后端: {name}，可选: {', '.join(BACKENDS)}")
+    return BACKENDS[name](model_path, max_seq_length, **kwargs)
+
+
+def default_onnx_path(model_path: str) -> str:
+    return os.path.join(model_path, "onnx", "model_int8.onnx")
+
+
+def export_onnx_int8(model_path: str, output_path: Optional[str] = None, max_seq_length: int = 128) -> str:
+    """
+    把 HuggingFace 模型导出为 ONNX，并做 int8 动态量化（权重量化，激活在运行时量化）。
+    需要安装 torch、transformers 与 onnxruntime。返回量化模型路径。
+    """
+    import torch
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    from transformers import AutoModel, AutoTokenizer
+
+    output_path = output_path or default_onnx_path(model_path)
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    fp32_path = output_path.replace("_int8", "") if "_int8" in output_path else output_path + ".fp32.onnx"
+
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    model = AutoModel.from_pretrained(model_path).eval()
+    dummy = tokenizer(["导出 ONNX 模型"], padding="max_length", truncation=True, max_length=max_seq_length,
+                      return_tensors="pt")
+    input_names = [name for name in ("input_ids", "attention_mask", "token_type_ids") if name in dummy]
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+    dynamic_axes["last_hidden_state"] = {0: "batch", 1: "sequence"}
+    with torch.no_grad():
+        torch.onnx.export(
+            model, tuple(dummy[name] for name in input_names), fp32_path,
+            input_names=input_names, output_names=["last_hidden_state"],
+            dynamic_axes=dynamic_axes, opset_version=14,
+        )
+    quantize_dynamic(fp32_path, output_path, weight_type=QuantType.QInt8)
+    logger.info(f"导出 int8 ONNX 模型到 {output_path}（fp32 版本 {fp32_path}）")
+    return output_path
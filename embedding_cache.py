@@ -0,0 +1,189 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Optional
+
+import numpy as np
+
+from logger import get_logger
+
+logger = get_logger("EmbeddingCache")
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    """
+    归一化文本：NFKC（全角转半角等）、去首尾空白、合并连续空白
+    """
+    return _WHITESPACE_RE.sub(" ", unicodedata.normalize("NFKC", text)).strip()
+
+
+class EmbeddingCache:
+    """
+    内容寻址的嵌入缓存，两级结构：
+    - L1：进程内 LRU（OrderedDict）
+    - L2：磁盘上的 float32 内存映射文件，组相联布局，重启后仍然有效，
+      多个 gunicorn worker 映射同一文件即可共享，无需复制
+    键为 (模型标识 + 归一化文本) 的 16 字节哈希。
+    """
+
+    KEY_BYTES = 16
+
+    def __init__(self, path: str, dimension: int, model_id: str, capacity: int = 50000,
+                 lru_size: int = 4096, ways: int = 4, write_lock=None):
+        """
+        :param path: 缓存文件目录
+        :param dimension: 向量维度
+        :param model_id: 模型标识，参与键的计算，换模型后旧向量自然失效
+        :param capacity: 磁盘缓存最多保存的向量数
+        :param lru_size: 进程内 LRU 最多保存的向量数
+        :param ways: 组相联的路数，同一组满时随机替换其中一路
+        :param write_lock: 多进程同时写入时用于互斥的跨进程锁（file_lock.FileLock），None 表示单写入者
+        """
+        self.dimension = dimension
+        self.model_id = model_id
+        self.ways = ways
+        self.nsets = max(1, capacity // ways)
+        self.capacity = self.nsets * ways
+        self.lru_size = lru_size
+        self.write_lock = write_lock
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+        # 统计信息
+        self.l1_hits = 0
+        self.l2_hits = 0
+        self.misses = 0
+        self.l1_evictions = 0
+        self.l2_evictions = 0
+
+        os.makedirs(path, exist_ok=True)
+        self.vectors_path = os.path.join(path, "embedding_cache.f32")
+        self.keys_path = os.path.join(path, "embedding_cache.keys")
+        self.meta_path = os.path.join(path, "embedding_cache.json")
+        self._open_store()
+
+    def _open_store(self):
+        meta = {"dimension": self.dimension, "capacity": self.capacity, "ways": self.ways}
+        reuse = False
+        if os.path.exists(self.meta_path) and os.path.exists(self.vectors_path) and os.path.exists(self.keys_path):
+            try:
+                with open(self.meta_path, "r", encoding="utf-8") as f:
+                    reuse = json.load(f) == meta
+            except Exception as e:
+                logger.warning(f"读取嵌入缓存元数据失败，将重建缓存: {e}")
+        mode = "r+" if reuse else "w+"
+        self.vectors = np.memmap(self.vectors_path, dtype="float32", mode=mode,
+                                 shape=(self.capacity, self.dimension))
+        self.keys = np.memmap(self.keys_path, dtype="uint8", mode=mode,
+                              shape=(self.capacity, self.KEY_BYTES))
+        if not reuse:
+            with open(self.meta_path, "w", encoding="utf-8") as f:
+                json.dump(meta, f)
+            logger.info(f"创建嵌入缓存文件 {self.vectors_path}，容量 {self.capacity}")
+        else:
+            logger.info(f"复用嵌入缓存文件 {self.vectors_path}，容量 {self.capacity}")
+
+    def make_key(self, text: str) -> bytes:
+        payload = f"{self.model_id}\0{normalize_text(text)}".encode("utf-8")
+        return hashlib.blake2b(payload, digest_size=self.KEY_BYTES).digest()
+
+    def _set_range(self, key: bytes):
+        start = (int.from_bytes(key[:8], "little") % self.nsets) * self.ways
+        return start, start + self.ways
+
+    def _l2_get(self, key: bytes) -> Optional[np.ndarray]:
+        key_row = np.frombuffer(key, dtype="uint8")
+        start, end = self._set_range(key)
+        for slot in range(start, end):
+            if np.array_equal(self.keys[slot], key_row):
+                vector = np.array(self.vectors[slot])
+                # 复制后再校验一次键，防止其他进程在读取期间覆盖了该槽位
+                if np.array_equal(self.keys[slot], key_row):
+                    return vector
+                return None
+        return None
+
+    def _l2_put(self, key: bytes, vector: np.ndarray):
+        key_row = np.frombuffer(key, dtype="uint8")
+        start, end = self._set_range(key)
+        victim = None
+        for slot in range(start, end):
+            if np.array_equal(self.keys[slot], key_row):
+                return
+            if victim is None and not self.keys[slot].any():
+                victim = slot
+        if victim is None:
+            victim = start + key[8] % self.ways
+            self.l2_evictions += 1
+        # 先清键、再写向量、最后写键，读方校验键即可发现未完成的写入
+        self.keys[victim] = 0
+        self.vectors[victim] = vector
+        self.keys[victim] = key_row
+
+    def get(self, text: str) -> Optional[np.ndarray]:
+        """
+        查询缓存，未命中返回 None
+        """
+        key = self.make_key(text)
+        with self._lock:
+            vector = self._lru.get(key)
+            if vector is not None:
+                self._lru.move_to_end(key)
+                self.l1_hits += 1
+                return vector
+            vector = self._l2_get(key)
+            if vector is None:
+                self.misses += 1
+                return None
+            self.l2_hits += 1
+            self._lru_put(key, vector)
+            return vector
+
+    def put(self, text: str, vector: np.ndarray):
+        """
+        写入缓存（同时写入 L1 与 L2）
+        """
+        key = self.make_key(text)
+        vector = np.asarray(vector, dtype="float32").reshape(self.dimension)
+        with self._lock:
+            self._lru_put(key, vector)
+            if self.write_lock is not None:
+                # 两个进程同时写同一槽位可能留下 A 的键配 B 的向量
+                with self.write_lock:
+                    self._l2_put(key, vector)
+            else:
+                self._l2_put(key, vector)
+
+    def _lru_put(self, key: bytes, vector: np.ndarray):
+        self._lru[key] = vector
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.lru_size:
+            self._lru.popitem(last=False)
+            self.l1_evictions += 1
+
+    def flush(self):
+        """
+        将内存映射的修改刷回磁盘
+        """
+        with self._lock:
+            self.vectors.flush()
+            self.keys.flush()
+
+    def stats(self) -> dict:
+        hits = self.l1_hits + self.l2_hits
+        lookups = hits + self.misses
+        return {
+            "l1_hits": self.l1_hits,
+            "l2_hits": self.l2_hits,
+            "misses": self.misses,
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "l1_size": len(self._lru),
+            "l1_evictions": self.l1_evictions,
+            "l2_evictions": self.l2_evictions,
+            "capacity": self.capacity,
+        }
@@ -0,0 +1,185 @@
+import asyncio
+import functools
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import List, Optional
+
+import numpy as np
+
+from logger import logger  # 日志模块
+
+# FAISS 检索/写入与磁盘 I/O 使用的线程数（FAISS、numpy 计算时会释放 GIL）
+IO_WORKERS = 4
+# 需要计算嵌入的操作（上下文组装、索引写入、语义缓存）使用的线程数：这些线程大部分时间在等待微批处理的结果，
+# 线程数即同时能排队的文本数，不小于嵌入批大小（VectorStore 的 embed_batch_size）才能凑满一批；
+# 与 io 线程池分开，数据库读写不会排在嵌入等待之后
+EMBEDDING_WAIT_WORKERS = 32
+# 嵌入计算使用的进程数，0 表示不启用进程池（嵌入在 VectorStore 的批处理线程中计算）
+EMBEDDING_PROCESSES = 0
+
+
+# ---------- 嵌入进程池 ----------
+_process_model = None
+
+
+def _init_embedding_process(backend_name: str, model_path: str, max_seq_length: int):
+    """
+    进程池初始化：每个子进程各自加载并预热一份模型
+    """
+    global _process_model
+    os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
+    from embedding_backend import create_backend
+    _process_model = create_backend(backend_name, model_path, max_seq_length)
+    _process_model.prepare()
+
+
+def _encode_in_process(texts: List[str]) -> np.ndarray:
+    return _process_model.encode(texts)
+
+
+class Executors:
+    """
+    执行器子系统：把 CPU 密集和阻塞 I/O 的工作移出 asyncio 事件循环
+    - io：线程池，用于 FAISS 与磁盘/数据库 I/O
+    - embedding_waits：线程池，用于需要等待嵌入结果的操作
+    - embedding：可选的进程池，用于嵌入计算
+    - 后台任务：响应返回后才执行的索引等工作，关闭时统一等待完成
+    """
+
+    def __init__(self, io_workers: int = IO_WORKERS, embedding_processes: int = EMBEDDING_PROCESSES,
+                 embedding_wait_workers: int = EMBEDDING_WAIT_WORKERS):
+        self.io_workers = io_workers
+        self.embedding_processes = embedding_processes
+        self.embedding_wait_workers = embedding_wait_workers
+        self.io = ThreadPoolExecutor(max_workers=io_workers, thread_name_prefix="vs-io")
+        self.embedding_waits = ThreadPoolExecutor(max_workers=embedding_wait_workers, thread_name_prefix="vs-embed")
+        self.embedding: Optional[ProcessPoolExecutor] = None
+        self._background = set()
+        # 统计信息
+        self.background_completed = 0
+        self.background_failed = 0
+
+    def attach_embedding_pool(self, vector_store):
+        """
+        按嵌入批大小调整等待线程数；启用进程池时，让 VectorStore 的批处理线程把整批文本交给子进程编码
+        """
+        if vector_store.embedding_batcher is None:
+            return
+        batch_size = vector_store.embedding_batcher.max_batch_size
+        if batch_size > self.embedding_wait_workers:
+            # 线程按需创建，启动时替换线程池没有额外开销
+            old = self.embedding_waits
+            self.embedding_wait_workers = batch_size
+            self.embedding_waits = ThreadPoolExecutor(max_workers=batch_size, thread_name_prefix="vs-embed")
+            old.shutdown(wait=False)
+        if self.embedding_processes <= 0:
+            return
+        self.embedding = ProcessPoolExecutor(
+            max_workers=self.embedding_processes,
+            initializer=_init_embedding_process,
+            initargs=(vector_store.embedding_backend.name, vector_store.model_path, vector_store.max_seq_length),
+        )
+        pool = self.embedding
+        vector_store.embedding_batcher.encode_fn = lambda texts: pool.submit(_encode_in_process, texts).result()
+        logger.info(f"Embedding process pool started with {self.embedding_processes} processes")
+
+    async def run_io(self, fn, *args, **kwargs):
+        """
+        在线程池中执行阻塞函数
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.io, functools.partial(fn, *args, **kwargs))
+
+    async def run_embedding(self, fn, *args, **kwargs):
+        """
+        在嵌入等待线程池中执行需要计算嵌入的阻塞函数
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.embedding_waits, functools.partial(fn, *args, **kwargs))
+
+    def spawn(self, coro) -> asyncio.Task:
+        """
+        调度后台任务（不阻塞当前请求），异常只记录日志
+        """
+        task = asyncio.ensure_future(coro)
+        self._background.add(task)
+        task.add_done_callback(self._on_background_done)
+        return task
+
+    def _on_background_done(self, task: asyncio.Task):
+        self._background.discard(task)
+        if task.cancelled():
+            self.background_failed += 1
+            return
+        error = task.exception()
+        if error is not None:
+            self.background_failed += 1
+            logger.error(f"Background task failed: {error}")
+        else:
+            self.background_completed += 1
+
+    async def drain(self, timeout: float = 30.0):
+        """
+        等待所有后台任务完成（关闭前调用）
+        """
+        pending = list(self._background)
+        if not pending:
+            return
+        logger.info(f"Waiting for {len(pending)} background tasks to finish...")
+        done, not_done = await asyncio.wait(pending, timeout=timeout)
+        if not_done:
+            logger.warning(f"{len(not_done)} background tasks did not finish before shutdown")
+
+    def shutdown(self):
+        self.io.shutdown(wait=True)
+        self.embedding_waits.shutdown(wait=True)
+        if self.embedding is not None:
+            self.embedding.shutdown(wait=True)
+
+    def stats(self) -> dict:
+        return {
+            "io_workers": self.io_workers,
+            "embedding_wait_workers": self.embedding_wait_workers,
+            "embedding_processes": self.embedding_processes if self.embedding is not None else 0,
+            "background_pending": len(self._background),
+            "background_completed": self.background_completed,
+            "background_failed": self.background_failed,
+        }
+
+
+class AsyncVectorStore:
+    """
+    VectorStore 的异步包装：所有可能阻塞的操作都在执行器线程池中运行，
+    需要计算嵌入的操作使用嵌入等待线程池，其余使用 io 线程池
+    """
+
+    def __init__(self, vector_store, executors: Executors):
+        self.store = vector_store
+        self.executors = executors
+
+    async def get_embedding(self, text: str) -> np.ndarray:
+        return await self.executors.run_embedding(self.store.get_embedding, text)
+
+    async def get_embeddings(self, texts: List[str]) -> np.ndarray:
+        return await self.executors.run_embedding(self.store.get_embeddings, texts)
+
+    async def search(self, user_id: str, query: str, top_k: int = 3):
+        return await self.executors.run_embedding(self.store.search, user_id, query, top_k)
+
+    async def get_conversation_history(self, user_id: str):
+        return await self.executors.run_io(self.store.get_conversation_history, user_id)
+
+    async def append_message(self, user_id: str, role: str, content: str) -> int:
+        return await self.executors.run_io(self.store.append_message, user_id, role, content)
+
+    async def index_message(self, user_id: str, message_id: int, role: str, content: str):
+        return await self.executors.run_embedding(self.store.index_message, user_id, message_id, role, content)
+
+    async def index_messages(self, entries: List[tuple]):
+        return await self.executors.run_embedding(self.store.index_messages, entries)
+
+    async def add_to_conversation(self, user_id: str, role: str, content: str):
+        return await self.executors.run_embedding(self.store.add_to_conversation, user_id, role, content)
+
+
+executors = Executors()
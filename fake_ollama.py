@@ -0,0 +1,193 @@
+"""
+本地模拟 Ollama 服务：实现 OpenAI 兼容的 /v1/chat/completions（含 stream=true 的 SSE），
+按可配置的首 token 延迟与生成速率返回固定格式的回复，用于压测时排除真实模型的影响。
+
+用法：
+    python fake_ollama.py                                    # 监听 127.0.0.1:11434（与 DEFAULT_OLLAMA_API_URL 一致）
+    python fake_ollama.py --latency-ms 300 --tokens-per-s 40 --tokens 80
+    python fake_ollama.py --port 11435 --error-rate 0.01     # 按比例返回 500，用于观察错误处理
+    python fake_ollama.py --port 11436 --tail-rate 0.05 --tail-ms 2000 --models qwen2.5:3b
+                                                             # 5% 的请求额外慢 2 秒（观察对冲请求），只提供指定模型
+    python fake_ollama.py --disconnect-after 3               # 流式回复输出 3 段后断开连接（模拟后端中途崩溃）
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+
+from aiohttp import web
+
+# 回复内容由这些片段循环拼接而成，每个片段计为一个 token
+REPLY_TOKENS = ["好的", "，", "我", "明白", "了", "。", "这是", "一条", "模拟", "的", "回复", "。"]
+
+
+class FakeOllama:
+    """
+    模拟的生成后端：首 token 延迟（可抖动）+ 按速率逐 token 输出
+    """
+
+    def __init__(self, latency_ms: float = 200, jitter_ms: float = 50, tokens_per_s: float = 50,
+                 tokens: int = 60, error_rate: float = 0.0, seed: int = None, tail_rate: float = 0.0,
+                 tail_ms: float = 0.0, models=None, disconnect_after: int = None):
+        """
+        :param latency_ms: 首 token 延迟（预填充耗时）
+        :param jitter_ms: 首 token 延迟的随机抖动范围（±）
+        :param tokens_per_s: 生成速率，<= 0 表示不限速
+        :param tokens: 每条回复的 token 数
+        :param error_rate: 返回 HTTP 500 的请求比例
+        :param seed: 随机种子，便于复现
+        :param tail_rate: 额外增加 tail_ms 首 token 延迟的请求比例（模拟长尾）
+        :param tail_ms: 长尾请求额外增加的延迟
+        :param models: /api/tags 列出的模型，None 表示接受任意模型
+        :param disconnect_after: 流式回复输出这么多段后直接断开连接，None 表示正常结束
+        """
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.tokens_per_s = tokens_per_s
+        self.tokens = tokens
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.tail_rate = tail_rate
+        self.tail_ms = tail_ms
+        self.models = list(models) if models else None
+        self.disconnect_after = disconnect_after
+        # 处理过请求的模型视为已加载，由 /api/ps 列出
+        self.loaded = []
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def reply_tokens(self):
+        return [REPLY_TOKENS[i % len(REPLY_TOKENS)] for i in range(self.tokens)]
+
+    async def first_token_delay(self):
+        jitter = self.random.uniform(-self.jitter_ms, self.jitter_ms) if self.jitter_ms else 0.0
+        if self.tail_rate and self.random.random() < self.tail_rate:
+            jitter += self.tail_ms
+        await asyncio.sleep(max(0.0, self.latency_ms + jitter) / 1000)
+
+    async def token_delay(self):
+        if self.tokens_per_s > 0:
+            await asyncio.sleep(1 / self.tokens_per_s)
+
+    async def handle_chat(self, request: web.Request) -> web.StreamResponse:
+        payload = await request.json()
+        self.requests += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if self.error_rate and self.random.random() < self.error_rate:
+                await self.first_token_delay()
+                return web.json_response({"error": "simulated failure"}, status=500)
+            model = payload.get("model", "fake")
+            if self.models is not None and model not in self.models and f"{model}:latest" not in self.models:
+                return web.json_response({"error": f"model \"{model}\" not found"}, status=404)
+            if model not in self.loaded:
+                self.loaded.append(model)
+            completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+            created = int(time.time())
+            if payload.get("stream"):
+                return await self.stream(request, completion_id, created, model)
+
+            await self.first_token_delay()
+            for _ in range(self.tokens - 1):
+                await self.token_delay()
+            prompt_tokens = sum(len(m.get("content", "")) for m in payload.get("messages", []))
+            return web.json_response({
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": "".join(self.reply_tokens())},
+                    "finish_reason": "stop",
+                }],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": self.tokens,
+                          "total_tokens": prompt_tokens + self.tokens},
+            })
+        finally:
+            self.in_flight -= 1
+
+    async def stream(self, request: web.Request, completion_id: str, created: int, model: str):
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await response.prepare(request)
+
+        def chunk(delta, finish_reason=None):
+            data = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }
+            return f"data: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8")
+
+        await self.first_token_delay()
+        for i, token in enumerate(self.reply_tokens()):
+            if i:
+                await self.token_delay()
+            if self.disconnect_after is not None and i >= self.disconnect_after:
+                # 不写结束块与 [DONE]，直接关闭连接
+                request.transport.close()
+                return response
+            delta = {"role": "assistant", "content": token} if i == 0 else {"content": token}
+            await response.write(chunk(delta))
+        await response.write(chunk({}, "stop"))
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def handle_tags(self, request: web.Request) -> web.Response:
+        # Ollama 原生接口：列出本地模型，可作为健康检查
+        names = self.models if self.models is not None else ["fake:latest"]
+        return web.json_response({"models": [{"name": name, "model": name} for name in names]})
+
+    async def handle_ps(self, request: web.Request) -> web.Response:
+        # Ollama 原生接口：列出已加载到内存的模型
+        return web.json_response({"models": [{"name": name, "model": name} for name in self.loaded]})
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        return web.json_response({
+            "requests": self.requests,
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+        })
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.handle_chat)
+        app.router.add_get("/api/tags", self.handle_tags)
+        app.router.add_get("/api/ps", self.handle_ps)
+        app.router.add_get("/stats", self.handle_stats)
+        return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地模拟 Ollama 服务（OpenAI 兼容接口）")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11434)
+    parser.add_argument("--latency-ms", type=float, default=200, help="首 token 延迟（毫秒）")
+    parser.add_argument("--jitter-ms", type=float, default=50, help="首 token 延迟的抖动（±毫秒）")
+    parser.add_argument("--tokens-per-s", type=float, default=50, help="生成速率，<= 0 表示不限速")
+    parser.add_argument("--tokens", type=int, default=60, help="每条回复的 token 数")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="返回 HTTP 500 的请求比例")
+    parser.add_argument("--seed", type=int, help="随机种子")
+    parser.add_argument("--tail-rate", type=float, default=0.0, help="额外变慢的请求比例（模拟长尾）")
+    parser.add_argument("--tail-ms", type=float, default=2000, help="长尾请求额外增加的延迟（毫秒）")
+    parser.add_argument("--models", nargs="+", help="提供的模型，默认接受任意模型")
+    parser.add_argument("--disconnect-after", type=int, help="流式回复输出这么多段后断开连接")
+    args = parser.parse_args()
+
+    fake = FakeOllama(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, tokens_per_s=args.tokens_per_s,
+                      tokens=max(1, args.tokens), error_rate=args.error_rate, seed=args.seed,
+                      tail_rate=args.tail_rate, tail_ms=args.tail_ms, models=args.models,
+                      disconnect_after=args.disconnect_after)
+    print(f"Fake Ollama listening on http://{args.host}:{args.port}/v1/chat/completions")
+    web.run_app(fake.make_app(), host=args.host, port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+import os
+import threading
+from typing import Optional
+
+try:
+    import fcntl  # 仅 POSIX 平台提供
+except ImportError:
+    fcntl = None
+
+from logger import logger  # 日志模块
+
+_reinit_lock = threading.Lock()
+
+
+class FileLock:
+    """
+    跨进程互斥锁：fcntl.flock 保证进程之间互斥，进程内再用 RLock 保证线程之间互斥，同一线程可重入。
+    fork 之后（例如 gunicorn preload_app=True）子进程第一次使用时会重新打开锁文件，
+    不会与父进程共享同一个文件描述（flock 按文件描述加锁）。
+    没有 fcntl 的平台上退化为进程内锁。
+    """
+
+    def __init__(self, path: str):
+        """
+        :param path: 锁文件路径（不存在时自动创建）
+        """
+        self.path = path
+        self._fd = None
+        self._pid = None
+        self._thread_lock = threading.RLock()
+        self._depth = 0
+        if fcntl is None:
+            logger.warning(f"fcntl is not available, {path} only locks within this process")
+
+    def _ensure_open(self):
+        if self._pid == os.getpid():
+            return
+        with _reinit_lock:
+            if self._pid == os.getpid():
+                return
+            # fork 后继承的锁状态与文件描述都属于父进程，全部重建
+            self._thread_lock = threading.RLock()
+            self._depth = 0
+            if fcntl is not None:
+                self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            self._pid = os.getpid()
+
+    def acquire(self, blocking: bool = True) -> bool:
+        self._ensure_open()
+        if not self._thread_lock.acquire(blocking):
+            return False
+        if self._depth == 0 and fcntl is not None:
+            try:
+                fcntl.flock(self._fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                self._thread_lock.release()
+                return False
+            except BaseException:
+                self._thread_lock.release()
+                raise
+        self._depth += 1
+        return True
+
+    def release(self):
+        self._depth -= 1
+        if self._depth == 0 and fcntl is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._thread_lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+
+
+def try_lock_file(path: str) -> Optional[int]:
+    """
+    以非阻塞方式独占锁文件，成功返回文件描述符（关闭它即释放锁，可在其他线程中关闭），
+    已被其他进程持有时返回 None。没有 fcntl 的平台上总是成功。
+    进程崩溃时锁由操作系统自动释放。
+    """
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    if fcntl is None:
+        return fd
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    return fd
@@ -1,6 +1,7 @@
 from multiprocessing import cpu_count
 
 # 根据 CPU 核心数决定 worker 数量（调试阶段建议为 1）
+# 多个 worker 需在 main.py 中开启 VECTOR_STORE_SHARED，此时可设为 cpu_count()
 workers = 1
 
 # 使用 Uvicorn 的 worker，适配 ASGI（FastAPI）应用
@@ -18,6 +19,7 @@ accesslog = './logs/gunicorn_access.log'  # 替换为实际路径
 errorlog = './logs/gunicorn_error.log'   # 替换为实际路径
 
 # 开启应用预加载，减少 worker 进程重复加载模型的开销
+# （模型在 master 中加载后由各 worker 写时复制共享；后台线程、文件句柄在 worker 中首次使用时才创建）
 preload_app = True
 
 # 允许的最大请求数量，避免内存泄漏
@@ -0,0 +1,209 @@
+"""
+离线索引调优工具：用已存储的嵌入向量（vector_store/partitions/*.vec）重放，
+对每种冷层索引配置报告 recall@k、单条查询延迟与每个向量的内存占用，据此选择 VECTOR_INDEX_TYPE。
+线上每个用户分区各自建索引、只在本分区内检索，所以这里也按分区分别建索引、测量，再汇总：
+召回率按查询数加权，延迟分位数取所有查询合并后的结果，内存按向量数加权。
+
+用法：
+    python index_tuning.py                                   # 使用全部已存储向量
+    python index_tuning.py --user user123 --k 5              # 只用某个用户的分区
+    python index_tuning.py --synthetic 20000                 # 没有数据时用随机向量试跑
+    python index_tuning.py --synthetic 200 500 5000          # 每个数字一个分区，模拟分区大小分布
+    python index_tuning.py --types IVF-SQ8 IVF-PQ --pq-m 32 64 128 --nprobe 4 8 16
+"""
+import argparse
+import glob
+import json
+import os
+import statistics
+import time
+
+import faiss
+import numpy as np
+
+from utils import percentile
+from vector_index import INDEX_TYPES, PartitionedIndex, cold_factory, configure_search
+
+DEFAULT_PARTITIONS_PATH = "./vector_store/partitions"
+
+
+def load_partitions(path, dimension, user_id=None, limit=None):
+    """
+    读取分区目录中落盘的向量（与 UserPartition.read_stored 相同的文件格式），每个分区单独返回
+    :return: [(分区名, 向量), ...]
+    """
+    if user_id is not None:
+        files = [os.path.join(path, PartitionedIndex.partition_key(user_id) + ".vec")]
+    else:
+        files = sorted(glob.glob(os.path.join(path, "*.vec")))
+    partitions = []
+    for vec_path in files:
+        if not os.path.exists(vec_path):
+            continue
+        rows = os.path.getsize(vec_path) // (dimension * 4)
+        ids_path = vec_path[:-len(".vec")] + ".ids"
+        if os.path.exists(ids_path):
+            rows = min(rows, os.path.getsize(ids_path) // 8)
+        if limit:
+            rows = min(rows, limit)
+        if rows:
+            vectors = np.fromfile(vec_path, dtype="float32", count=rows * dimension).reshape(rows, dimension)
+            partitions.append((os.path.basename(vec_path)[:-len(".vec")], vectors))
+    return partitions
+
+
+def split_partition(vectors, max_queries, k, rng):
+    """
+    从分区中留出查询向量，其余作为库，用精确检索的结果作为真值
+    :param max_queries: 每个分区最多留出的查询数，不超过分区向量数的 1/10
+    """
+    count = min(max_queries, max(1, len(vectors) // 10))
+    order = rng.permutation(len(vectors))
+    queries = np.ascontiguousarray(vectors[order[:count]])
+    base = np.ascontiguousarray(vectors[order[count:]])
+    exact = faiss.IndexFlatL2(vectors.shape[1])
+    exact.add(base)
+    _, ground_truth = exact.search(queries, min(k, len(base)))
+    return base, queries, ground_truth
+
+
+def build_configs(args):
+    """
+    展开待测配置：[(名称, 索引类型, 构建参数, 检索参数), ...]
+    """
+    configs = []
+    for index_type in args.types:
+        if index_type == "Flat":
+            configs.append(("Flat", index_type, {}, {}))
+        elif index_type == "HNSW":
+            for m in args.hnsw_m:
+                for ef in args.ef_search:
+                    configs.append((f"HNSW{m} ef={ef}", index_type, {"hnsw_m": m}, {"ef_search": ef}))
+        elif index_type == "IVF-PQ":
+            for m in args.pq_m:
+                for nprobe in args.nprobe:
+                    configs.append((f"IVF-PQ m={m} nprobe={nprobe}", index_type, {"pq_m": m}, {"nprobe": nprobe}))
+        else:
+            for nprobe in args.nprobe:
+                configs.append((f"{index_type} nprobe={nprobe}", index_type, {}, {"nprobe": nprobe}))
+    return configs
+
+
+def evaluate(index_type, build_params, search_params, base, queries, ground_truth, nlist):
+    """
+    在一个分区上构建一种配置，测量每条查询的召回率与延迟、索引大小
+    """
+    dimension = base.shape[1]
+    k = ground_truth.shape[1]
+    factory = cold_factory(index_type, dimension, len(base), nlist=nlist, **build_params)
+    start = time.perf_counter()
+    index = faiss.index_factory(dimension, factory, faiss.METRIC_L2)
+    if not index.is_trained:
+        index.train(base)
+    index.add(base)
+    build_seconds = time.perf_counter() - start
+    configure_search(index, **search_params)
+
+    latencies = []
+    found = np.zeros_like(ground_truth)
+    for i in range(len(queries)):
+        t = time.perf_counter()
+        _, ids = index.search(queries[i:i + 1], k)
+        latencies.append((time.perf_counter() - t) * 1000)
+        found[i] = ids[0]
+    recalls = [len(set(found[i]) & set(ground_truth[i])) / k for i in range(len(queries))]
+    return {
+        "factory": factory,
+        "recalls": recalls,
+        "latencies": latencies,
+        "index_bytes": len(faiss.serialize_index(index)),
+        "vectors": len(base),
+        "build_s": build_seconds,
+    }
+
+
+def aggregate(name, runs):
+    """
+    汇总一种配置在各分区上的结果
+    """
+    recalls = [r for run in runs for r in run["recalls"]]
+    latencies = [t for run in runs for t in run["latencies"]]
+    return {
+        "config": name,
+        "factory": " / ".join(sorted({run["factory"] for run in runs})),
+        "partitions": len(runs),
+        "recall_at_k": float(np.mean(recalls)),
+        "p50_ms": statistics.median(latencies),
+        "p95_ms": percentile(latencies, 95),
+        "p99_ms": percentile(latencies, 99),
+        "bytes_per_vector": sum(run["index_bytes"] for run in runs) / sum(run["vectors"] for run in runs),
+        "build_s": sum(run["build_s"] for run in runs),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="比较冷层索引配置的召回率、延迟与内存")
+    parser.add_argument("--path", default=DEFAULT_PARTITIONS_PATH, help="分区目录")
+    parser.add_argument("--dimension", type=int, default=1024)
+    parser.add_argument("--user", help="只使用该用户分区的向量")
+    parser.add_argument("--limit", type=int, help="每个分区最多使用的向量数")
+    parser.add_argument("--synthetic", nargs="+", type=int,
+                        help="不读取存储，按给出的大小各生成一个随机向量分区")
+    parser.add_argument("--min-size", type=int, default=100,
+                        help="跳过小于该大小的分区（线上这些分区只在热层精确检索，默认与 hot_threshold 相同）")
+    parser.add_argument("--queries", type=int, default=200, help="每个分区最多留出作为查询的向量数")
+    parser.add_argument("--k", type=int, default=3, help="recall@k 的 k（VectorStore.search 默认 top_k=3）")
+    parser.add_argument("--types", nargs="+", default=list(INDEX_TYPES), choices=INDEX_TYPES)
+    parser.add_argument("--nlist", type=int, default=100)
+    parser.add_argument("--nprobe", nargs="+", type=int, default=[8])
+    parser.add_argument("--pq-m", nargs="+", type=int, default=[64])
+    parser.add_argument("--hnsw-m", nargs="+", type=int, default=[32])
+    parser.add_argument("--ef-search", nargs="+", type=int, default=[64])
+    parser.add_argument("--json", action="store_true", help="以 JSON 输出结果")
+    args = parser.parse_args()
+
+    if args.synthetic:
+        rng = np.random.RandomState(0)
+        partitions = [(f"synthetic{i}", rng.rand(size, args.dimension).astype("float32"))
+                      for i, size in enumerate(args.synthetic)]
+    else:
+        partitions = load_partitions(args.path, args.dimension, args.user, args.limit)
+    min_size = max(args.min_size, args.k + 1)
+    skipped = [name for name, vectors in partitions if len(vectors) < min_size]
+    partitions = [(name, vectors) for name, vectors in partitions if len(vectors) >= min_size]
+    if not partitions:
+        parser.error(f"没有不少于 {min_size} 个向量的分区（可用 --min-size 调整，或用 --synthetic 试跑）")
+
+    rng = np.random.RandomState(42)
+    splits = [split_partition(vectors, args.queries, args.k, rng) for _, vectors in partitions]
+
+    results = []
+    for name, index_type, build_params, search_params in build_configs(args):
+        try:
+            runs = [evaluate(index_type, build_params, search_params, base, queries, ground_truth, args.nlist)
+                    for base, queries, ground_truth in splits]
+            results.append(aggregate(name, runs))
+        except Exception as e:
+            results.append({"config": name, "error": str(e)})
+
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+        return
+    sizes = sorted(len(vectors) for _, vectors in partitions)
+    print(f"partitions={len(partitions)} (skipped {len(skipped)} smaller than {min_size}) "
+          f"size min/median/max={sizes[0]}/{int(statistics.median(sizes))}/{sizes[-1]} "
+          f"queries={sum(len(queries) for _, queries, _ in splits)} dimension={args.dimension} k={args.k}")
+    columns = [("config", "{}"), ("factory", "{}"), ("recall_at_k", "{:.3f}"), ("p50_ms", "{:.3f}"),
+               ("p95_ms", "{:.3f}"), ("p99_ms", "{:.3f}"), ("bytes_per_vector", "{:.0f}"), ("build_s", "{:.2f}")]
+    rows = [[name for name, _ in columns]]
+    rows += [[fmt.format(r[name]) for name, fmt in columns] for r in results if "error" not in r]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    for row in rows:
+        print("  ".join(cell.ljust(width) for cell, width in zip(row, widths)))
+    for r in results:
+        if "error" in r:
+            print(f"{r['config']}: error: {r['error']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+"""
+并发压测：以目标 RPS（开环，按计划时间发送，不因服务变慢而降低发送速率）
+向 /v1/chat/completions 重放 JSONL 格式的请求，报告延迟分位数、吞吐、缓存命中率与错误率。
+缓存结果取自响应头 X-Cache（hit / coalesced / semantic / miss）。
+
+配合 fake_ollama.py 使用可排除真实模型的影响：
+    python fake_ollama.py --latency-ms 200 --tokens-per-s 50 &
+    uvicorn main:app --port 11405 &
+    python load_test.py --rps 20 --duration 30
+    python load_test.py --payloads payloads.jsonl --rps 50 --requests 2000 --stream --json
+
+payloads.jsonl 每行一个请求：完整的请求体（含 messages），或只含 content / prompt 字段的文本；
+未提供时按 --unique 生成若干条不同的问题循环发送（重复的问题用于观察缓存命中）。
+"""
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import time
+from collections import Counter
+
+import aiohttp
+
+from utils import percentile
+
+DEFAULT_URL = "http://127.0.0.1:11405/v1/chat/completions"
+DEFAULT_MODEL = "qwen2.5-3bnsfw"
+SAMPLE_PROMPTS = [
+    "我是谁？",
+    "今天天气怎么样？",
+    "帮我总结一下我们之前聊过的内容。",
+    "我家有几口人？",
+    "推荐一本适合周末读的书。",
+]
+
+
+def make_payload(entry, args):
+    """
+    把一行 JSON 补全为 ChatRequest 请求体
+    """
+    if isinstance(entry, str):
+        entry = {"content": entry}
+    if "messages" in entry:
+        payload = dict(entry)
+    else:
+        text = next((entry[key] for key in ("content", "prompt", "body", "title") if entry.get(key)), None)
+        if text is None:
+            raise ValueError(f"无法从该行构造请求: {entry}")
+        payload = {"messages": [{"role": "user", "content": text}]}
+    payload.setdefault("model", args.model)
+    payload.setdefault("max_tokens", args.max_tokens)
+    payload.setdefault("temperature", 0.7)
+    payload["stream"] = args.stream if args.stream else payload.get("stream", False)
+    return payload
+
+
+def load_payloads(args):
+    if args.payloads:
+        with open(args.payloads, "r", encoding="utf-8") as f:
+            return [make_payload(json.loads(line), args) for line in f if line.strip()]
+    return [make_payload(f"{SAMPLE_PROMPTS[i % len(SAMPLE_PROMPTS)]}（{i}）", args) for i in range(args.unique)]
+
+
+async def send_one(session, url, payload, scheduled, timeout):
+    """
+    发送一个请求，延迟从计划发送时间算起（包含客户端排队，避免协同遗漏）
+    """
+    result = {"cache": None, "error": None, "ttft": None}
+    sent = time.perf_counter()
+    result["lag"] = sent - scheduled
+    try:
+        async with session.post(url, json=payload, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+            result["status"] = response.status
+            result["cache"] = response.headers.get("X-Cache")
+            if payload.get("stream"):
+                async for raw_line in response.content:
+                    if result["ttft"] is None and raw_line.startswith(b"data:"):
+                        result["ttft"] = time.perf_counter() - scheduled
+            else:
+                await response.read()
+            if response.status >= 400:
+                result["error"] = f"HTTP {response.status}"
+    except asyncio.TimeoutError:
+        result["status"] = None
+        result["error"] = "timeout"
+    except aiohttp.ClientError as e:
+        result["status"] = None
+        result["error"] = type(e).__name__
+    result["latency"] = time.perf_counter() - scheduled
+    return result
+
+
+async def run(args, payloads):
+    total = args.requests or int(args.rps * args.duration)
+    rng = random.Random(args.seed)
+    connector = aiohttp.TCPConnector(limit=args.max_in_flight)
+    semaphore = asyncio.Semaphore(args.max_in_flight)
+    results = []
+
+    async with aiohttp.ClientSession(connector=connector) as session:
+        async def worker(i, scheduled):
+            async with semaphore:
+                payload = payloads[i % len(payloads)] if not args.shuffle else rng.choice(payloads)
+                results.append(await send_one(session, args.url, payload, scheduled, args.timeout))
+
+        tasks = []
+        start = time.perf_counter()
+        next_time = start
+        for i in range(total):
+            delay = next_time - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.ensure_future(worker(i, next_time)))
+            # 泊松到达（指数间隔）或固定间隔
+            next_time += rng.expovariate(args.rps) if args.poisson else 1 / args.rps
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+    return results, elapsed
+
+
+def summarize(results, elapsed, args):
+    latencies = [r["latency"] * 1000 for r in results]
+    ok = [r for r in results if not r["error"]]
+    caches = Counter(r["cache"] or "unknown" for r in ok)
+    cached = sum(count for status, count in caches.items() if status in ("hit", "coalesced", "semantic"))
+    errors = Counter(r["error"] for r in results if r["error"])
+    summary = {
+        "requests": len(results),
+        "target_rps": args.rps,
+        "duration_s": elapsed,
+        "throughput_rps": len(ok) / elapsed if elapsed > 0 else 0.0,
+        "p50_ms": statistics.median(latencies) if latencies else None,
+        "p95_ms": percentile(latencies, 95) if latencies else None,
+        "p99_ms": percentile(latencies, 99) if latencies else None,
+        "max_ms": max(latencies) if latencies else None,
+        "cache_hit_rate": cached / len(ok) if ok else 0.0,
+        "cache": dict(caches),
+        "error_rate": (len(results) - len(ok)) / len(results) if results else 0.0,
+        "errors": dict(errors),
+        # 计划发送时间与实际发送时间的最大差：明显大于 0 说明受 --max-in-flight 限制，客户端已成为瓶颈
+        "max_send_lag_ms": max(r["lag"] for r in results) * 1000 if results else None,
+    }
+    ttfts = [r["ttft"] * 1000 for r in results if r["ttft"] is not None]
+    if ttfts:
+        summary["ttft_p50_ms"] = statistics.median(ttfts)
+        summary["ttft_p95_ms"] = percentile(ttfts, 95)
+        summary["ttft_p99_ms"] = percentile(ttfts, 99)
+    # 按缓存结果拆分延迟，命中与未命中的差距即缓存节省的时间
+    by_cache = {}
+    for status in caches:
+        values = [r["latency"] * 1000 for r in ok if (r["cache"] or "unknown") == status]
+        by_cache[status] = {"p50_ms": statistics.median(values), "p95_ms": percentile(values, 95)}
+    summary["latency_by_cache"] = by_cache
+    return summary
+
+
+def print_summary(summary):
+    print(f"requests={summary['requests']} target_rps={summary['target_rps']} "
+          f"duration={summary['duration_s']:.1f}s throughput={summary['throughput_rps']:.1f} req/s")
+    if summary["p50_ms"] is not None:
+        print(f"latency  p50={summary['p50_ms']:.1f}ms p95={summary['p95_ms']:.1f}ms "
+              f"p99={summary['p99_ms']:.1f}ms max={summary['max_ms']:.1f}ms")
+    if "ttft_p50_ms" in summary:
+        print(f"ttft     p50={summary['ttft_p50_ms']:.1f}ms p95={summary['ttft_p95_ms']:.1f}ms "
+              f"p99={summary['ttft_p99_ms']:.1f}ms")
+    print(f"cache hit rate={summary['cache_hit_rate']:.1%} {summary['cache']}")
+    for status, values in sorted(summary["latency_by_cache"].items()):
+        print(f"  {status:<10} p50={values['p50_ms']:.1f}ms p95={values['p95_ms']:.1f}ms")
+    print(f"error rate={summary['error_rate']:.1%} {summary['errors']}")
+    print(f"max send lag={summary['max_send_lag_ms']:.1f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="以目标 RPS 压测 /v1/chat/completions")
+    parser.add_argument("--url", default=DEFAULT_URL)
+    parser.add_argument("--payloads", help="JSONL 请求文件")
+    parser.add_argument("--unique", type=int, default=20, help="未提供 --payloads 时生成的不同问题数")
+    parser.add_argument("--rps", type=float, default=10, help="目标每秒请求数")
+    parser.add_argument("--duration", type=float, default=30, help="压测时长（秒）")
+    parser.add_argument("--requests", type=int, help="请求总数（优先于 --duration）")
+    parser.add_argument("--max-in-flight", type=int, default=256, help="客户端同时在途的最大请求数")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--stream", action="store_true", help="以 stream=true 发送，并统计首 token 时间")
+    parser.add_argument("--poisson", action="store_true", help="泊松到达（默认固定间隔）")
+    parser.add_argument("--shuffle", action="store_true", help="随机选取请求（默认按顺序循环）")
+    parser.add_argument("--model", default=DEFAULT_MODEL)
+    parser.add_argument("--max-tokens", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="以 JSON 输出结果")
+    args = parser.parse_args()
+    if args.rps <= 0:
+        parser.error("--rps 必须大于 0")
+
+    payloads = load_payloads(args)
+    if not payloads:
+        parser.error("没有可发送的请求")
+    results, elapsed = asyncio.run(run(args, payloads))
+    summary = summarize(results, elapsed, args)
+    if args.json:
+        print(json.dumps(summary, ensure_ascii=False, indent=2))
+    else:
+        print_summary(summary)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,200 @@
+import atexit
+import copy
+import hashlib
+import json
 import logging
-from logging.handlers import RotatingFileHandler
-import time
+import os
+import queue
+import random
+import sys
+import threading
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
-# 创建日志记录器
-logger = logging.getLogger('chat_api')
-logger.setLevel(logging.INFO)
+# 日志文件与轮转设置
+LOG_FILE = 'logs/chat_api.log'
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+# True 时每行一个 JSON 对象（analyze_logs.py 两种格式都能解析）
+LOG_JSON = True
+# 日志队列上限：后台线程写不过来时丢弃新日志（计入 dropped），而不是阻塞请求
+LOG_QUEUE_SIZE = 10000
+# 单条日志消息的最大长度，preview() 截断单个载荷的默认长度
+LOG_MAX_MESSAGE_CHARS = 2000
+LOG_MAX_FIELD_CHARS = 200
+# 按类别采样：payload（请求/回复全文）、embedding（每条嵌入文本）、retrieval（检索结果），未列出的类别全部记录
+LOG_SAMPLE_RATES = {"payload": 0.1, "embedding": 0.01, "retrieval": 0.1}
+# 同时输出到控制台的最低级别
+LOG_CONSOLE_LEVEL = logging.WARNING
+
+
+def preview(value, limit: int = LOG_MAX_FIELD_CHARS) -> str:
+    """
+    截断过长的载荷，并附上原文长度和摘要（便于比对同一内容而不必记录全文）
+    """
+    text = value if isinstance(value, str) else str(value)
+    if len(text) <= limit:
+        return text
+    digest = hashlib.blake2b(text.encode("utf-8", "replace"), digest_size=6).hexdigest()
+    return f"{text[:limit]}…(+{len(text) - limit} chars, blake2b={digest})"
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    每条日志输出为一行 JSON：ts、level、logger、msg，以及通过 extra 传入的 category 和 fields
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).strftime("%Y-%m-%dT%H:%M:%S.") + f"{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "pid": record.process,
+            "msg": record.getMessage(),
+        }
+        category = getattr(record, "category", None)
+        if category:
+            entry["category"] = category
+        fields = getattr(record, "fields", None)
+        if fields:
+            entry.update(fields)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+# 只用于格式化异常堆栈
+_exc_formatter = logging.Formatter()
+
+
+class AsyncLogHandler(QueueHandler):
+    """
+    把日志放入有界队列，由后台线程（QueueListener）写文件，请求线程与事件循环不做磁盘 I/O。
+    队列满时丢弃并计数；fork 之后（gunicorn preload_app=True）在子进程中首次写日志时重建队列和后台线程。
+    """
+
+    def __init__(self, handlers, maxsize: int = LOG_QUEUE_SIZE, max_message_chars: int = LOG_MAX_MESSAGE_CHARS):
+        super().__init__(queue.Queue(maxsize))
+        self.target_handlers = handlers
+        self.maxsize = maxsize
+        self.max_message_chars = max_message_chars
+        self.listener = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+        self.dropped = 0
+
+    def _ensure_listener(self):
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            # 父进程的队列与后台线程不属于本进程，全部重建
+            self.queue = queue.Queue(self.maxsize)
+            self.listener = QueueListener(self.queue, *self.target_handlers, respect_handler_level=True)
+            self.listener.start()
+            self._pid = os.getpid()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # 在调用线程中合并参数并截断，队列中只保存有界的字符串。
+        # 不用 QueueHandler.prepare：它把异常堆栈并入 msg 后再被截断；这里堆栈单独放在 exc_text（不截断），
+        # JsonFormatter 输出为 exc 字段，文本格式化器照常附在消息之后
+        exc_text = record.exc_text
+        if record.exc_info and not exc_text:
+            exc_text = _exc_formatter.formatException(record.exc_info)
+        message = record.getMessage()
+        if len(message) > self.max_message_chars:
+            message = preview(message, self.max_message_chars)
+        record = copy.copy(record)
+        record.message = message
+        record.msg = message
+        record.args = None
+        record.exc_info = None
+        record.exc_text = exc_text
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def emit(self, record: logging.LogRecord):
+        self._ensure_listener()
+        super().emit(record)
 
-# 创建一个按大小轮转的文件处理器
-file_handler = RotatingFileHandler('logs/chat_api.log', maxBytes=10*1024*1024, backupCount=5)
-file_handler.setLevel(logging.INFO)
+    def stop(self):
+        """
+        写完队列中剩余的日志并停止后台线程
+        """
+        if self.listener is not None and self._pid == os.getpid():
+            self.listener.stop()
+            self.listener = None
+            self._pid = None
 
-# 创建格式化器
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-file_handler.setFormatter(formatter)
 
-# 将处理器添加到记录器
-logger.addHandler(file_handler)
+# 各类别记录与采样丢弃的条数
+_sample_kept = {}
+_sample_dropped = {}
 
+
+def sample(category: str) -> bool:
+    """
+    按 LOG_SAMPLE_RATES 决定该类别的这条日志是否记录；在拼接载荷之前调用，未采中的日志没有任何格式化开销
+    """
+    rate = LOG_SAMPLE_RATES.get(category, 1.0)
+    keep = rate >= 1.0 or random.random() < rate
+    counters = _sample_kept if keep else _sample_dropped
+    counters[category] = counters.get(category, 0) + 1
+    return keep
+
+
+def _build_handler() -> AsyncLogHandler:
+    # 创建一个按大小轮转的文件处理器（首次写入时才打开文件，fork 出的进程各自打开）
+    os.makedirs(os.path.dirname(LOG_FILE) or ".", exist_ok=True)
+    file_handler = RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT,
+                                       encoding='utf-8', delay=True)
+    file_handler.setLevel(logging.INFO)
+    # 创建格式化器
+    if LOG_JSON:
+        file_handler.setFormatter(JsonFormatter())
+    else:
+        file_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    console_handler = logging.StreamHandler(sys.stderr)
+    console_handler.setLevel(LOG_CONSOLE_LEVEL)
+    console_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    return AsyncLogHandler([file_handler, console_handler])
+
+
+async_handler = _build_handler()
+
+
+def get_logger(name: str) -> logging.Logger:
+    """
+    返回经由异步队列写日志的记录器（各模块共用同一个队列和后台写线程）
+    """
+    named_logger = logging.getLogger(name)
+    if async_handler not in named_logger.handlers:
+        named_logger.addHandler(async_handler)
+        named_logger.setLevel(logging.INFO)
+        named_logger.propagate = False
+    return named_logger
+
+
+def logging_stats() -> dict:
+    return {
+        "queued": async_handler.queue.qsize(),
+        "dropped": async_handler.dropped,
+        "kept": dict(_sample_kept),
+        "sampled_out": dict(_sample_dropped),
+    }
+
+
+def shutdown_logging():
+    async_handler.stop()
+
+
+atexit.register(shutdown_logging)
+
+# 创建日志记录器
+logger = get_logger('chat_api')
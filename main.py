@@ -1,15 +1,24 @@
-from fastapi import FastAPI, Depends, HTTPException
-from sqlalchemy.orm import Session
+from fastapi import FastAPI, HTTPException, Response
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
-from typing import List
+from typing import List, AsyncIterator, Dict, Optional
+import csv
+import io
 import json
-import redis
+import time
+import uuid
 import asyncio
 import hashlib
-from logger import logger  # 日志模块
-from database import get_db, add_chat_history
+from logger import logger, logging_stats, preview, sample, shutdown_logging  # 日志模块
+from database import SessionLocal, chat_history_writer, check_connection, engine, get_chat_history_page
+from cache import ResponseCache
 from memory_manager import memory_manager
-from ollama_client import call_ollama  # 改为异步函数
+from ollama_client import OllamaStreamError, call_ollama, stream_ollama, ollama_client  # 改为异步函数
+from singleflight import SingleFlight
+from semantic_cache import SemanticCache
+from executors import executors, AsyncVectorStore
+from context_builder import ContextBuilder, make_token_counter
+from metrics import CONTENT_TYPE, ERRORS, REQUEST_SECONDS, REQUESTS, STAGE_SECONDS, metrics, stage_timer
 from vector_store import VectorStore  # 引入 VectorStore 类
 
 # 应用实例
@@ -19,17 +28,116 @@ app = FastAPI()
 REDIS_HOST = "localhost"
 REDIS_PORT = 6379
 REDIS_DB = 0
-
-try:
-    redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, decode_responses=True)
-    redis_client.ping()  # 测试连接
-    logger.info("Connected to Redis successfully.")
-except redis.ConnectionError as e:
-    logger.error(f"Failed to connect to Redis: {e}")
-    redis_client = None  # 防止服务崩溃
+REDIS_MAX_CONNECTIONS = 32
+# 进程内 L1 缓存（Redis 不可用时仍可命中）
+L1_CACHE_SIZE = 1024
+L1_CACHE_TTL = 300
+# 是否借助 Redis 锁 + pub/sub 在多个 gunicorn worker 之间合并相同请求
+SINGLE_FLIGHT_ACROSS_WORKERS = True
+
+# 语义缓存：用户输入与已回答问题的余弦相似度达到阈值时直接复用回答（以少量精确性换取更少的 LLM 调用）
+SEMANTIC_CACHE_ENABLED = False
+SEMANTIC_CACHE_THRESHOLD = 0.95
+SEMANTIC_CACHE_TTL = 3600
+SEMANTIC_CACHE_MAX_ENTRIES = 10000
+
+# 上下文组装：token 预算、最近保留的轮数、语义检索的更早轮数
+CONTEXT_TOKEN_BUDGET = 2048
+CONTEXT_RECENT_TURNS = 6
+CONTEXT_RETRIEVE_K = 4
+# 用于计算 token 数的分词器路径（None 表示按字符估算）
+CONTEXT_TOKENIZER_PATH = None
+
+# 多 worker 共享向量存储：各 worker 共用 ./vector_store 目录（写入由文件锁协调，冷层索引内存映射），
+# 开启后可在 gunicorn_conf.py 中把 workers 调大（配合 preload_app = True 只加载一份模型）
+VECTOR_STORE_SHARED = False
+
+# 向量索引冷层类型：Flat / IVFFlat / IVF-SQ8 / IVF-PQ / HNSW（用 index_tuning.py 按召回率与内存选择）
+VECTOR_INDEX_TYPE = "IVFFlat"
+# IVF-PQ 每个向量占用的字节数（需整除向量维度 1024）
+VECTOR_INDEX_PQ_M = 64
+
+# 嵌入后端：torch（sentence-transformers）或 onnx（int8 量化，需先导出，见 bench_embedding.py）
+EMBEDDING_BACKEND = "torch"
+# 是否在导入时（gunicorn master 中）加载模型：多 worker + preload_app 时设为 True 可共享模型内存；
+# False 时在 worker 启动后于后台加载并预热，期间 /health 正常响应、/ready 返回 503
+EMBEDDING_PRELOAD = False
+
+# 请求未携带 user 字段时使用的用户 ID（应从认证系统动态获取真实用户 ID）
+DEFAULT_USER_ID = "user123"
+
+# 批量接口：单次最多的对话条数、同时生成的条数，以及攒够多少条用户消息后一次计算嵌入并写入 FAISS
+BATCH_MAX_ITEMS = 1000
+BATCH_CONCURRENCY = 8
+BATCH_INDEX_SIZE = 64
+
+# 聊天记录查询：每页最多的行数，以及导出时每次从数据库读取的行数（内存占用只与它有关）
+HISTORY_PAGE_MAX = 500
+HISTORY_EXPORT_CHUNK = 1000
+HISTORY_EXPORT_COLUMNS = ("id", "user_id", "message", "response", "timestamp")
+
+# 兜底/错误提示不写入任何缓存
+UNCACHEABLE_RESPONSES = {
+    "抱歉，Ollama API 请求超时，请稍后再试。",
+    "抱歉，我暂时无法回答您的问题。",
+    "抱歉，我暂时无法处理您的请求。",
+    "抱歉，输入参数格式有误，请检查后重试。",
+    "请求参数格式错误。",
+}
+
+# 两级响应缓存（L1 进程内 + asyncio Redis），连接在 startup 钩子中建立
+response_cache = ResponseCache(
+    host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, max_connections=REDIS_MAX_CONNECTIONS,
+    l1_size=L1_CACHE_SIZE, l1_ttl=L1_CACHE_TTL
+)
+
+# 相同缓存键的并发请求只生成一次（跨 worker 所需的 Redis 客户端在 startup 钩子中设置）
+single_flight = SingleFlight()
 
 # 实例化 VectorStore
-vector_store = VectorStore(dimension=1024, save_path="./vector_store")  # 保存路径指定
+vector_store = VectorStore(
+    dimension=1024, save_path="./vector_store", shared=VECTOR_STORE_SHARED,
+    embedding_backend=EMBEDDING_BACKEND, preload_model=EMBEDDING_PRELOAD,
+    index_type=VECTOR_INDEX_TYPE, pq_m=VECTOR_INDEX_PQ_M
+)  # 保存路径指定
+# 异步包装：嵌入、FAISS 与磁盘 I/O 在执行器线程池中运行，不阻塞事件循环
+async_vector_store = AsyncVectorStore(vector_store, executors)
+
+# 在 token 预算内组合最近轮次与语义检索结果
+context_builder = ContextBuilder(
+    vector_store, max_tokens=CONTEXT_TOKEN_BUDGET, recent_turns=CONTEXT_RECENT_TURNS,
+    retrieve_k=CONTEXT_RETRIEVE_K, token_counter=make_token_counter(CONTEXT_TOKENIZER_PATH)
+)
+
+semantic_cache = None
+if SEMANTIC_CACHE_ENABLED:
+    semantic_cache = SemanticCache(
+        vector_store.get_embedding, vector_store.dimension, threshold=SEMANTIC_CACHE_THRESHOLD,
+        ttl=SEMANTIC_CACHE_TTL, max_entries=SEMANTIC_CACHE_MAX_ENTRIES
+    )
+
+# /metrics 在抓取时读取各组件的 stats()，counters 中列出的是累计值
+metrics.register_stats("llmb_embedding", vector_store.embedding_stats, "Embedding batcher, backend and cache",
+                       counters=("total_batches", "total_items", "cache_l1_hits", "cache_l2_hits", "cache_misses",
+                                 "cache_l1_evictions", "cache_l2_evictions"))
+metrics.register_stats("llmb_index", vector_store.index_stats, "Partitioned vector index", counters=("rebuilds", "reloads"))
+metrics.register_stats("llmb_ollama", ollama_client.stats, "Ollama client",
+                       counters=("completed", "requests", "hedges", "hedge_wins", "retries"))
+metrics.register_stats("llmb_response_cache", response_cache.stats, "Response cache",
+                       counters=("l1_hits", "l2_hits", "misses", "errors"))
+metrics.register_stats("llmb_single_flight", single_flight.stats, "Request coalescing",
+                       counters=("leaders", "local_followers", "remote_followers", "fallbacks"))
+metrics.register_stats("llmb_executors", executors.stats, "Executors",
+                       counters=("background_completed", "background_failed"))
+metrics.register_stats("llmb_logging", logging_stats, "Async logging queue",
+                       counters=("dropped", "kept", "sampled_out"))
+metrics.register_stats("llmb_chat_history_writer", chat_history_writer.stats, "Chat history writer",
+                       counters=("written", "batches", "failed"))
+metrics.register_stats("llmb_memory", memory_manager.stats, "Per-user memory store",
+                       counters=("added", "queries", "evictions", "expirations"))
+if semantic_cache is not None:
+    metrics.register_stats("llmb_semantic_cache", semantic_cache.stats, "Semantic cache",
+                           counters=("lookups", "hits", "evictions", "expirations"))
 
 # 定义请求和响应模型
 class Message(BaseModel):
@@ -42,6 +150,7 @@ class ChatRequest(BaseModel):
     max_tokens: int  # 最大生成的 token 数
     temperature: float  # 温度值，控制生成的随机性
     stream: bool  # 是否开启流式传输
+    user: Optional[str] = None  # 用户 ID（OpenAI 兼容字段），未提供时使用 DEFAULT_USER_ID
 
 class ChatMessage(BaseModel):
     role: str  # 消息角色
@@ -53,6 +162,21 @@ class ChatResponseChoice(BaseModel):
 class ChatResponse(BaseModel):
     choices: List[ChatResponseChoice]  # AI 回复的列表（通常为 1 条）
 
+class BatchChatItem(BaseModel):
+    id: Optional[str] = None  # 调用方自定义的条目 ID，原样返回
+    user: Optional[str] = None  # 用户 ID，未提供时使用 DEFAULT_USER_ID
+    messages: List[Message]  # 消息历史记录
+    model: Optional[str] = None  # 以下字段未提供时使用批次的设置
+    max_tokens: Optional[int] = None
+    temperature: Optional[float] = None
+
+class BatchChatRequest(BaseModel):
+    model: str  # 模型名称
+    items: List[BatchChatItem]  # 各条对话
+    max_tokens: int = 100  # 最大生成的 token 数
+    temperature: float = 0.7  # 温度值，控制生成的随机性
+    concurrency: Optional[int] = None  # 同时生成的条数，不超过 BATCH_CONCURRENCY
+
 # 辅助函数
 async def generate_response(messages: List[dict], model: str, max_tokens: int = 100, temperature: float = 0.7) -> str:
     """
@@ -66,14 +190,19 @@ async def generate_response(messages: List[dict], model: str, max_tokens: int =
             raise ValueError("`messages` 参数格式无效，必须为包含 `role` 和 `content` 键的字典列表。")
 
         # 调用外部 Ollama API
-        logger.info(f"调用 Ollama 模型 '{model}'，上下文: {messages[:5]}")  # 仅打印前5条消息以避免日志过长
-        response_text = await call_ollama(messages, model, temperature)
+        if sample("payload"):
+            logger.info(f"调用 Ollama 模型 '{model}'，上下文: {preview(messages[-5:])}", extra={"category": "payload"})
+        with stage_timer("ollama"):
+            response_text = await call_ollama(messages, model, temperature)
+        if response_text in UNCACHEABLE_RESPONSES:
+            ERRORS.inc(stage="ollama")
 
         # 校验返回值是否符合预期
         if not isinstance(response_text, str):
             raise ValueError(f"Ollama API 返回值无效，期望是字符串，但得到：{type(response_text)}")
 
-        logger.info(f"Ollama 模型回复: {response_text}")
+        if sample("payload"):
+            logger.info(f"Ollama 模型回复: {preview(response_text)}", extra={"category": "payload"})
         return response_text
 
     except ValueError as ve:
@@ -81,37 +210,67 @@ async def generate_response(messages: List[dict], model: str, max_tokens: int =
         return "抱歉，输入参数格式有误，请检查后重试。"
 
     except Exception as e:
-        logger.exception(f"调用 Ollama 模型时发生错误: {e}. Messages: {messages}, Model: {model}")
+        logger.exception(f"调用 Ollama 模型时发生错误: {e}. Messages: {preview(messages)}, Model: {model}")
+        ERRORS.inc(stage="ollama")
         return "抱歉，我暂时无法处理您的请求。"
 
-def get_cached_response(redis_client, cache_key: str) -> str:
+async def generate_response_stream(messages: List[dict], model: str, max_tokens: int = 100,
+                                   temperature: float = 0.7) -> AsyncIterator[str]:
+    """
+    以流式方式调用 Ollama 模型，逐段产出回复内容
+    """
+    if not isinstance(messages, list) or any(
+        not isinstance(m, dict) or "role" not in m or "content" not in m for m in messages
+    ):
+        logger.error("参数校验错误: `messages` 参数格式无效")
+        yield "抱歉，输入参数格式有误，请检查后重试。"
+        return
+
+    if sample("payload"):
+        logger.info(f"流式调用 Ollama 模型 '{model}'，上下文: {preview(messages[-5:])}", extra={"category": "payload"})
+    async for content in stream_ollama(messages, model, temperature):
+        yield content
+
+def sse_chunk(completion_id: str, created: int, model: str, delta: dict, finish_reason=None) -> str:
+    """
+    构造 OpenAI chat.completion.chunk 格式的 SSE 数据行
+    """
+    chunk = {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": created,
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+    return f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+
+async def get_cached_response(cache_key: str) -> str:
     """
-    从 Redis 获取缓存
+    从两级缓存（L1 + Redis）获取缓存
     """
     try:
-        if redis_client:
-            cached_response = redis_client.get(cache_key)
-            if cached_response:
-                logger.info(f"Cache hit for key: {cache_key}")
-                return cached_response
-        else:
-            logger.warning("Redis client not initialized")
+        with stage_timer("cache_get"):
+            cached_response = await response_cache.get(cache_key)
+        if cached_response:
+            logger.info(f"Cache hit for key: {cache_key}")
+            return cached_response
     except Exception as e:
-        logger.error(f"Redis error while fetching cache: {e}")
+        logger.error(f"Cache error while fetching response: {e}")
     return None
 
-def cache_response(redis_client, cache_key: str, response_text: str, ttl: int = 3600):
+async def cache_response(cache_key: str, response_text: str, ttl: int = 3600):
     """
-    保存响应到 Redis
+    保存响应到两级缓存（L1 + Redis）
     """
     try:
-        if redis_client and response_text not in ["抱歉，Ollama API 请求超时，请稍后再试。"]:
-            redis_client.setex(cache_key, ttl, response_text)
+        if response_text not in UNCACHEABLE_RESPONSES:
+            with stage_timer("cache_set"):
+                await response_cache.set(cache_key, response_text, ttl)
             logger.info(f"Response cached successfully for key: {cache_key}")
         else:
             logger.warning(f"Invalid response not cached for key: {cache_key}")
     except Exception as e:
-        logger.error(f"Redis error while caching response: {e}")
+        logger.error(f"Cache error while caching response: {e}")
 
 def add_to_vector_store(user_id: str, role: str, content: str):
     """
@@ -123,6 +282,197 @@ def add_to_vector_store(user_id: str, role: str, content: str):
     except Exception as e:
         logger.error(f"Failed to add message to VectorStore: {e}")
 
+async def persist_exchange(user_id: str, user_input: str, response_text: str, cache_key: str,
+                     model: str, pending_index: list = None):
+    """
+    将一轮对话写入 VectorStore、SQLite，并缓存回复
+    :param pending_index: 批量接口传入的待索引列表，用户消息加入其中由调用方攒批写入 FAISS，而不是逐条后台索引
+    """
+    # 保存到 VectorStore（更新对话历史）：先同步追加记录，保证下一轮请求能看到本轮对话
+    try:
+        user_message_id = await async_vector_store.append_message(user_id, role="user", content=user_input)
+        await async_vector_store.append_message(user_id, role="assistant", content=response_text)
+        logger.info(f"Updated conversation history in VectorStore for user {user_id}.")
+        # 嵌入计算与 FAISS 写入放到后台，不阻塞响应
+        if pending_index is None:
+            executors.spawn(index_in_background(user_id, user_message_id, user_input))
+        else:
+            pending_index.append((user_id, user_message_id, user_input))
+    except Exception as e:
+        logger.error(f"Failed to update conversation history: {e}")
+
+    # 存储聊天历史到数据库（写后批量持久化，这里只入队）
+    try:
+        await chat_history_writer.enqueue(user_id=user_id, message=user_input, response=response_text)
+        logger.info("Chat history queued for saving")
+    except Exception as e:
+        logger.error(f"Failed to save chat history: {e}")
+
+    # 缓存生成的响应
+    await cache_response(cache_key, response_text)
+    if semantic_cache is not None and response_text not in UNCACHEABLE_RESPONSES:
+        executors.spawn(store_semantic_cache(user_id, model, user_input, response_text))
+
+async def index_in_background(user_id: str, message_id: int, content: str):
+    """
+    后台任务：为用户消息计算嵌入并写入索引
+    """
+    try:
+        await async_vector_store.index_message(user_id, message_id, "user", content)
+    except Exception as e:
+        logger.error(f"Failed to index message {message_id} for user {user_id}: {e}")
+
+async def index_batch_in_background(entries: List[tuple]):
+    """
+    后台任务：一次批量计算多条用户消息的嵌入并写入索引
+    """
+    try:
+        await async_vector_store.index_messages(entries)
+    except Exception as e:
+        logger.error(f"Failed to index {len(entries)} batched messages: {e}")
+
+async def store_semantic_cache(user_id: str, model: str, user_input: str, response_text: str):
+    """
+    后台任务：写入语义缓存
+    """
+    try:
+        await executors.run_embedding(semantic_cache.store, semantic_namespace(user_id, model), user_input,
+                                      response_text)
+    except Exception as e:
+        logger.error(f"Semantic cache error while storing response: {e}")
+
+def semantic_namespace(user_id: str, model: str) -> str:
+    """
+    语义缓存按 用户 + 模型 隔离，避免把某个用户的回答返回给其他用户
+    """
+    return f"{user_id}:{model}"
+
+async def get_semantic_cached_response(user_id: str, model: str, user_input: str) -> str:
+    """
+    从语义缓存查找相近问题的回答（嵌入计算在执行器线程池中进行）
+    """
+    if semantic_cache is None:
+        return None
+    try:
+        with stage_timer("semantic_cache"):
+            return await executors.run_embedding(semantic_cache.lookup, semantic_namespace(user_id, model), user_input)
+    except Exception as e:
+        logger.error(f"Semantic cache error while fetching response: {e}")
+        return None
+
+async def find_cached_response(cache_key: str, user_id: str, model: str, user_input: str,
+                               prefetched: Dict[str, str] = None):
+    """
+    依次查两级缓存、正在生成的相同请求与语义缓存，返回 (回复, 缓存结果)；未命中时回复为 None、结果为 "miss"
+    :param prefetched: 批量预取的缓存结果，提供时不再单独查询两级缓存
+    """
+    # 检查缓存是否命中
+    if prefetched is not None:
+        cached_response = prefetched.get(cache_key)
+    else:
+        cached_response = await get_cached_response(cache_key)
+    cache_status = "hit" if cached_response else "miss"
+
+    # 相同请求正在生成中：等待其结果，视同缓存命中
+    in_flight = single_flight.inflight(cache_key) if not cached_response else None
+    if in_flight is not None:
+        try:
+            cached_response = await single_flight.wait(in_flight)
+            cache_status = "coalesced" if cached_response else "miss"
+        except Exception as e:
+            logger.warning(f"Coalesced request failed for key {cache_key}, generating again: {e}")
+
+    # 精确缓存未命中时查语义缓存
+    if not cached_response:
+        cached_response = await get_semantic_cached_response(user_id, model, user_input)
+        if cached_response:
+            cache_status = "semantic"
+    return cached_response, cache_status
+
+def make_cache_key(user_id: str, user_input: str) -> str:
+    """
+    缓存键 = 对话滚动摘要 + 当前输入：开销只与当前输入大小有关，重启后保持稳定
+    """
+    conversation_digest = vector_store.conversation_digest(user_id)
+    return f"chat:{user_id}:{hashlib.md5(f'{conversation_digest}:{user_input}'.encode()).hexdigest()}"
+
+async def stream_chat_completion(chat_request: ChatRequest, user_id: str, user_input: str,
+                                 full_messages: List[dict], cache_key: str,
+                                 cached_response: str = None, cache_status: str = "miss") -> AsyncIterator[str]:
+    """
+    以 SSE 形式逐段返回回复；流结束后再把完整回复写入 VectorStore、SQLite 和 Redis
+    """
+    start_time = time.time()
+    try:
+        async for chunk in _stream_chat_completion(chat_request, user_id, user_input, full_messages, cache_key,
+                                                   cached_response):
+            yield chunk
+    finally:
+        REQUEST_SECONDS.observe(time.time() - start_time, cache=cache_status, stream="true")
+
+async def _stream_chat_completion(chat_request: ChatRequest, user_id: str, user_input: str,
+                                  full_messages: List[dict], cache_key: str,
+                                  cached_response: str = None) -> AsyncIterator[str]:
+    start_time = time.time()
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    created = int(start_time)
+    model = chat_request.model
+    yield sse_chunk(completion_id, created, model, {"role": "assistant"})
+
+    if cached_response:
+        yield sse_chunk(completion_id, created, model, {"content": cached_response})
+        yield sse_chunk(completion_id, created, model, {}, finish_reason="stop")
+        yield "data: [DONE]\n\n"
+        return
+
+    parts = []
+    # 没有相同请求在生成时登记为生成者，让随后到达的相同请求等待本次结果
+    leading = single_flight.inflight(cache_key) is None
+    if leading:
+        single_flight.begin(cache_key)
+    try:
+        async for content in generate_response_stream(full_messages, model, chat_request.max_tokens,
+                                                      chat_request.temperature):
+            if not parts:
+                logger.info(f"chat_completions first token took {time.time() - start_time:.2f} seconds")
+                STAGE_SECONDS.observe(time.time() - start_time, stage="ollama_first_token")
+            parts.append(content)
+            yield sse_chunk(completion_id, created, model, {"content": content})
+        yield sse_chunk(completion_id, created, model, {}, finish_reason="stop")
+        yield "data: [DONE]\n\n"
+    except OllamaStreamError as e:
+        # 生成中途中断：已发出的内容不完整，以错误结束本次流，不写入对话记录与缓存，也不交给合并等待的请求
+        logger.error(f"Model stream interrupted after {len(parts)} chunks: {e}")
+        ERRORS.inc(stage="ollama")
+        if leading:
+            single_flight.finish(cache_key, error=e)
+        yield sse_chunk(completion_id, created, model, {}, finish_reason="error")
+        yield f"data: {json.dumps({'error': {'message': 'Model stream interrupted', 'type': 'upstream_error'}})}\n\n"
+        return
+    except BaseException as e:
+        if leading:
+            single_flight.finish(cache_key, error=e)
+        raise
+    finally:
+        logger.info(f"chat_completions stream took {time.time() - start_time:.2f} seconds")
+        STAGE_SECONDS.observe(time.time() - start_time, stage="ollama")
+
+    response_text = "".join(parts)
+    if not response_text:
+        logger.error("Failed to generate response from model")
+        ERRORS.inc(stage="ollama")
+        if leading:
+            single_flight.finish(cache_key, error=RuntimeError("Failed to generate response"))
+        return
+    if sample("payload"):
+        logger.info(f"Ollama 模型流式回复: {preview(response_text)}", extra={"category": "payload"})
+
+    try:
+        await persist_exchange(user_id, user_input, response_text, cache_key, chat_request.model)
+    finally:
+        if leading:
+            single_flight.finish(cache_key, response_text)
+
 # 生命周期事件
 @app.on_event("startup")
 async def startup_event():
@@ -130,12 +480,16 @@ async def startup_event():
     在应用启动时执行初始化任务
     """
     logger.info("Starting up the application...")
-    if redis_client:
-        try:
-            redis_client.ping()
-            logger.info("Redis connection is healthy.")
-        except redis.ConnectionError as e:
-            logger.error(f"Redis connection failed during startup: {e}")
+    # preload_app=True 时 master 进程建表用过的连接不能在 fork 出的 worker 中继续使用
+    engine.dispose(close=False)
+    # 后台加载并预热嵌入模型，就绪前 /ready 返回 503
+    vector_store.start_embedding_backend()
+    await ollama_client.start()
+    executors.attach_embedding_pool(vector_store)
+    chat_history_writer.start(executor=executors.io)
+    await response_cache.connect()
+    if SINGLE_FLIGHT_ACROSS_WORKERS:
+        single_flight.redis_client = response_cache.redis
 
 @app.on_event("shutdown")
 async def shutdown_event():
@@ -143,12 +497,17 @@ async def shutdown_event():
     在应用关闭时进行清理任务
     """
     logger.info("Shutting down the application...")
-    if redis_client:
-        try:
-            redis_client.close()
-            logger.info("Redis connection closed successfully.")
-        except Exception as e:
-            logger.error(f"Failed to close Redis connection: {e}")
+    await ollama_client.close()
+    await executors.drain()
+    await chat_history_writer.stop()
+    vector_store.close()
+    executors.shutdown()
+    try:
+        await response_cache.close()
+    except Exception as e:
+        logger.error(f"Failed to close Redis connection: {e}")
+    # 写完队列中剩余的日志
+    shutdown_logging()
 
 # 健康检查
 @app.get("/health")
@@ -156,79 +515,117 @@ async def health_check():
     """
     健康检查接口，用于确认服务是否正常运行
     """
-    redis_status = "Connected" if redis_client and redis_client.ping() else "Disconnected"
+    redis_status = "Connected" if await response_cache.ping() else "Disconnected"
 
     # 检查数据库连接
     db_status = "Connected"
     try:
-        db = next(get_db())
-        db.execute("SELECT 1")
+        await executors.run_io(check_connection)
     except Exception as e:
         db_status = f"Error: {e}"
 
     return {
         "status": "ok",
         "redis": redis_status,
-        "database": db_status
+        "database": db_status,
+        "embedding": vector_store.embedding_stats(),
+        "index": vector_store.index_stats(),
+        "ollama": ollama_client.stats(),
+        "cache": response_cache.stats(),
+        "single_flight": single_flight.stats(),
+        "executors": executors.stats(),
+        "chat_history_writer": chat_history_writer.stats(),
+        "semantic_cache": semantic_cache.stats() if semantic_cache is not None else None
     }
 
+# 就绪检查（与 /health 存活检查分开）
+@app.get("/ready")
+async def readiness_check():
+    """
+    就绪检查：嵌入模型加载并预热完成后返回 200，否则返回 503，供负载均衡决定是否转发流量
+    """
+    backend = vector_store.embedding_backend
+    if not backend.ready:
+        return JSONResponse(status_code=503, content={"status": "not ready", "embedding_backend": backend.stats()})
+    return {"status": "ready", "embedding_backend": backend.stats()}
+
+# Prometheus 指标
+@app.get("/metrics")
+async def metrics_endpoint():
+    """
+    以 Prometheus 文本格式输出各阶段耗时直方图、缓存命中计数与各组件的状态
+    """
+    return Response(content=metrics.render(), media_type=CONTENT_TYPE)
+
 # 核心聊天接口
 @app.post("/v1/chat/completions", response_model=ChatResponse)
-async def chat_completions(chat_request: ChatRequest, db: Session = Depends(get_db)):
+async def chat_completions(chat_request: ChatRequest, response: Response):
     """
-    主业务逻辑：处理聊天请求
+    主业务逻辑：处理聊天请求；stream=true 时以 SSE 流式返回。
+    响应头 X-Cache 标明缓存结果（hit / coalesced / semantic / miss），供压测统计命中率
     """
-    import time
     start_time = time.time()
+    cache_status = None
 
     try:
-        logger.info(f"Received chat request: {chat_request.json()}")
+        if sample("payload"):
+            logger.info(f"Received chat request: {preview(chat_request.json())}", extra={"category": "payload"})
 
-        user_id = "user123"  # 从认证系统动态获取真实用户 ID
+        user_id = chat_request.user or DEFAULT_USER_ID
         user_input = next((msg.content for msg in chat_request.messages if msg.role == "user"), None)
 
         if not user_input:
             logger.error("No valid user message found in 'messages'")
             raise HTTPException(status_code=422, detail="No valid user message found in 'messages'")
 
-        # 加载上下文历史
-        conversation_history = vector_store.get_conversation_history(user_id)
-        logger.info(f"Loaded conversation history for user {user_id}: {conversation_history}")
-
-        # 将历史记录与当前用户输入合并
-        full_messages = conversation_history + [{"role": "user", "content": user_input}]
-        cache_key = f"chat:{user_id}:{hashlib.md5(json.dumps(full_messages, ensure_ascii=False).encode()).hexdigest()}"
-
-        # 检查缓存是否命中
-        cached_response = get_cached_response(redis_client, cache_key)
+        if VECTOR_STORE_SHARED:
+            # 先加载其他 worker 写入的对话记录，摘要与上下文才是最新的
+            await executors.run_io(vector_store.refresh)
+        cache_key = make_cache_key(user_id, user_input)
+        cached_response, cache_status = await find_cached_response(cache_key, user_id, chat_request.model, user_input)
+
+        full_messages = []
+        if not cached_response:
+            # 组装上下文（最近轮次 + 语义检索，受 token 预算约束；检索在执行器线程池中进行）
+            with stage_timer("context"):
+                conversation_history = await executors.run_embedding(context_builder.build, user_id, user_input)
+            logger.info(f"Loaded conversation context for user {user_id}: {len(conversation_history)} messages")
+
+            # 将历史记录与当前用户输入合并
+            full_messages = conversation_history + [{"role": "user", "content": user_input}]
+
+        if chat_request.stream:
+            return StreamingResponse(
+                stream_chat_completion(chat_request, user_id, user_input, full_messages, cache_key,
+                                       cached_response, cache_status),
+                media_type="text/event-stream",
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "X-Cache": cache_status},
+            )
+
+        response.headers["X-Cache"] = cache_status
         if cached_response:
             return ChatResponse(choices=[ChatResponseChoice(
                 message=ChatMessage(role="assistant", content=cached_response)
             )])
 
-        # 调用 AI 模型生成回复
-        response_text = await generate_response(full_messages, chat_request.model, chat_request.max_tokens, chat_request.temperature)
-        if not response_text:
-            logger.error("Failed to generate response from model")
-            raise HTTPException(status_code=500, detail="Failed to generate response")
+        async def generate_and_persist() -> str:
+            # 调用 AI 模型生成回复
+            text = await generate_response(full_messages, chat_request.model, chat_request.max_tokens, chat_request.temperature)
+            if not text:
+                logger.error("Failed to generate response from model")
+                raise HTTPException(status_code=500, detail="Failed to generate response")
 
-        # 保存到 VectorStore（更新对话历史）
-        try:
-            vector_store.add_to_conversation(user_id, role="user", content=user_input)
-            vector_store.add_to_conversation(user_id, role="assistant", content=response_text)
-            logger.info(f"Updated conversation history in VectorStore for user {user_id}.")
-        except Exception as e:
-            logger.error(f"Failed to update conversation history: {e}")
+            # 写入 VectorStore、数据库并缓存
+            await persist_exchange(user_id, user_input, text, cache_key, chat_request.model)
+            return text
 
-        # 存储聊天历史到数据库
-        try:
-            add_chat_history(db, user_id=user_id, message=user_input, response=response_text)
-            logger.info("Chat history saved successfully")
-        except Exception as e:
-            logger.error(f"Failed to save chat history: {e}")
+        async def lookup_cache():
+            return await get_cached_response(cache_key)
 
-        # 缓存生成的响应
-        cache_response(redis_client, cache_key, response_text)
+        # 相同缓存键的并发请求只生成一次，其余请求共享结果；Redis 不可用时只在进程内合并
+        response_text = await single_flight.do(
+            cache_key, generate_and_persist, lookup=lookup_cache if response_cache.available else None
+        )
 
         # 返回结果
         return ChatResponse(choices=[ChatResponseChoice(
@@ -240,7 +637,241 @@ async def chat_completions(chat_request: ChatRequest, db: Session = Depends(get_
         raise he
     except Exception as e:
         logger.error(f"Unexpected error in chat_completions: {e}", exc_info=True)
+        ERRORS.inc(stage="chat_completions")
         raise HTTPException(status_code=500, detail="Internal server error")
     finally:
         end_time = time.time()
-        logger.info(f"chat_completions execution took {end_time - start_time:.2f} seconds")
+        logger.info(f"chat_completions execution took {end_time - start_time:.3f} seconds "
+                    f"(cache={cache_status or 'none'})",
+                    extra={"fields": {"duration_s": round(end_time - start_time, 6), "cache": cache_status}})
+        if cache_status is not None:
+            REQUESTS.inc(cache=cache_status)
+            if not chat_request.stream:
+                REQUEST_SECONDS.observe(end_time - start_time, cache=cache_status, stream="false")
+
+async def run_batch_item(index: int, item: BatchChatItem, batch: BatchChatRequest, semaphore: asyncio.Semaphore,
+                         pending_index: list, prefetched: Dict[str, str] = None) -> dict:
+    """
+    处理批量请求中的一条对话，返回该条的结果行（出错时包含 error，而不是让整个批次失败）
+    """
+    start_time = time.time()
+    user_id = item.user or DEFAULT_USER_ID
+    model = item.model or batch.model
+    cache_status = None
+    result = {"index": index, "id": item.id, "user": user_id}
+    try:
+        user_input = next((msg.content for msg in item.messages if msg.role == "user"), None)
+        if not user_input:
+            result["error"] = {"status": 422, "detail": "No valid user message found in 'messages'"}
+            return result
+
+        cache_key = make_cache_key(user_id, user_input)
+        response_text, cache_status = await find_cached_response(cache_key, user_id, model, user_input, prefetched)
+
+        if not response_text:
+            async def generate_and_persist() -> str:
+                # 限制同时生成的条数，批量任务不至于占满 Ollama 的排队名额
+                async with semaphore:
+                    with stage_timer("context"):
+                        conversation_history = await executors.run_embedding(context_builder.build, user_id,
+                                                                             user_input)
+                    text = await generate_response(
+                        conversation_history + [{"role": "user", "content": user_input}], model,
+                        item.max_tokens or batch.max_tokens,
+                        item.temperature if item.temperature is not None else batch.temperature)
+                await persist_exchange(user_id, user_input, text, cache_key, model, pending_index)
+                return text
+
+            async def lookup_cache():
+                return await get_cached_response(cache_key)
+
+            response_text = await single_flight.do(
+                cache_key, generate_and_persist, lookup=lookup_cache if response_cache.available else None
+            )
+
+        if response_text in UNCACHEABLE_RESPONSES:
+            result["error"] = {"status": 502, "detail": response_text}
+        else:
+            result["choices"] = [{"message": {"role": "assistant", "content": response_text}}]
+        result["cache"] = cache_status
+    except Exception as e:
+        logger.error(f"Unexpected error in batch item {index} for user {user_id}: {e}", exc_info=True)
+        ERRORS.inc(stage="batch")
+        result["error"] = {"status": 500, "detail": "Internal server error"}
+    finally:
+        duration = time.time() - start_time
+        result["duration_s"] = round(duration, 6)
+        if cache_status is not None:
+            REQUESTS.inc(cache=cache_status)
+            REQUEST_SECONDS.observe(duration, cache=cache_status, stream="batch")
+    return result
+
+async def stream_batch_completion(batch: BatchChatRequest, chains: Dict[str, List[int]],
+                                  prefetched: Optional[Dict[str, str]]) -> AsyncIterator[str]:
+    """
+    各用户的对话按顺序处理（后一条依赖前一条写入的历史），不同用户并发处理；
+    每完成一条即输出一行 JSON，用户消息攒够 BATCH_INDEX_SIZE 条后一次批量计算嵌入并写入 FAISS
+    """
+    start_time = time.time()
+    concurrency = min(batch.concurrency or BATCH_CONCURRENCY, BATCH_CONCURRENCY)
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    results = asyncio.Queue()
+    pending_index = []
+    counts = {"ok": 0, "error": 0}
+
+    async def run_chain(indices: List[int]):
+        for position, index in enumerate(indices):
+            # 只有每个用户的第一条能使用预取结果，之后的缓存键随对话摘要变化
+            await results.put(await run_batch_item(index, batch.items[index], batch, semaphore, pending_index,
+                                                   prefetched if position == 0 else None))
+
+    def flush_index():
+        if pending_index:
+            executors.spawn(index_batch_in_background(list(pending_index)))
+            pending_index.clear()
+
+    tasks = [asyncio.ensure_future(run_chain(indices)) for indices in chains.values()]
+    try:
+        for _ in range(len(batch.items)):
+            result = await results.get()
+            counts["error" if "error" in result else "ok"] += 1
+            if len(pending_index) >= BATCH_INDEX_SIZE:
+                flush_index()
+            yield json.dumps(result, ensure_ascii=False) + "\n"
+    finally:
+        # 客户端断开时取消尚未完成的条目
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+        flush_index()
+        duration = time.time() - start_time
+        logger.info(f"chat_completions batch of {len(batch.items)} items took {duration:.3f} seconds "
+                    f"({counts['ok']} ok, {counts['error']} failed)",
+                    extra={"fields": {"duration_s": round(duration, 6), "items": len(batch.items), **counts}})
+
+# 批量聊天接口
+@app.post("/v1/chat/completions/batch")
+async def chat_completions_batch(batch: BatchChatRequest):
+    """
+    一次提交多条对话（各自的 user），以 NDJSON 流式返回：每条完成即输出一行
+    {"index", "id", "user", "cache", "choices" | "error", "duration_s"}，顺序为完成顺序而非提交顺序。
+    各用户第一条的缓存键用一次 pipeline 批量查询；生成受 concurrency 限制；嵌入与 FAISS 写入攒批进行，
+    聊天记录经 chat_history_writer 批量写入 SQLite
+    """
+    if not batch.items:
+        raise HTTPException(status_code=422, detail="'items' must not be empty")
+    if len(batch.items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"At most {BATCH_MAX_ITEMS} items per batch")
+
+    if VECTOR_STORE_SHARED:
+        # 先加载其他 worker 写入的对话记录，摘要与上下文才是最新的
+        await executors.run_io(vector_store.refresh)
+
+    # 按用户分组，保持各用户内的提交顺序
+    chains: Dict[str, List[int]] = {}
+    for index, item in enumerate(batch.items):
+        chains.setdefault(item.user or DEFAULT_USER_ID, []).append(index)
+
+    # 预取各用户第一条的缓存结果
+    first_keys = []
+    for indices in chains.values():
+        item = batch.items[indices[0]]
+        user_input = next((msg.content for msg in item.messages if msg.role == "user"), None)
+        if user_input:
+            first_keys.append(make_cache_key(item.user or DEFAULT_USER_ID, user_input))
+    prefetched = None
+    try:
+        with stage_timer("cache_get"):
+            prefetched = await response_cache.get_many(first_keys)
+    except Exception as e:
+        # 预取失败时各条单独查询
+        logger.error(f"Cache error while prefetching batch responses: {e}")
+
+    return StreamingResponse(stream_batch_completion(batch, chains, prefetched),
+                             media_type="application/x-ndjson", headers={"X-Accel-Buffering": "no"})
+
+def history_row(row) -> dict:
+    """
+    把查询结果行转换为可序列化的字典
+    """
+    return {
+        "id": row.id,
+        "user_id": row.user_id,
+        "message": row.message,
+        "response": row.response,
+        "timestamp": row.timestamp.isoformat() if row.timestamp else None,
+    }
+
+def read_history_page(user_id: str, limit: int, cursor: Optional[str], order: str):
+    with SessionLocal() as db:
+        return get_chat_history_page(db, user_id, limit, cursor, order)
+
+def read_export_chunk(user_id: str, cursor: Optional[str], fmt: str):
+    """
+    读取并格式化一段导出数据，返回 (文本, 行数, 下一段游标)；在执行器线程中运行，每段一个短事务
+    """
+    with SessionLocal() as db:
+        rows, next_cursor = get_chat_history_page(db, user_id, HISTORY_EXPORT_CHUNK, cursor, order="asc")
+    if fmt == "csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in rows:
+            record = history_row(row)
+            writer.writerow([record[column] for column in HISTORY_EXPORT_COLUMNS])
+        return buffer.getvalue(), len(rows), next_cursor
+    return "".join(json.dumps(history_row(row), ensure_ascii=False) + "\n" for row in rows), len(rows), next_cursor
+
+async def stream_history_export(user_id: str, fmt: str) -> AsyncIterator[str]:
+    """
+    按键集游标逐段读取并输出，任意时刻只持有一段数据；客户端读得慢时自然暂停读取数据库
+    """
+    start_time = time.time()
+    total = 0
+    cursor = None
+    try:
+        if fmt == "csv":
+            buffer = io.StringIO()
+            csv.writer(buffer).writerow(HISTORY_EXPORT_COLUMNS)
+            yield buffer.getvalue()
+        while True:
+            block, count, cursor = await executors.run_io(read_export_chunk, user_id, cursor, fmt)
+            total += count
+            if block:
+                yield block
+            if cursor is None:
+                break
+    finally:
+        logger.info(f"Exported {total} chat history rows for user {user_id} as {fmt} "
+                    f"in {time.time() - start_time:.3f} seconds")
+
+# 聊天记录分页查询
+@app.get("/v1/history/{user_id}")
+async def chat_history(user_id: str, limit: int = 50, cursor: Optional[str] = None, order: str = "desc"):
+    """
+    按 (timestamp, id) 键集分页读取聊天记录：返回 {"data": [...], "next_cursor": ...}，
+    把 next_cursor 作为下一次请求的 cursor 继续翻页，为 null 时表示没有更多记录。
+    聊天记录经写后队列批量落库，最近零点几秒内的对话可能尚未出现
+    """
+    if order not in ("asc", "desc"):
+        raise HTTPException(status_code=422, detail="'order' must be 'asc' or 'desc'")
+    limit = max(1, min(limit, HISTORY_PAGE_MAX))
+    try:
+        rows, next_cursor = await executors.run_io(read_history_page, user_id, limit, cursor, order)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"data": [history_row(row) for row in rows], "next_cursor": next_cursor}
+
+# 聊天记录流式导出
+@app.get("/v1/history/{user_id}/export")
+async def export_chat_history(user_id: str, format: str = "ndjson"):
+    """
+    以 NDJSON 或 CSV 流式导出某用户的全部聊天记录（从旧到新）。
+    每次在执行器线程中读取 HISTORY_EXPORT_CHUNK 行，内存占用与总行数无关，也不阻塞事件循环
+    """
+    if format not in ("ndjson", "csv"):
+        raise HTTPException(status_code=422, detail="'format' must be 'ndjson' or 'csv'")
+    media_type = "text/csv; charset=utf-8" if format == "csv" else "application/x-ndjson"
+    safe_user = "".join(c if c.isalnum() or c in "-_." else "_" for c in user_id)
+    filename = f"chat_history_{safe_user}.{'csv' if format == 'csv' else 'ndjson'}"
+    return StreamingResponse(stream_history_export(user_id, format), media_type=media_type,
+                             headers={"Content-Disposition": f'attachment; filename="{filename}"'})
@@ -1,26 +1,226 @@
-from collections import deque
+import heapq
+import itertools
+import math
+import re
+import threading
 import time
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set
+
+# 未指定用户时使用的用户 ID（兼容原来不分用户的调用方式）
+DEFAULT_USER = "default"
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalize(text: str) -> str:
+    """
+    NFKC 归一化（全角转半角等）、转小写、去掉空白：中文没有词边界，按字符切分
+    """
+    return _WHITESPACE_RE.sub("", unicodedata.normalize("NFKC", text).lower())
+
+
+def char_ngrams(text: str, n: int = 2) -> Set[str]:
+    """
+    字符 n-gram 集合；文本短于 n 时返回文本本身
+    """
+    if len(text) < n:
+        return {text} if text else set()
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+class _UserMemories:
+    """
+    单个用户的记忆：id -> 记录（按写入顺序），以及 n-gram -> id 集合 的倒排索引
+    """
+
+    def __init__(self):
+        self.entries: "OrderedDict[int, dict]" = OrderedDict()
+        self.postings: Dict[str, Set[int]] = {}
+
+    def add(self, memory_id: int, entry: dict):
+        self.entries[memory_id] = entry
+        for gram in entry["grams"]:
+            self.postings.setdefault(gram, set()).add(memory_id)
+
+    def remove(self, memory_id: int) -> Optional[dict]:
+        entry = self.entries.pop(memory_id, None)
+        if entry is None:
+            return None
+        for gram in entry["grams"]:
+            ids = self.postings.get(gram)
+            if ids is not None:
+                ids.discard(memory_id)
+                if not ids:
+                    del self.postings[gram]
+        return entry
+
 
 class MemoryManager:
-    def __init__(self, max_memories=1000, ttl=3600):  # 最多1000条记忆，生存时间1小时
-        self.memories = deque(maxlen=max_memories)
+    """
+    按用户隔离的记忆存储：
+    - 倒排索引以字符 n-gram（默认二元组）为键，查询只访问与查询共享 n-gram 的记忆，
+      开销取决于命中数量而不是记忆总数
+    - 非重要记忆到期后由最小堆按到期时间真正删除；重要记忆不过期
+    - 每个用户超过容量时淘汰最早写入的记忆
+    - 结果按相关度（查询 n-gram 的覆盖比例）与新近度综合排序
+    """
+
+    def __init__(self, max_memories=1000, ttl=3600, ngram: int = 2, min_score: float = 0.5,
+                 recency_weight: float = 0.2, recency_half_life: float = 1800):  # 每个用户最多1000条记忆，生存时间1小时
+        """
+        :param max_memories: 每个用户最多保存的记忆数
+        :param ttl: 非重要记忆的生存时间（秒）
+        :param ngram: 索引使用的字符 n-gram 长度
+        :param min_score: 最低相关度（记忆包含查询 n-gram 的比例），低于该值不返回
+        :param recency_weight: 排序时新近度所占的权重
+        :param recency_half_life: 新近度减半所需的时间（秒）
+        """
+        self.max_memories = max_memories
         self.ttl = ttl
+        self.ngram = ngram
+        self.min_score = min_score
+        self.recency_weight = recency_weight
+        self.recency_half_life = recency_half_life
+        self._users: Dict[str, _UserMemories] = {}
+        self._expiry = []  # (到期时间, 用户 ID, 记忆 ID) 最小堆
+        self._ids = itertools.count(1)
+        self._count = 0  # 当前存活的记忆总数，写入、淘汰、过期时更新
+        self._lock = threading.Lock()
+        # 统计信息
+        self.added = 0
+        self.queries = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _grams(self, text: str) -> Set[str]:
+        normalized = normalize(text)
+        grams = char_ngrams(normalized, self.ngram)
+        # 单字查询也能命中：单字同样入索引
+        grams.update(normalized)
+        return grams
+
+    def _remove(self, user_id: str, memory_id: int) -> bool:
+        memories = self._users.get(user_id)
+        if memories is None or memories.remove(memory_id) is None:
+            return False
+        self._count -= 1
+        if not memories.entries:
+            del self._users[user_id]
+        return True
+
+    def _purge_expired(self, now: float):
+        while self._expiry and self._expiry[0][0] <= now:
+            _, user_id, memory_id = heapq.heappop(self._expiry)
+            if self._remove(user_id, memory_id):
+                self.expirations += 1
+
+    def add_memory(self, content, importance=False, user_id: str = DEFAULT_USER, ttl: int = None) -> int:
+        """
+        写入一条记忆，返回记忆 ID
+        :param importance: 重要记忆不会过期（超过容量时仍按写入顺序淘汰）
+        :param ttl: 本条记忆的生存时间，None 时使用默认值
+        """
+        now = time.time()
+        grams = self._grams(content)
+        with self._lock:
+            self._purge_expired(now)
+            memory_id = next(self._ids)
+            expires_at = None if importance else now + (ttl if ttl is not None else self.ttl)
+            memories = self._users.get(user_id)
+            if memories is None:
+                memories = self._users[user_id] = _UserMemories()
+            memories.add(memory_id, {
+                'content': content,
+                'timestamp': now,
+                'importance': importance,
+                'expires_at': expires_at,
+                'grams': grams,
+            })
+            self._count += 1
+            if expires_at is not None:
+                heapq.heappush(self._expiry, (expires_at, user_id, memory_id))
+            while len(memories.entries) > self.max_memories:
+                self._remove(user_id, next(iter(memories.entries)))
+                self.evictions += 1
+            # 被容量淘汰的记忆仍留在堆中，堆过大时按存活记录重建
+            if len(self._expiry) > 2 * max(self._count, self.max_memories):
+                self._expiry = [(e['expires_at'], uid, mid) for uid, m in self._users.items()
+                                for mid, e in m.entries.items() if e['expires_at'] is not None]
+                heapq.heapify(self._expiry)
+            self.added += 1
+        return memory_id
+
+    def search(self, query: str, user_id: str = DEFAULT_USER, limit: Optional[int] = None) -> List[dict]:
+        """
+        返回与查询相关的记忆（content、timestamp、importance、score），按综合得分降序
+        """
+        now = time.time()
+        query_grams = char_ngrams(normalize(query), self.ngram)
+        if not query_grams:
+            return []
+        with self._lock:
+            self.queries += 1
+            self._purge_expired(now)
+            memories = self._users.get(user_id)
+            if memories is None:
+                return []
+            # 只遍历查询 n-gram 的倒排列表，统计每条记忆命中的 n-gram 数
+            overlap: Dict[int, int] = {}
+            for gram in query_grams:
+                for memory_id in memories.postings.get(gram, ()):
+                    overlap[memory_id] = overlap.get(memory_id, 0) + 1
+            results = []
+            for memory_id, count in overlap.items():
+                relevance = count / len(query_grams)
+                if relevance < self.min_score:
+                    continue
+                entry = memories.entries[memory_id]
+                recency = math.pow(0.5, (now - entry['timestamp']) / self.recency_half_life)
+                results.append({
+                    'id': memory_id,
+                    'content': entry['content'],
+                    'timestamp': entry['timestamp'],
+                    'importance': entry['importance'],
+                    'score': relevance + self.recency_weight * recency,
+                })
+        results.sort(key=lambda r: (r['score'], r['timestamp']), reverse=True)
+        return results[:limit] if limit is not None else results
+
+    def get_relevant_memories(self, query, user_id: str = DEFAULT_USER, limit: Optional[int] = None) -> List[str]:
+        """
+        返回与查询相关的记忆内容，按相关度与新近度排序
+        """
+        return [memory['content'] for memory in self.search(query, user_id, limit)]
+
+    def remove_user(self, user_id: str):
+        """
+        删除某个用户的全部记忆（堆中的残留项到期时自动忽略）
+        """
+        with self._lock:
+            memories = self._users.pop(user_id, None)
+            if memories is not None:
+                self._count -= len(memories.entries)
+
+    def size(self, user_id: Optional[str] = None) -> int:
+        if user_id is not None:
+            memories = self._users.get(user_id)
+            return len(memories.entries) if memories is not None else 0
+        return self._count
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "users": len(self._users),
+                "memories": self.size(),
+                "index_grams": sum(len(m.postings) for m in self._users.values()),
+                "expiry_heap": len(self._expiry),
+                "added": self.added,
+                "queries": self.queries,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
 
-    def add_memory(self, content, importance=False):
-        self.memories.append({
-            'content': content,
-            'timestamp': time.time(),
-            'importance': importance
-        })
-
-    def get_relevant_memories(self, query):
-        current_time = time.time()
-        relevant = []
-        for memory in self.memories:
-            if current_time - memory['timestamp'] > self.ttl and not memory['importance']:
-                continue
-            if query.lower() in memory['content'].lower():
-                relevant.append(memory['content'])
-        return relevant
 
 memory_manager = MemoryManager()
@@ -0,0 +1,237 @@
+import bisect
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+# 阶段耗时的默认分桶（秒）：覆盖从亚毫秒的缓存/FAISS 到数十秒的模型生成
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if value == -math.inf:
+        return "-Inf"
+    if isinstance(value, int) or (value.is_integer() and abs(value) < 1e15):
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"{self.name} 需要标签 {self.labelnames}，实际为 {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    """
+    单调递增的计数器（名称应以 _total 结尾）
+    """
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return self.header() + [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+                                for key, value in items]
+
+
+class Histogram(_Metric):
+    """
+    固定分桶的直方图：observe() 只做一次二分查找和几次加法，开销在微秒级，可在生产环境常开
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # 每组标签：[各分桶计数..., +Inf 桶计数, 总和]
+        self._values: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        记录 with 代码块的耗时（秒），代码块抛出异常时同样记录
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted((key, list(counts)) for key, counts in self._values.items())
+        lines = self.header()
+        for key, counts in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, f'le="{_format_value(bound)}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(counts[-1])}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class StatsCollector:
+    """
+    把已有组件的 stats() 字典导出为指标：抓取时才调用，数值项成为 <prefix>_<键>，
+    嵌套字典按路径展开，布尔值记为 0/1，字符串与 None 跳过。
+    counters 中的键（累计值，嵌套字典给出上层键即可）导出为 counter 并追加 _total 后缀，其余为 gauge。
+    """
+
+    def __init__(self, prefix: str, func: Callable[[], Optional[dict]], documentation: str = "",
+                 counters: Iterable[str] = ()):
+        self.prefix = prefix
+        self.func = func
+        self.documentation = documentation
+        self.counters = set(counters)
+
+    def _flatten(self, stats: dict, path: str = ""):
+        for key, value in stats.items():
+            name = f"{path}_{key}" if path else str(key)
+            if isinstance(value, dict):
+                yield from self._flatten(value, name)
+            elif isinstance(value, bool):
+                yield name, int(value)
+            elif isinstance(value, (int, float)):
+                yield name, value
+
+    def render(self) -> List[str]:
+        stats = self.func()
+        if not stats:
+            return []
+        lines = []
+        for key, value in self._flatten(stats):
+            if key in self.counters or any(key.startswith(counter + "_") for counter in self.counters):
+                name, kind = f"{self.prefix}_{key}_total", "counter"
+            else:
+                name, kind = f"{self.prefix}_{key}", "gauge"
+            lines.append(f"# HELP {name} {self.documentation or self.prefix} {key}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"{name} {_format_value(value)}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    进程内的指标注册表，render() 输出 Prometheus 文本格式（/metrics）。
+    指标保存在各进程内：多个 gunicorn worker 时每次抓取只反映处理该次请求的 worker。
+    """
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._collectors: List[StatsCollector] = []
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric) or existing.labelnames != metric.labelnames:
+                    raise ValueError(f"指标 {metric.name} 已以不同的类型或标签注册")
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def register_stats(self, prefix: str, func: Callable[[], Optional[dict]], documentation: str = "",
+                       counters: Iterable[str] = ()):
+        """
+        注册一个在抓取时调用的 stats() 函数
+        """
+        with self._lock:
+            self._collectors = [c for c in self._collectors if c.prefix != prefix]
+            self._collectors.append(StatsCollector(prefix, func, documentation, counters))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+            collectors = list(self._collectors)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        for collector in collectors:
+            try:
+                lines.extend(collector.render())
+            except Exception as e:
+                # 某个组件出错不影响其余指标的输出
+                lines.append(f"# collector {collector.prefix} failed: {_escape(e)}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+
+# 请求路径各阶段耗时：context（历史加载与检索）、embedding、faiss_search、faiss_add、cache_get/cache_set（L1 + Redis）、
+# semantic_cache、ollama、ollama_first_token、journal_append、snapshot（pickle 压缩）、sqlite_flush
+STAGE_SECONDS = metrics.histogram("llmb_stage_duration_seconds", "Time spent in each request stage", ("stage",))
+REQUEST_SECONDS = metrics.histogram("llmb_request_duration_seconds", "Chat completion latency by cache result",
+                                    ("cache", "stream"))
+REQUESTS = metrics.counter("llmb_chat_requests_total", "Chat completion requests by cache result", ("cache",))
+ERRORS = metrics.counter("llmb_errors_total", "Errors by stage", ("stage",))
+
+
+def stage_timer(stage: str):
+    """
+    记录一个阶段的耗时：with stage_timer("ollama"): ...
+    """
+    return STAGE_SECONDS.time(stage=stage)
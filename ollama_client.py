@@ -1,34 +1,512 @@
 import aiohttp  # 异步 HTTP 客户端
-from typing import List, Optional, Dict
-import logging
-
-# 配置日志
-logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
-handler = logging.StreamHandler()
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-handler.setFormatter(formatter)
-logger.addHandler(handler)
-# 本地ollama api
-DEFAULT_OLLAMA_API_URL = "http://127.0.0.1:11434/v1/chat/completions"
+from typing import List, Optional, Dict, AsyncIterator, Iterable, Set
+from collections import deque
+from contextlib import asynccontextmanager
+import asyncio
+import itertools
+import json
+import re
+import time
+from logger import get_logger, preview, sample
+
+# 配置日志（经由异步队列写入，不阻塞事件循环）
+logger = get_logger(__name__)
+# Ollama 后端列表（基础地址），多个后端时按在途请求数最少路由，并优先选择已加载所请求模型的后端
+OLLAMA_BACKENDS = ["http://127.0.0.1:11434"]
+CHAT_PATH = "/v1/chat/completions"
+# 本地ollama api（显式传入 api_url 时直接请求该地址，不经过路由）
+DEFAULT_OLLAMA_API_URL = OLLAMA_BACKENDS[0] + CHAT_PATH
+# 每个后端同时处理的最大请求数，超出的请求在本地排队（背压）
+OLLAMA_MAX_CONCURRENCY = 4
+# 连接池大小与空闲连接保活时间（秒）
+OLLAMA_POOL_SIZE = 32
+OLLAMA_KEEPALIVE_TIMEOUT = 60
+# 健康检查间隔与超时（秒），间隔为 0 时不做主动检查；连续失败达到次数后摘除后端一段时间
+OLLAMA_HEALTH_INTERVAL = 10
+OLLAMA_HEALTH_TIMEOUT = 2
+OLLAMA_EJECT_FAILURES = 3
+OLLAMA_EJECT_SECONDS = 30
+# 对冲请求：非流式请求超过近期延迟的该分位数仍未返回时，向另一个后端再发一份，取先返回的结果；None 表示关闭
+OLLAMA_HEDGE_PERCENTILE = None
+OLLAMA_HEDGE_MIN_SAMPLES = 50
+OLLAMA_HEDGE_MIN_DELAY = 0.05
+# 对冲请求数占请求总数的上限，避免后端整体变慢时负载翻倍
+OLLAMA_HEDGE_MAX_RATIO = 0.1
+OLLAMA_LATENCY_WINDOW = 500
+# 连接失败或 5xx 时最多尝试的后端数
+OLLAMA_MAX_ATTEMPTS = 2
+
+
+class OllamaStreamError(Exception):
+    """
+    流式生成在产出部分内容之后中断：已产出的内容不是完整回复，调用方不应保存或缓存
+    """
+
+
+def model_key(name: str) -> str:
+    """
+    Ollama 中不带标签的模型名等同于 :latest
+    """
+    return name if ":" in name else f"{name}:latest"
+
+
+def _retryable(error: BaseException) -> bool:
+    """
+    连接失败、超时、响应中途断开与 5xx 说明后端本身有问题，可换后端重试；4xx（如模型不存在）不重试
+    """
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status >= 500
+    return isinstance(error, (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError))
+
+
+class OllamaBackend:
+    """
+    单个 Ollama 后端：并发名额、在途/排队计数、健康状态与已加载模型
+    """
+
+    def __init__(self, base_url: str, max_concurrency: int = OLLAMA_MAX_CONCURRENCY, chat_url: str = None):
+        self.base_url = base_url.rstrip("/")
+        self.chat_url = chat_url or self.base_url + CHAT_PATH
+        # 指标名中使用的标识：127.0.0.1:11434 -> 127_0_0_1_11434
+        self.name = re.sub(r"\W", "_", re.sub(r"^\w+://", "", self.base_url))
+        self.max_concurrency = max_concurrency
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self.in_flight = 0
+        self.queued = 0
+        self.completed = 0
+        self.failures = 0
+        self.ejections = 0
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+        # /api/ps 返回的已加载（在显存/内存中）模型，与 /api/tags 返回的本地可用模型
+        self.loaded_models: Set[str] = set()
+        self.available_models: Set[str] = set()
+
+    @property
+    def outstanding(self) -> int:
+        return self.in_flight + self.queued
+
+    def ejected(self, now: float) -> bool:
+        return self.ejected_until > now
+
+    @asynccontextmanager
+    async def slot(self):
+        """
+        获取该后端的一个并发名额；名额不足时在此排队
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.queued += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.queued -= 1
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self.completed += 1
+            self._semaphore.release()
+
+    def record_success(self, model: Optional[str] = None):
+        self.consecutive_failures = 0
+        if model:
+            # 处理过请求后模型即被加载到该后端
+            self.loaded_models.add(model_key(model))
+
+    def record_failure(self, eject_failures: int, eject_seconds: float) -> bool:
+        """
+        记录一次失败，连续失败达到阈值时摘除，返回是否在本次被摘除
+        """
+        self.failures += 1
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= eject_failures and not self.ejected(time.monotonic()):
+            self.ejected_until = time.monotonic() + eject_seconds
+            self.ejections += 1
+            return True
+        return False
+
+    def restore(self):
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "completed": self.completed,
+            "failures": self.failures,
+            "ejections": self.ejections,
+            "healthy": not self.ejected(time.monotonic()),
+            "loaded_models": len(self.loaded_models),
+        }
+
+
+class OllamaClient:
+    """
+    长生命周期的多后端 Ollama HTTP 客户端：
+    - 复用同一个 aiohttp.ClientSession 及其 TCPConnector 连接池（保持 keep-alive）
+    - 每个后端用信号量限制同时处理的请求数；路由到在途+排队请求最少的后端，
+      优先选择已加载所请求模型的后端（未饱和时），避免在冷后端上重新加载模型
+    - 后台定期请求 /api/ps、/api/tags 做健康检查并刷新已加载模型；请求或检查连续失败时摘除后端，
+      摘除期满或健康检查恢复后重新加入；所有后端都被摘除时仍按负载选择（失败开放）
+    - 可选的对冲请求：非流式请求超过近期延迟分位数仍未返回时发往另一个后端，取先成功的结果
+    在 FastAPI 的 startup 钩子中 start()，shutdown 钩子中 close()。
+    """
+
+    def __init__(self, backends: Iterable[str] = None, max_concurrency: int = OLLAMA_MAX_CONCURRENCY,
+                 pool_size: int = OLLAMA_POOL_SIZE, keepalive_timeout: float = OLLAMA_KEEPALIVE_TIMEOUT,
+                 health_interval: float = OLLAMA_HEALTH_INTERVAL, health_timeout: float = OLLAMA_HEALTH_TIMEOUT,
+                 eject_failures: int = OLLAMA_EJECT_FAILURES, eject_seconds: float = OLLAMA_EJECT_SECONDS,
+                 hedge_percentile: Optional[float] = OLLAMA_HEDGE_PERCENTILE,
+                 hedge_min_samples: int = OLLAMA_HEDGE_MIN_SAMPLES, hedge_min_delay: float = OLLAMA_HEDGE_MIN_DELAY,
+                 hedge_max_ratio: float = OLLAMA_HEDGE_MAX_RATIO, max_attempts: int = OLLAMA_MAX_ATTEMPTS):
+        """
+        :param backends: 后端基础地址列表，默认 OLLAMA_BACKENDS
+        :param max_concurrency: 每个后端的最大并发请求数
+        :param health_interval: 健康检查间隔（秒），0 表示不做主动检查
+        :param eject_failures: 连续失败多少次后摘除后端
+        :param eject_seconds: 摘除时长（秒）
+        :param hedge_percentile: 触发对冲的延迟分位数（如 95），None 表示关闭对冲
+        :param hedge_max_ratio: 对冲请求数占非流式请求总数的上限
+        :param max_attempts: 连接失败或 5xx 时最多尝试的后端数
+        """
+        self.max_concurrency = max_concurrency
+        self.pool_size = pool_size
+        self.keepalive_timeout = keepalive_timeout
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self.eject_failures = eject_failures
+        self.eject_seconds = eject_seconds
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_max_ratio = hedge_max_ratio
+        self.max_attempts = max_attempts
+        self.backends = [OllamaBackend(url, max_concurrency) for url in (backends or OLLAMA_BACKENDS)]
+        # 显式指定 api_url 且不属于后端列表时使用的后端（不参与路由与健康检查）
+        self._direct: Dict[str, OllamaBackend] = {}
+        self.session: Optional[aiohttp.ClientSession] = None
+        self._health_task: Optional[asyncio.Task] = None
+        self._rotation = itertools.count()
+        # 近期成功的非流式请求耗时（秒），用于计算对冲延迟
+        self._latencies = deque(maxlen=OLLAMA_LATENCY_WINDOW)
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.retries = 0
+
+    async def start(self):
+        """
+        创建连接池与会话并启动健康检查（需在事件循环中调用）
+        """
+        if self.session is not None and not self.session.closed:
+            return
+        connector = aiohttp.TCPConnector(
+            limit=self.pool_size,
+            limit_per_host=self.pool_size,
+            keepalive_timeout=self.keepalive_timeout,
+            ttl_dns_cache=300,
+        )
+        self.session = aiohttp.ClientSession(connector=connector)
+        for backend in self.backends:
+            backend._semaphore = asyncio.Semaphore(backend.max_concurrency)
+        if self.health_interval and self.health_interval > 0:
+            self._health_task = asyncio.create_task(self._health_loop())
+        logger.info(f"Ollama client started: backends={[b.base_url for b in self.backends]}, "
+                    f"pool_size={self.pool_size}, max_concurrency={self.max_concurrency}, "
+                    f"hedge_percentile={self.hedge_percentile}")
+
+    async def close(self):
+        if self._health_task is not None:
+            self._health_task.cancel()
+            try:
+                await self._health_task
+            except asyncio.CancelledError:
+                pass
+            self._health_task = None
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+            logger.info("Ollama client closed.")
+        self.session = None
+        for backend in self.backends + list(self._direct.values()):
+            backend._semaphore = None
+
+    async def _ensure_session(self) -> aiohttp.ClientSession:
+        if self.session is None or self.session.closed:
+            # 未经过 startup 钩子（例如脚本中直接调用）时按需创建
+            await self.start()
+        return self.session
+
+    def choose(self, model: Optional[str] = None, exclude: Iterable[OllamaBackend] = ()) -> Optional[OllamaBackend]:
+        """
+        选择后端：排除已摘除的后端（全部摘除时不排除），未饱和且已加载该模型的后端优先，
+        其次是本地有该模型的后端，在其中选在途+排队请求占并发上限比例最小的；负载相同时轮转
+        """
+        exclude = set(exclude)
+        candidates = [b for b in self.backends if b not in exclude]
+        if not candidates:
+            return None
+        now = time.monotonic()
+        candidates = [b for b in candidates if not b.ejected(now)] or candidates
+        if model:
+            key = model_key(model)
+            warm = [b for b in candidates if key in b.loaded_models and b.outstanding < b.max_concurrency]
+            # 尚未拿到模型列表（available_models 为空）的后端视为可能有该模型
+            candidates = warm or [b for b in candidates
+                                  if not b.available_models or key in b.available_models] or candidates
+        offset = next(self._rotation) % len(candidates)
+        candidates = candidates[offset:] + candidates[:offset]
+        return min(candidates, key=lambda b: b.outstanding / b.max_concurrency)
+
+    def _direct_backend(self, api_url: str) -> OllamaBackend:
+        for backend in self.backends:
+            if backend.chat_url == api_url:
+                return backend
+        backend = self._direct.get(api_url)
+        if backend is None:
+            base_url = api_url[:-len(CHAT_PATH)] if api_url.endswith(CHAT_PATH) else api_url
+            backend = self._direct[api_url] = OllamaBackend(base_url, self.max_concurrency, chat_url=api_url)
+        return backend
+
+    def _record_failure(self, backend: OllamaBackend, error: BaseException):
+        if not _retryable(error):
+            return
+        if backend.record_failure(self.eject_failures, self.eject_seconds):
+            logger.warning(f"Ollama backend {backend.base_url} ejected for {self.eject_seconds}s "
+                           f"after {backend.consecutive_failures} consecutive failures: {error!r}")
+
+    def hedge_delay(self) -> Optional[float]:
+        """
+        对冲等待时间：近期成功请求耗时的 hedge_percentile 分位数；样本不足或未开启时返回 None
+        """
+        if self.hedge_percentile is None or len(self._latencies) < self.hedge_min_samples:
+            return None
+        ordered = sorted(self._latencies)
+        index = min(len(ordered) - 1, int(len(ordered) * self.hedge_percentile / 100))
+        return max(self.hedge_min_delay, ordered[index])
+
+    async def _post(self, backend: OllamaBackend, request_data: dict, timeout: float) -> dict:
+        session = await self._ensure_session()
+        start = time.perf_counter()
+        try:
+            async with backend.slot():
+                async with session.post(backend.chat_url, json=request_data,
+                                        timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                    response.raise_for_status()
+                    result = await response.json()
+        except asyncio.CancelledError:
+            # 对冲请求中落后的一方被取消，不计为后端失败
+            raise
+        except Exception as e:
+            self._record_failure(backend, e)
+            raise
+        backend.record_success(request_data.get("model"))
+        self._latencies.append(time.perf_counter() - start)
+        return result
+
+    async def _hedged(self, primary: OllamaBackend, request_data: dict, timeout: float,
+                      tried: Set[OllamaBackend]) -> dict:
+        """
+        向 primary 发送请求；超过对冲延迟仍未返回时再发往另一个后端，返回先成功的结果并取消另一个
+        """
+        tried.add(primary)
+        tasks = {asyncio.ensure_future(self._post(primary, request_data, timeout)): primary}
+        try:
+            delay = self.hedge_delay()
+            if delay is not None:
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                if not done and self.hedges < self.hedge_max_ratio * self.requests:
+                    hedge = self.choose(request_data.get("model"), exclude=tried)
+                    if hedge is not None:
+                        tried.add(hedge)
+                        self.hedges += 1
+                        tasks[asyncio.ensure_future(self._post(hedge, request_data, timeout))] = hedge
+            pending = set(tasks)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if tasks[task] is not primary:
+                            self.hedge_wins += 1
+                        return task.result()
+                    error = error or task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    async def complete(self, request_data: dict, timeout: float, api_url: Optional[str] = None) -> dict:
+        """
+        发送非流式请求并返回响应 JSON：按负载与模型路由、可选对冲，连接失败或 5xx 时换后端重试
+        """
+        self.requests += 1
+        if api_url is not None:
+            return await self._post(self._direct_backend(api_url), request_data, timeout)
+        tried: Set[OllamaBackend] = set()
+        error = None
+        for attempt in range(self.max_attempts):
+            backend = self.choose(request_data.get("model"), exclude=tried)
+            if backend is None:
+                break
+            if attempt:
+                self.retries += 1
+            try:
+                return await self._hedged(backend, request_data, timeout, tried)
+            except Exception as e:
+                if not _retryable(e):
+                    raise
+                error = e
+        raise error or aiohttp.ClientConnectionError("no Ollama backend available")
+
+    @asynccontextmanager
+    async def stream(self, request_data: dict, timeout: float, backend: OllamaBackend):
+        """
+        在 backend 上发起流式请求，返回响应对象；失败计入该后端的健康状态
+        """
+        session = await self._ensure_session()
+        try:
+            async with backend.slot():
+                async with session.post(backend.chat_url, json=request_data,
+                                        timeout=aiohttp.ClientTimeout(total=None, sock_read=timeout)) as response:
+                    response.raise_for_status()
+                    yield response
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._record_failure(backend, e)
+            raise
+        backend.record_success(request_data.get("model"))
+
+    async def _stream_chunks(self, request_data: dict, timeout: float, backend: OllamaBackend) -> AsyncIterator[str]:
+        """
+        在 backend 上发起一次流式请求，解析 SSE（data: {...}，以 data: [DONE] 结束）并逐段产出内容；
+        已产出内容但没有收到 [DONE] / finish_reason 就结束时抛出 ClientPayloadError（计入该后端的失败）
+        """
+        finished = False
+        produced = False
+        async with self.stream(request_data, timeout, backend) as response:
+            async for raw_line in response.content:
+                line = raw_line.decode("utf-8").strip()
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    finished = True
+                    break
+                chunk = json.loads(data)
+                choices = chunk.get("choices") or []
+                if not choices:
+                    continue
+                if choices[0].get("finish_reason"):
+                    finished = True
+                content = (choices[0].get("delta") or {}).get("content")
+                if content:
+                    produced = True
+                    yield content
+            if produced and not finished:
+                # 连接被正常关闭但没有结束标记：按中途断开处理
+                raise aiohttp.ClientPayloadError("stream ended without [DONE]")
+
+    async def stream_with_retry(self, request_data: dict, timeout: float,
+                                api_url: Optional[str] = None) -> AsyncIterator[str]:
+        """
+        发送流式请求并逐段产出生成的内容：按负载与模型路由（不做对冲），在产出第一段内容之前连接失败、
+        超时或 5xx 时换后端重试，全部失败时抛出最后一个错误。
+        已产出内容后中断时抛出 OllamaStreamError：部分内容已交给调用方，不能再换后端重新生成
+        """
+        tried: Set[OllamaBackend] = set()
+        error = None
+        for attempt in range(1 if api_url is not None else self.max_attempts):
+            backend = self._direct_backend(api_url) if api_url is not None else \
+                self.choose(request_data.get("model"), exclude=tried)
+            if backend is None:
+                break
+            if attempt:
+                self.retries += 1
+            tried.add(backend)
+            produced = False
+            try:
+                async for content in self._stream_chunks(request_data, timeout, backend):
+                    produced = True
+                    yield content
+                return
+            except Exception as e:
+                logger.error(f"流式调用 Ollama API 出错（{backend.base_url}）: {e!r}")
+                if produced:
+                    raise OllamaStreamError(f"stream interrupted after partial output: {e!r}") from e
+                if not _retryable(e):
+                    raise
+                error = e
+        raise error or aiohttp.ClientConnectionError("no Ollama backend available")
+
+    async def _check(self, backend: OllamaBackend):
+        session = await self._ensure_session()
+        client_timeout = aiohttp.ClientTimeout(total=self.health_timeout)
+        try:
+            async with session.get(f"{backend.base_url}/api/tags", timeout=client_timeout) as response:
+                response.raise_for_status()
+                available = (await response.json()).get("models") or []
+            # 较早的 Ollama 没有 /api/ps，此时只依据处理过的请求推断已加载模型
+            async with session.get(f"{backend.base_url}/api/ps", timeout=client_timeout) as response:
+                loaded = None
+                if response.status == 200:
+                    loaded = (await response.json()).get("models") or []
+        except Exception as e:
+            self._record_failure(backend, e if _retryable(e) else aiohttp.ClientConnectionError(str(e)))
+            return
+        backend.available_models = {model_key(m.get("name") or m.get("model", "")) for m in available}
+        if loaded is not None:
+            backend.loaded_models = {model_key(m.get("name") or m.get("model", "")) for m in loaded}
+        if backend.ejected(time.monotonic()) or backend.consecutive_failures:
+            logger.info(f"Ollama backend {backend.base_url} healthy again")
+        backend.restore()
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.gather(*(self._check(backend) for backend in self.backends))
+            await asyncio.sleep(self.health_interval)
+
+    def stats(self) -> dict:
+        backends = [b.stats() for b in self.backends]
+        return {
+            "in_flight": sum(b["in_flight"] for b in backends),
+            "queued": sum(b["queued"] for b in backends),
+            "completed": sum(b["completed"] for b in backends),
+            "requests": self.requests,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "retries": self.retries,
+            "healthy_backends": sum(b["healthy"] for b in backends),
+            "max_concurrency": self.max_concurrency,
+            "pool_size": self.pool_size,
+            "backends": {backend.name: s for backend, s in zip(self.backends, backends)},
+        }
+
+
+ollama_client = OllamaClient()
 
 async def call_ollama(
     messages: List[Dict[str, str]],
     model: str = "en2.5-3bnsfw",
     temperature: float = 0.7,
     top_p: Optional[float] = None,
-    api_url: str = DEFAULT_OLLAMA_API_URL,
+    api_url: Optional[str] = None,
     timeout: int = 20
 ) -> Optional[str]:
     """
     异步调用 Ollama API 并返回生成的响应内容。
+    未指定 api_url 时经由 ollama_client 在各后端间路由（可能对冲、换后端重试）。
     """
     try:
         # 参数验证
         if not isinstance(messages, list) or not all(
             isinstance(msg, dict) and "role" in msg and "content" in msg for msg in messages
         ):
-            logger.error(f"Invalid messages format: {messages}")
+            logger.error(f"Invalid messages format: {preview(messages)}")
             return "请求参数格式错误。"
 
         # 构建请求数据
@@ -41,22 +519,21 @@ async def call_ollama(
         if top_p is not None:
             request_data["top_p"] = top_p
 
-        # 打印请求数据
-        logger.info(f"Request payload: {request_data}")
+        # 打印请求数据（按采样率记录，载荷截断）
+        if sample("payload"):
+            logger.info(f"Request payload: {preview(request_data)}", extra={"category": "payload"})
 
-        # 发送异步请求
-        async with aiohttp.ClientSession() as session:
-            async with session.post(api_url, json=request_data, timeout=timeout) as response:
-                response.raise_for_status()
-                response_json = await response.json()
+        # 发送异步请求（复用连接池，受各后端并发上限约束）
+        response_json = await ollama_client.complete(request_data, timeout, api_url)
 
-                # 解析响应
-                logger.info(f"Response from API: {response_json}")
-                if "choices" in response_json and len(response_json["choices"]) > 0:
-                    return response_json["choices"][0]["message"]["content"]
-                else:
-                    logger.error(f"Unexpected response format: {response_json}")
-                    return "抱歉，我暂时无法回答您的问题。"
+        # 解析响应
+        if sample("payload"):
+            logger.info(f"Response from API: {preview(response_json)}", extra={"category": "payload"})
+        if "choices" in response_json and len(response_json["choices"]) > 0:
+            return response_json["choices"][0]["message"]["content"]
+        else:
+            logger.error(f"Unexpected response format: {preview(response_json)}")
+            return "抱歉，我暂时无法回答您的问题。"
 
     except aiohttp.ClientError as e:
         logger.error(f"调用 Ollama API 出错: {e}")
@@ -65,3 +542,49 @@ async def call_ollama(
     except Exception as e:
         logger.error(f"未知错误: {e}")
         return "抱歉，我暂时无法回答您的问题。"
+
+
+async def stream_ollama(
+    messages: List[Dict[str, str]],
+    model: str = "en2.5-3bnsfw",
+    temperature: float = 0.7,
+    top_p: Optional[float] = None,
+    api_url: Optional[str] = None,
+    timeout: int = 20
+) -> AsyncIterator[str]:
+    """
+    以流式方式异步调用 Ollama API，逐段产出生成的内容。
+    Ollama 的 OpenAI 兼容接口在 stream=True 时返回 SSE（data: {...}），以 data: [DONE] 结束。
+    timeout 为相邻两个数据块之间的最长等待时间，而不是整个生成过程的时长。
+    路由与重试见 OllamaClient.stream_with_retry；产出第一段内容之前全部失败时以兜底文本结束，
+    已产出内容后中断（出错，或没有收到 [DONE] / finish_reason 就结束）时抛出 OllamaStreamError。
+    """
+    # 参数验证
+    if not isinstance(messages, list) or not all(
+        isinstance(msg, dict) and "role" in msg and "content" in msg for msg in messages
+    ):
+        logger.error(f"Invalid messages format: {preview(messages)}")
+        yield "请求参数格式错误。"
+        return
+
+    # 构建请求数据
+    request_data = {
+        "model": model,
+        "messages": messages,
+        "stream": True,
+        "temperature": temperature,
+    }
+    if top_p is not None:
+        request_data["top_p"] = top_p
+
+    if sample("payload"):
+        logger.info(f"Streaming request payload: {preview(request_data)}", extra={"category": "payload"})
+
+    try:
+        async for content in ollama_client.stream_with_retry(request_data, timeout, api_url):
+            yield content
+    except OllamaStreamError:
+        raise
+    except Exception as e:
+        logger.error(f"流式调用 Ollama API 失败: {e!r}")
+        yield "抱歉，我暂时无法回答您的问题。"
@@ -0,0 +1,131 @@
+import heapq
+import itertools
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Optional
+
+import faiss
+import numpy as np
+
+from logger import logger  # 日志模块
+
+
+class SemanticCache:
+    """
+    语义响应缓存：用嵌入模型编码用户输入，在专用的小型内积索引中查找
+    语义最相近的已回答问题，相似度超过阈值时直接返回缓存的回答。
+    - 按命名空间（例如 用户 + 模型）隔离，各自一个 IndexIDMap2(IndexFlatIP)
+    - 每条记录有 TTL，过期记录由最小堆按到期时间淘汰
+    - 超过容量时按 LRU 淘汰
+    """
+
+    def __init__(self, embed_fn: Callable[[str], np.ndarray], dimension: int, threshold: float = 0.95,
+                 ttl: int = 3600, max_entries: int = 10000):
+        """
+        :param embed_fn: 文本 -> 向量 的函数（复用 VectorStore 的嵌入模型）
+        :param dimension: 向量维度
+        :param threshold: 余弦相似度阈值，达到该值才视为命中
+        :param ttl: 默认的记录生存时间（秒）
+        :param max_entries: 最多保存的记录数
+        """
+        self.embed_fn = embed_fn
+        self.dimension = dimension
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._indexes: Dict[str, faiss.IndexIDMap2] = {}
+        self._entries = OrderedDict()  # id -> 记录，按最近使用排序
+        self._expiry = []  # (到期时间, id) 最小堆
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        # 统计信息
+        self.lookups = 0
+        self.hits = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _embed(self, text: str) -> np.ndarray:
+        vector = np.asarray(self.embed_fn(text), dtype="float32").reshape(1, self.dimension).copy()
+        faiss.normalize_L2(vector)  # 归一化后内积即余弦相似度
+        return vector
+
+    def _remove(self, entry_id: int):
+        entry = self._entries.pop(entry_id, None)
+        if entry is None:
+            return
+        index = self._indexes.get(entry["namespace"])
+        if index is not None:
+            index.remove_ids(np.array([entry_id], dtype="int64"))
+            if index.ntotal == 0:
+                del self._indexes[entry["namespace"]]
+
+    def _purge_expired(self, now: float):
+        while self._expiry and self._expiry[0][0] <= now:
+            expires_at, entry_id = heapq.heappop(self._expiry)
+            entry = self._entries.get(entry_id)
+            if entry is not None and entry["expires_at"] == expires_at:
+                self._remove(entry_id)
+                self.expirations += 1
+
+    def lookup(self, namespace: str, prompt: str) -> Optional[str]:
+        """
+        查找语义相近的已回答问题，命中返回缓存的回答，否则返回 None
+        """
+        with self._lock:
+            self.lookups += 1
+            self._purge_expired(time.time())
+            if namespace not in self._indexes:
+                return None
+        vector = self._embed(prompt)
+        with self._lock:
+            index = self._indexes.get(namespace)
+            if index is None or index.ntotal == 0:
+                return None
+            similarities, ids = index.search(vector, 1)
+            entry_id, similarity = int(ids[0][0]), float(similarities[0][0])
+            entry = self._entries.get(entry_id)
+            if entry is None or similarity < self.threshold:
+                return None
+            self._entries.move_to_end(entry_id)
+            self.hits += 1
+        logger.info(f"Semantic cache hit ({similarity:.3f}) for prompt: {prompt[:50]}")
+        return entry["response"]
+
+    def store(self, namespace: str, prompt: str, response: str, ttl: int = None):
+        """
+        写入一条 问题 -> 回答 记录
+        """
+        vector = self._embed(prompt)
+        expires_at = time.time() + (ttl if ttl is not None else self.ttl)
+        with self._lock:
+            self._purge_expired(time.time())
+            entry_id = next(self._ids)
+            index = self._indexes.get(namespace)
+            if index is None:
+                index = faiss.IndexIDMap2(faiss.IndexFlatIP(self.dimension))
+                self._indexes[namespace] = index
+            index.add_with_ids(vector, np.array([entry_id], dtype="int64"))
+            self._entries[entry_id] = {
+                "namespace": namespace, "prompt": prompt, "response": response, "expires_at": expires_at
+            }
+            heapq.heappush(self._expiry, (expires_at, entry_id))
+            while len(self._entries) > self.max_entries:
+                oldest_id = next(iter(self._entries))
+                self._remove(oldest_id)
+                self.evictions += 1
+            # 被 LRU 淘汰的记录仍留在堆中，堆过大时按存活记录重建
+            if len(self._expiry) > 2 * self.max_entries:
+                self._expiry = [(e["expires_at"], i) for i, e in self._entries.items()]
+                heapq.heapify(self._expiry)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "hit_rate": self.hits / self.lookups if self.lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "threshold": self.threshold,
+        }
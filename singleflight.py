@@ -0,0 +1,172 @@
+import asyncio
+import uuid
+from typing import Awaitable, Callable, Dict, Optional
+from logger import logger  # 日志模块
+
+# 比较令牌后再删除，避免误删其他 worker 重新获取的锁
+_RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class LeaderCancelled(Exception):
+    """
+    生成者的请求被取消（例如客户端断开），等待者应自行重新生成
+    """
+
+
+class SingleFlight:
+    """
+    按缓存键合并并发的相同请求：第一个请求负责生成，其余请求等待同一个 Future。
+    - 进程内：以 asyncio.Future 合并
+    - 跨 gunicorn worker（可选）：以 Redis 短期锁选出唯一的生成者，
+      生成者写入缓存后通过 pub/sub 通知其他 worker 从缓存读取结果
+    """
+
+    def __init__(self, redis_client=None, lock_ttl_ms: int = 30000, wait_timeout: float = 60.0):
+        """
+        :param redis_client: asyncio Redis 客户端，为 None 时只在进程内合并
+        :param lock_ttl_ms: 跨 worker 锁的过期时间（毫秒），生成者异常退出时锁会自动释放
+        :param wait_timeout: 等待其他 worker 生成结果的最长时间（秒），超时后本地自行生成
+        """
+        self.redis_client = redis_client
+        self.lock_ttl_ms = lock_ttl_ms
+        self.wait_timeout = wait_timeout
+        self._inflight: Dict[str, asyncio.Future] = {}
+        # 统计信息
+        self.leaders = 0
+        self.local_followers = 0
+        self.remote_followers = 0
+        self.fallbacks = 0
+
+    def inflight(self, key: str) -> Optional[asyncio.Future]:
+        """
+        返回该键正在进行中的生成任务（没有则为 None）
+        """
+        return self._inflight.get(key)
+
+    def begin(self, key: str) -> asyncio.Future:
+        """
+        登记为该键的生成者，返回其他请求将等待的 Future
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        self.leaders += 1
+        return future
+
+    def finish(self, key: str, result=None, error: BaseException = None):
+        """
+        结束生成：唤醒所有等待者
+        """
+        future = self._inflight.pop(key, None)
+        if future is None or future.done():
+            return
+        if isinstance(error, (asyncio.CancelledError, GeneratorExit)):
+            error = LeaderCancelled(key)
+        if error is not None:
+            future.set_exception(error)
+            future.exception()  # 没有等待者时避免 "exception was never retrieved" 警告
+        else:
+            future.set_result(result)
+
+    async def wait(self, future: asyncio.Future):
+        self.local_followers += 1
+        return await asyncio.shield(future)
+
+    async def do(self, key: str, fn: Callable[[], Awaitable], lookup: Callable[[], Awaitable] = None):
+        """
+        对同一个键只执行一次 fn，并发的相同调用共享其结果。
+        :param fn: 生成结果的协程函数（负责写入缓存）
+        :param lookup: 从共享缓存读取结果的协程函数，用于跨 worker 合并；返回 None 表示未命中
+        """
+        future = self.inflight(key)
+        while future is not None:
+            try:
+                return await self.wait(future)
+            except LeaderCancelled:
+                future = self.inflight(key)
+
+        self.begin(key)
+        try:
+            if self.redis_client is not None and lookup is not None:
+                result = await self._do_across_workers(key, fn, lookup)
+            else:
+                result = await fn()
+        except BaseException as e:
+            self.finish(key, error=e)
+            raise
+        self.finish(key, result)
+        return result
+
+    async def _do_across_workers(self, key: str, fn, lookup):
+        lock_key = f"singleflight:lock:{key}"
+        channel = f"singleflight:done:{key}"
+        token = uuid.uuid4().hex
+        try:
+            acquired = await self.redis_client.set(lock_key, token, nx=True, px=self.lock_ttl_ms)
+        except Exception as e:
+            logger.error(f"Single-flight lock error for key {key}: {e}")
+            return await fn()
+
+        if acquired:
+            try:
+                return await fn()
+            finally:
+                try:
+                    await self.redis_client.publish(channel, "1")
+                    await self.redis_client.eval(_RELEASE_LOCK_SCRIPT, 1, lock_key, token)
+                except Exception as e:
+                    logger.error(f"Single-flight release error for key {key}: {e}")
+
+        # 其他 worker 正在生成：等待通知后从缓存读取
+        self.remote_followers += 1
+        result = await self._wait_remote(lock_key, channel, lookup)
+        if result is not None:
+            logger.info(f"Single-flight shared result from another worker for key: {key}")
+            return result
+        self.fallbacks += 1
+        logger.warning(f"Single-flight wait failed for key {key}, generating locally")
+        return await fn()
+
+    async def _wait_remote(self, lock_key: str, channel: str, lookup):
+        loop = asyncio.get_running_loop()
+        try:
+            pubsub = self.redis_client.pubsub(ignore_subscribe_messages=True)
+            await pubsub.subscribe(channel)
+        except Exception as e:
+            logger.error(f"Single-flight subscribe error for {channel}: {e}")
+            return None
+        try:
+            # 订阅前生成者可能已经完成，先查一次缓存
+            result = await lookup()
+            if result is not None:
+                return result
+            deadline = loop.time() + self.wait_timeout
+            while loop.time() < deadline:
+                message = await pubsub.get_message(timeout=1.0)
+                if message is not None:
+                    break
+                # 锁已不存在（生成者结束或异常退出），不再等待通知
+                if not await self.redis_client.exists(lock_key):
+                    break
+            return await lookup()
+        except Exception as e:
+            logger.error(f"Single-flight wait error for {channel}: {e}")
+            return None
+        finally:
+            try:
+                await pubsub.reset()
+            except Exception:
+                pass
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._inflight),
+            "leaders": self.leaders,
+            "local_followers": self.local_followers,
+            "remote_followers": self.remote_followers,
+            "fallbacks": self.fallbacks,
+        }
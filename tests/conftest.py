@@ -0,0 +1,31 @@
+import hashlib
+import os
+import sys
+import tempfile
+
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# 各模块在导入时使用相对路径（logs/、chat_history.db、vector_store/），测试在临时目录中运行，不改动仓库中的数据
+os.chdir(tempfile.mkdtemp(prefix="llmb_tests_"))
+
+
+@pytest.fixture
+def fake_embeddings(monkeypatch):
+    """
+    用确定性的伪嵌入代替模型：相同文本得到相同的单位向量，不需要加载模型
+    """
+    from vector_store import VectorStore
+
+    def encode(self, texts):
+        vectors = []
+        for text in texts:
+            seed = int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "little")
+            vector = np.random.default_rng(seed).standard_normal(self.dimension).astype("float32")
+            vectors.append(vector / np.linalg.norm(vector))
+        return np.vstack(vectors)
+
+    monkeypatch.setattr(VectorStore, "_encode_batch", encode)
@@ -0,0 +1,56 @@
+"""
+ContextBuilder.build 的 token 预算：最近轮次从新到旧放入直到预算用完，检索到的更早轮次整轮放入或跳过，总量不超过预算
+"""
+import os
+import tempfile
+
+import pytest
+
+pytest.importorskip("faiss")
+
+from context_builder import MESSAGE_OVERHEAD_TOKENS, ContextBuilder
+from vector_store import VectorStore
+
+TURNS = 5
+# 每条消息 6 个字符，按 1 字符 1 token 计数时每条消息占 6 + MESSAGE_OVERHEAD_TOKENS
+MESSAGE_COST = 6 + MESSAGE_OVERHEAD_TOKENS
+
+
+@pytest.fixture
+def store(fake_embeddings):
+    path = os.path.join(tempfile.mkdtemp(prefix="llmb_context_"), "vector_store")
+    store = VectorStore(save_path=path, preload_model=False, embedding_cache_size=0)
+    for i in range(TURNS):
+        message_id = store.append_message("alice", "user", f"q{i}-abc")
+        store.append_message("alice", "assistant", f"a{i}-abc")
+        store.index_messages([("alice", message_id, f"q{i}-abc")])
+    yield store
+    store.close()
+
+
+def build(store, max_tokens, recent_turns=2, retrieve_k=1):
+    builder = ContextBuilder(store, max_tokens=max_tokens, recent_turns=recent_turns, retrieve_k=retrieve_k,
+                             token_counter=len)
+    # 当前输入与第 0 轮的问题相同，检索必然命中第 0 轮
+    return [m["content"] for m in builder.build("alice", "q0-abc")]
+
+
+def test_recent_turns_and_retrieved_turn_fill_the_budget(store):
+    # 当前输入 1 条 + 最近 2 轮 4 条 + 检索到的 1 轮 2 条，恰好用完预算
+    context = build(store, max_tokens=7 * MESSAGE_COST)
+    assert context == ["q0-abc", "a0-abc", "q3-abc", "a3-abc", "q4-abc", "a4-abc"]
+
+
+def test_retrieved_turn_is_skipped_when_it_does_not_fit(store):
+    context = build(store, max_tokens=7 * MESSAGE_COST - 1)
+    assert context == ["q3-abc", "a3-abc", "q4-abc", "a4-abc"]
+
+
+def test_recent_window_is_cut_from_the_oldest_message(store):
+    # 预算只够 3 条最近消息：最早的问题被截掉，只剩它的回答
+    context = build(store, max_tokens=4 * MESSAGE_COST + MESSAGE_COST // 2)
+    assert context == ["a3-abc", "q4-abc", "a4-abc"]
+
+
+def test_no_history_when_input_exhausts_the_budget(store):
+    assert build(store, max_tokens=MESSAGE_COST) == []
@@ -0,0 +1,43 @@
+"""
+进程在追加日志时崩溃、最后一行只写了一半：重启后截断不完整的行，之前的消息全部恢复，之后的追加正常
+"""
+import os
+import tempfile
+
+from vector_store import ConversationJournal
+
+
+def open_journal(path):
+    journal = ConversationJournal(path)
+    conversation_data, digests = journal.load()
+    return journal, conversation_data, digests
+
+
+def test_truncated_last_line_is_dropped_on_replay():
+    path = tempfile.mkdtemp(prefix="llmb_recovery_")
+    journal, _, _ = open_journal(path)
+    contents = ["我叫爱丽丝", "你好，爱丽丝", "我住在上海"]
+    for i, content in enumerate(contents):
+        journal.append("alice", {"role": "user" if i % 2 == 0 else "assistant", "content": content})
+    journal.close()
+    intact_size = os.path.getsize(journal.journal_path)
+
+    # 模拟写到一半时崩溃
+    with open(journal.journal_path, "ab") as f:
+        f.write('{"seq": 4, "user_id": "alice", "message": {"role": "assistant", "content": "上海'.encode("utf-8"))
+
+    journal, conversation_data, digests = open_journal(path)
+    try:
+        assert [m["content"] for m in conversation_data["alice"]] == contents
+        assert [m["id"] for m in conversation_data["alice"]] == [1, 2, 3]
+        assert "alice" in digests
+        assert os.path.getsize(journal.journal_path) == intact_size
+        # 不完整的记录没有占用序号，新追加的行也不会接在残行后面
+        assert journal.append("alice", {"role": "assistant", "content": "上海很大"}) == 4
+    finally:
+        journal.close()
+
+    journal, conversation_data, _ = open_journal(path)
+    journal.close()
+    assert [m["content"] for m in conversation_data["alice"]] == contents + ["上海很大"]
+    assert [m["id"] for m in conversation_data["alice"]] == [1, 2, 3, 4]
@@ -0,0 +1,76 @@
+"""
+旧版快照（整个 conversation_data 字典直接 pickle、消息没有 ID）加载后重新编号，用户消息重新写入分区索引
+"""
+import json
+import os
+import pickle
+import tempfile
+
+import pytest
+
+pytest.importorskip("faiss")
+
+from vector_store import REINDEX_MARKER, VectorStore
+
+
+def open_store(path):
+    return VectorStore(save_path=path, preload_model=False, embedding_cache_size=0)
+
+
+def write_legacy(path, conversation_data, journal=()):
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, "conversation_data.pkl"), "wb") as f:
+        pickle.dump(conversation_data, f)
+    # 升级后、修复前追加的日志：序号从 1 开始，与旧消息重新编号后的 ID 冲突
+    with open(os.path.join(path, "conversation_journal.jsonl"), "w", encoding="utf-8") as f:
+        for seq, (user_id, role, content) in enumerate(journal, 1):
+            message = {"role": role, "content": content, "id": seq}
+            f.write(json.dumps({"seq": seq, "user_id": user_id, "message": message}, ensure_ascii=False) + "\n")
+
+
+def test_legacy_snapshot_is_renumbered_and_indexed(fake_embeddings):
+    path = os.path.join(tempfile.mkdtemp(prefix="llmb_legacy_"), "vector_store")
+    write_legacy(path, {
+        "alice": [{"role": "user", "content": "我叫爱丽丝"}, {"role": "assistant", "content": "你好，爱丽丝"}],
+        "bob": [{"role": "user", "content": "我喜欢猫"}, {"role": "assistant", "content": "猫很可爱"}],
+    }, journal=[("alice", "user", "我住在上海"), ("alice", "assistant", "上海很大")])
+
+    store = open_store(path)
+    try:
+        alice = store.conversation_data["alice"]
+        assert [m["content"] for m in alice] == ["我叫爱丽丝", "你好，爱丽丝", "我住在上海", "上海很大"]
+        # 每个用户内 ID 随时间递增，全局唯一
+        ids = [m["id"] for messages in store.conversation_data.values() for m in messages]
+        assert sorted(ids) == list(range(1, 7))
+        assert [m["id"] for m in alice] == sorted(m["id"] for m in alice)
+        # 旧消息与日志中的用户消息都能被检索到，并映射回正确的消息
+        assert store.index.ntotal == 3
+        assert store.search("alice", "我叫爱丽丝", top_k=1)[0]["content"] == "我叫爱丽丝"
+        assert store.search("bob", "我喜欢猫", top_k=1)[0]["content"] == "我喜欢猫"
+        assert not os.path.exists(os.path.join(path, REINDEX_MARKER))
+        assert store.append_message("bob", "user", "新消息") == 7
+    finally:
+        store.close()
+
+    # 迁移结果已落盘：重新加载不再迁移，ID 保持不变
+    store = open_store(path)
+    try:
+        assert [m["id"] for m in store.conversation_data["bob"]] == [5, 6, 7]
+        assert store.index.ntotal == 3
+    finally:
+        store.close()
+
+
+def test_interrupted_reindex_resumes(fake_embeddings):
+    path = os.path.join(tempfile.mkdtemp(prefix="llmb_legacy_"), "vector_store")
+    write_legacy(path, {"alice": [{"role": "user", "content": "你好"}, {"role": "assistant", "content": "你好"}]})
+    open_store(path).close()
+    # 模拟重建索引中途退出：标记文件仍在
+    open(os.path.join(path, REINDEX_MARKER), "w").close()
+
+    store = open_store(path)
+    try:
+        assert store.index.ntotal == 1
+        assert not os.path.exists(os.path.join(path, REINDEX_MARKER))
+    finally:
+        store.close()
@@ -0,0 +1,58 @@
+"""
+JSON 日志行的结构：经由异步队列写出后每条日志一行 JSON，包含固定字段、category、fields 与异常堆栈
+"""
+import io
+import json
+import logging
+import os
+
+from logger import AsyncLogHandler, JsonFormatter
+
+
+def write_logs(emit, max_message_chars=2000):
+    stream = io.StringIO()
+    target = logging.StreamHandler(stream)
+    target.setFormatter(JsonFormatter())
+    handler = AsyncLogHandler([target], max_message_chars=max_message_chars)
+    test_logger = logging.getLogger("llmb_test_json")
+    test_logger.addHandler(handler)
+    test_logger.setLevel(logging.INFO)
+    test_logger.propagate = False
+    try:
+        emit(test_logger)
+    finally:
+        handler.stop()
+        test_logger.removeHandler(handler)
+    return [json.loads(line) for line in stream.getvalue().splitlines()]
+
+
+def test_json_log_line_shape():
+    def emit(log):
+        log.info("Chat request from %s", "alice", extra={"category": "payload", "fields": {"user_id": "alice"}})
+        log.warning("x" * 60)
+        try:
+            raise ValueError("bad input")
+        except ValueError:
+            log.exception("Request failed")
+
+    info, warning, error = write_logs(emit, max_message_chars=30)
+
+    assert list(info) == ["ts", "level", "logger", "pid", "msg", "category", "user_id"]
+    assert info["level"] == "INFO"
+    assert info["logger"] == "llmb_test_json"
+    assert info["pid"] == os.getpid()
+    assert info["msg"] == "Chat request from alice"
+    assert info["category"] == "payload"
+    assert info["user_id"] == "alice"
+    # 毫秒精度的本地时间
+    assert len(info["ts"]) == len("2024-01-01T00:00:00.000") and info["ts"][10] == "T"
+
+    # 过长的消息被截断并附上原长度；没有 category/fields 时不输出这两项
+    assert list(warning) == ["ts", "level", "logger", "pid", "msg"]
+    assert warning["msg"].startswith("x" * 30 + "…(+30 chars")
+
+    # 异常堆栈单独放在 exc 字段，不并入（也不随之被截断）msg
+    assert error["level"] == "ERROR"
+    assert error["msg"] == "Request failed"
+    assert error["exc"].startswith("Traceback (most recent call last):")
+    assert error["exc"].endswith("ValueError: bad input")
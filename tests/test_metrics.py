@@ -0,0 +1,75 @@
+"""
+/metrics 输出的 Prometheus 文本格式：HELP/TYPE 头、标签转义、直方图累计分桶，以及 stats() 导出的 counter/gauge
+"""
+import re
+
+from metrics import MetricsRegistry
+
+# 指标名{标签} 值
+SAMPLE_RE = re.compile(r'^[a-zA-Z_:][a-zA-Z0-9_:]*(\{([a-zA-Z_][a-zA-Z0-9_]*="(\\.|[^"\\])*",?)*\})? \S+$')
+
+
+def render(registry):
+    text = registry.render()
+    assert text.endswith("\n")
+    lines = text.splitlines()
+    for line in lines:
+        # 注释行（含 HELP/TYPE）或样本行
+        assert line.startswith("# ") or SAMPLE_RE.match(line), line
+    return lines
+
+
+def test_counter_and_histogram_format():
+    registry = MetricsRegistry()
+    requests = registry.counter("llmb_chat_requests_total", "Chat completion requests by cache result", ("cache",))
+    requests.inc(cache="hit")
+    requests.inc(2, cache='mi"ss\n')
+    stage = registry.histogram("llmb_stage_duration_seconds", "Time spent in each request stage", ("stage",),
+                               buckets=(0.01, 0.1, 1.0))
+    stage.observe(0.005, stage="ollama")
+    stage.observe(0.1, stage="ollama")
+    stage.observe(2.5, stage="ollama")
+
+    assert render(registry) == [
+        "# HELP llmb_chat_requests_total Chat completion requests by cache result",
+        "# TYPE llmb_chat_requests_total counter",
+        'llmb_chat_requests_total{cache="hit"} 1',
+        'llmb_chat_requests_total{cache="mi\\"ss\\n"} 2',
+        "# HELP llmb_stage_duration_seconds Time spent in each request stage",
+        "# TYPE llmb_stage_duration_seconds histogram",
+        'llmb_stage_duration_seconds_bucket{stage="ollama",le="0.01"} 1',
+        'llmb_stage_duration_seconds_bucket{stage="ollama",le="0.1"} 2',
+        'llmb_stage_duration_seconds_bucket{stage="ollama",le="1"} 2',
+        'llmb_stage_duration_seconds_bucket{stage="ollama",le="+Inf"} 3',
+        'llmb_stage_duration_seconds_sum{stage="ollama"} 2.605',
+        'llmb_stage_duration_seconds_count{stage="ollama"} 3',
+    ]
+
+
+def test_stats_collectors_export_counters_and_gauges():
+    registry = MetricsRegistry()
+    registry.register_stats("llmb_response_cache", lambda: {
+        "l1_hits": 3, "hit_rate": 0.75, "redis_available": False, "backend": "redis",
+        "latency": {"p50": 0.5},
+    }, "Response cache", counters=("l1_hits",))
+
+    def broken():
+        raise RuntimeError("boom")
+
+    registry.register_stats("llmb_broken", broken)
+
+    assert render(registry) == [
+        "# HELP llmb_response_cache_l1_hits_total Response cache l1_hits",
+        "# TYPE llmb_response_cache_l1_hits_total counter",
+        "llmb_response_cache_l1_hits_total 3",
+        "# HELP llmb_response_cache_hit_rate Response cache hit_rate",
+        "# TYPE llmb_response_cache_hit_rate gauge",
+        "llmb_response_cache_hit_rate 0.75",
+        "# HELP llmb_response_cache_redis_available Response cache redis_available",
+        "# TYPE llmb_response_cache_redis_available gauge",
+        "llmb_response_cache_redis_available 0",
+        "# HELP llmb_response_cache_latency_p50 Response cache latency_p50",
+        "# TYPE llmb_response_cache_latency_p50 gauge",
+        "llmb_response_cache_latency_p50 0.5",
+        "# collector llmb_broken failed: boom",
+    ]
@@ -0,0 +1,49 @@
+"""
+按用户分区的索引：两个用户交替写入，检索命中只来自本用户的分区，并映射回正确的消息 ID；重新加载后映射不变
+"""
+import os
+import tempfile
+
+import pytest
+
+pytest.importorskip("faiss")
+
+from vector_store import VectorStore
+
+
+def open_store(path):
+    return VectorStore(save_path=path, preload_model=False, embedding_cache_size=0)
+
+
+def test_ids_map_back_to_each_users_messages(fake_embeddings):
+    path = os.path.join(tempfile.mkdtemp(prefix="llmb_partitions_"), "vector_store")
+    store = open_store(path)
+    try:
+        # 交替写入，ID 在两个用户之间穿插；两人都说过同一句话
+        turns = [("alice", "我喜欢猫", "猫很可爱"), ("bob", "我喜欢猫", "我也喜欢"),
+                 ("alice", "我住在上海", "上海很大"), ("bob", "我住在北京", "北京很冷")]
+        message_ids = {}
+        for user_id, question, answer in turns:
+            message_id = store.append_message(user_id, "user", question)
+            store.append_message(user_id, "assistant", answer)
+            store.index_messages([(user_id, message_id, question)])
+            message_ids[(user_id, question)] = message_id
+        assert store.index.get_partition("alice").ntotal == 2
+        assert store.index.get_partition("bob").ntotal == 2
+    finally:
+        store.close()
+
+    store = open_store(path)
+    try:
+        for user_id in ("alice", "bob"):
+            hit = store.search(user_id, "我喜欢猫", top_k=1)[0]
+            assert hit["id"] == message_ids[(user_id, "我喜欢猫")]
+            # 命中的消息属于检索的用户，所在一轮对话是该用户自己的回复
+            assert hit in store.conversation_data[user_id]
+        assert [m["content"] for m in store.get_turn(message_ids[("bob", "我喜欢猫")])] == ["我喜欢猫", "我也喜欢"]
+        # 每个分区只含本用户的消息：即使 top_k 超过分区大小，也不会命中另一用户的消息
+        alice_hits = store.search("alice", "我住在北京", top_k=10)
+        assert {m["content"] for m in alice_hits} == {"我喜欢猫", "我住在上海"}
+        assert store.search("carol", "我喜欢猫") == []
+    finally:
+        store.close()
@@ -0,0 +1,59 @@
+"""
+Redis 不可用时响应缓存继续由 L1 命中；出错后在 retry_interval 内不再访问 Redis，之后恢复
+"""
+import asyncio
+
+from redis.exceptions import ConnectionError
+
+from cache import ResponseCache
+
+
+class DownRedis:
+    """
+    每次调用都连接失败的 Redis 客户端，记录调用次数
+    """
+
+    def __init__(self):
+        self.calls = 0
+
+    async def get(self, key):
+        self.calls += 1
+        raise ConnectionError("Connection refused")
+
+    async def setex(self, key, ttl, value):
+        self.calls += 1
+        raise ConnectionError("Connection refused")
+
+    def pipeline(self, transaction=True):
+        self.calls += 1
+        raise ConnectionError("Connection refused")
+
+
+def test_l1_serves_hits_while_redis_is_down():
+    async def run():
+        cache = ResponseCache(retry_interval=60)
+        redis = cache.redis = DownRedis()
+
+        await cache.set("k1", "answer one")
+        assert redis.calls == 1
+        assert not cache.available
+        # Redis 处于退避期：写入只进 L1，读取直接由 L1 命中，不再访问 Redis
+        await cache.set("k2", "answer two")
+        assert await cache.get("k1") == "answer one"
+        assert await cache.get_many(["k1", "k2", "k3"]) == {"k1": "answer one", "k2": "answer two"}
+        assert await cache.get("k3") is None
+        assert redis.calls == 1
+
+        # 退避结束后重新尝试 Redis；L1 仍然命中
+        cache._retry_after = 0.0
+        assert await cache.get("missing") is None
+        assert redis.calls == 2
+        assert await cache.get("k2") == "answer two"
+        return cache
+
+    stats = asyncio.run(run()).stats()
+    assert stats["l1_hits"] == 4
+    assert stats["l2_hits"] == 0
+    assert stats["misses"] == 3
+    assert stats["errors"] == 2
+    assert stats["redis_available"] is False
@@ -0,0 +1,70 @@
+"""
+语义缓存的 TTL：到期前命中，到期后查不到且记录从索引中移除；单条记录可以覆盖默认 TTL
+"""
+import hashlib
+
+import numpy as np
+import pytest
+
+pytest.importorskip("faiss")
+
+import semantic_cache
+from semantic_cache import SemanticCache
+
+DIMENSION = 16
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+def embed(text):
+    seed = int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "little")
+    return np.random.default_rng(seed).standard_normal(DIMENSION).astype("float32")
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(semantic_cache, "time", clock)
+    return clock
+
+
+def test_entries_expire_after_ttl(clock):
+    cache = SemanticCache(embed, DIMENSION, ttl=60)
+    cache.store("alice:model", "今天天气怎么样", "晴天")
+    cache.store("alice:model", "你叫什么名字", "小助手", ttl=600)
+
+    clock.now += 59
+    assert cache.lookup("alice:model", "今天天气怎么样") == "晴天"
+    # 命名空间互相隔离
+    assert cache.lookup("bob:model", "今天天气怎么样") is None
+
+    clock.now += 1
+    assert cache.lookup("alice:model", "今天天气怎么样") is None
+    assert cache.lookup("alice:model", "你叫什么名字") == "小助手"
+    assert cache.stats()["entries"] == 1
+    assert cache.stats()["expirations"] == 1
+
+    clock.now += 600
+    assert cache.lookup("alice:model", "你叫什么名字") is None
+    # 最后一条记录过期后，命名空间的索引也被释放
+    assert cache.stats()["entries"] == 0
+    assert "alice:model" not in cache._indexes
+
+
+def test_refreshed_entry_outlives_earlier_copy(clock):
+    cache = SemanticCache(embed, DIMENSION, ttl=60)
+    cache.store("alice:model", "今天天气怎么样", "晴天")
+    clock.now += 30
+    cache.store("alice:model", "今天天气怎么样", "多云")
+
+    # 旧记录到期只淘汰旧记录，新记录仍然命中
+    clock.now += 31
+    assert cache.lookup("alice:model", "今天天气怎么样") == "多云"
+    clock.now += 30
+    assert cache.lookup("alice:model", "今天天气怎么样") is None
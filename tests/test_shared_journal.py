@@ -0,0 +1,75 @@
+"""
+共享模式下多个进程同时追加对话、期间发生日志压缩轮换：消息 ID 全局唯一，重新加载后一条不丢
+"""
+import multiprocessing
+import os
+import tempfile
+
+import pytest
+
+pytest.importorskip("faiss")
+
+from vector_store import VectorStore
+
+PROCESSES = 3
+MESSAGES = 150
+COMPACT_EVERY = 37
+
+
+def open_store(path):
+    return VectorStore(save_path=path, shared=True, compact_every=COMPACT_EVERY, preload_model=False,
+                       embedding_cache_size=0)
+
+
+def append_worker(path, name, leader, loaded, started, resumed, results):
+    store = open_store(path)
+    # 所有进程都在目录中还没有日志时完成加载
+    loaded.wait()
+    ids = []
+    if not leader:
+        # 等领头的进程完成一次压缩轮换后才开始追加：此时本进程的序号已经过期
+        started.wait()
+    for i in range(MESSAGES):
+        ids.append(store.append_message(name, "user", f"{name}-{i}"))
+        if leader and not started.is_set() and store.journal.entries_since_compact == 0:
+            # 刚完成轮换、新日志中还没有条目时，让其他进程先各追加一条
+            started.set()
+            resumed.wait()
+        elif not leader and len(ids) == 1:
+            resumed.wait()
+    store.close()
+    results.put((name, ids))
+
+
+def test_shared_appends_across_compaction_keep_unique_ids():
+    path = os.path.join(tempfile.mkdtemp(prefix="llmb_journal_"), "vector_store")
+    ctx = multiprocessing.get_context("fork")
+    loaded = ctx.Barrier(PROCESSES)
+    started = ctx.Event()
+    resumed = ctx.Barrier(PROCESSES)
+    results = ctx.Queue()
+    workers = [ctx.Process(target=append_worker, args=(path, f"w{n}", n == 0, loaded, started, resumed,
+                                                               results))
+               for n in range(PROCESSES)]
+    for worker in workers:
+        worker.start()
+    returned = dict(results.get(timeout=60) for _ in workers)
+    for worker in workers:
+        worker.join(timeout=60)
+        assert worker.exitcode == 0
+
+    # 各进程拿到的消息 ID 互不重复且连续
+    all_ids = [message_id for ids in returned.values() for message_id in ids]
+    assert sorted(all_ids) == list(range(1, PROCESSES * MESSAGES + 1))
+
+    # 重新加载（快照 + 日志重放）后每条消息都在，且 ID 与写入时返回的一致
+    store = open_store(path)
+    try:
+        total = sum(len(messages) for messages in store.conversation_data.values())
+        assert total == PROCESSES * MESSAGES
+        for name, ids in returned.items():
+            messages = store.conversation_data[name]
+            assert [m["content"] for m in messages] == [f"{name}-{i}" for i in range(MESSAGES)]
+            assert [m["id"] for m in messages] == ids
+    finally:
+        store.close()
@@ -0,0 +1,86 @@
+"""
+进程内 single-flight：并发的相同请求只生成一次，其余请求共享结果；生成者被取消时由等待者接手
+"""
+import asyncio
+
+import pytest
+
+from singleflight import SingleFlight
+
+
+def test_concurrent_identical_requests_are_coalesced():
+    async def run():
+        flight = SingleFlight()
+        release = asyncio.Event()
+        calls = []
+
+        async def generate(key):
+            calls.append(key)
+            await release.wait()
+            return f"answer:{key}"
+
+        tasks = [asyncio.create_task(flight.do("same", lambda: generate("same"))) for _ in range(10)]
+        other = asyncio.create_task(flight.do("other", lambda: generate("other")))
+        await asyncio.sleep(0)
+        # 生成者仍在进行中，其他请求都在等待同一个 Future
+        assert flight.inflight("same") is not None
+        release.set()
+        results = await asyncio.gather(*tasks)
+        assert await other == "answer:other"
+        return flight, calls, results
+
+    flight, calls, results = asyncio.run(run())
+    assert sorted(calls) == ["other", "same"]
+    assert results == ["answer:same"] * 10
+    assert flight.stats() == {"in_flight": 0, "leaders": 2, "local_followers": 9, "remote_followers": 0,
+                              "fallbacks": 0}
+
+
+def test_leader_error_is_shared_with_followers():
+    async def run():
+        flight = SingleFlight()
+        release = asyncio.Event()
+
+        async def generate():
+            await release.wait()
+            raise RuntimeError("backend down")
+
+        tasks = [asyncio.create_task(flight.do("key", generate)) for _ in range(3)]
+        await asyncio.sleep(0)
+        release.set()
+        return flight, await asyncio.gather(*tasks, return_exceptions=True)
+
+    flight, results = asyncio.run(run())
+    assert all(isinstance(r, RuntimeError) for r in results)
+    assert flight.leaders == 1
+    assert flight.inflight("key") is None
+
+
+def test_follower_takes_over_when_leader_is_cancelled():
+    async def run():
+        flight = SingleFlight()
+        release = asyncio.Event()
+        calls = 0
+
+        async def generate():
+            nonlocal calls
+            calls += 1
+            await release.wait()
+            return calls
+
+        leader = asyncio.create_task(flight.do("key", generate))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(flight.do("key", generate))
+        await asyncio.sleep(0)
+        # 客户端断开，生成者被取消：等待者不应收到 CancelledError，而是自己重新生成
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        await asyncio.sleep(0)
+        release.set()
+        return flight, await follower
+
+    flight, result = asyncio.run(run())
+    assert result == 2
+    assert flight.leaders == 2
+    assert flight.inflight("key") is None
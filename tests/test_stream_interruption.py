@@ -0,0 +1,166 @@
+"""
+后端在流式回复中途断开时，不完整的回复不能被当作正常结束：不保存、不缓存、不交给合并等待的请求
+"""
+import asyncio
+import json
+import socket
+
+import pytest
+from aiohttp import web
+
+import ollama_client
+from fake_ollama import FakeOllama
+from ollama_client import OllamaClient, OllamaStreamError, stream_ollama
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def start_fake(**kwargs):
+    fake = FakeOllama(latency_ms=0, jitter_ms=0, tokens_per_s=0, tokens=10, **kwargs)
+    runner = web.AppRunner(fake.make_app())
+    await runner.setup()
+    port = free_port()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner, f"http://127.0.0.1:{port}"
+
+
+def use_pool(monkeypatch, base_url):
+    client = OllamaClient(backends=[base_url], health_interval=0)
+    monkeypatch.setattr(ollama_client, "ollama_client", client)
+    return client
+
+
+def test_stream_ollama_raises_after_partial_output(monkeypatch):
+    async def run():
+        runner, base_url = await start_fake(disconnect_after=3)
+        client = use_pool(monkeypatch, base_url)
+        chunks = []
+        try:
+            with pytest.raises(OllamaStreamError):
+                async for content in stream_ollama([{"role": "user", "content": "你好"}], model="fake"):
+                    chunks.append(content)
+        finally:
+            await client.close()
+            await runner.cleanup()
+        return chunks
+
+    chunks = asyncio.run(run())
+    assert chunks == ["好的", "，", "我"]
+
+
+def test_partial_output_failure_propagates_without_failover(monkeypatch):
+    async def run():
+        broken_runner, broken_url = await start_fake(disconnect_after=3)
+        healthy_runner, healthy_url = await start_fake()
+        client = OllamaClient(backends=[broken_url, healthy_url], health_interval=0)
+        monkeypatch.setattr(ollama_client, "ollama_client", client)
+        # 固定先选中会断开的后端
+        monkeypatch.setattr(client, "choose", lambda model, exclude=(): client.backends[0])
+        chunks = []
+        try:
+            with pytest.raises(OllamaStreamError):
+                async for content in stream_ollama([{"role": "user", "content": "你好"}], model="fake"):
+                    chunks.append(content)
+        finally:
+            await client.close()
+            await broken_runner.cleanup()
+            await healthy_runner.cleanup()
+        return chunks, client
+
+    chunks, client = asyncio.run(run())
+    # 不换后端重新生成，也不以兜底文本收尾；中途断开计入该后端的失败
+    assert chunks == ["好的", "，", "我"]
+    assert client.retries == 0
+    assert client.backends[0].consecutive_failures == 1
+
+
+def pin_order(monkeypatch, client):
+    # 按列表顺序选择尚未尝试过的后端
+    monkeypatch.setattr(client, "choose", lambda model, exclude=(): next(
+        (backend for backend in client.backends if backend not in exclude), None))
+
+
+def test_stream_fails_over_before_output(monkeypatch):
+    async def run():
+        failing_runner, failing_url = await start_fake(error_rate=1.0)
+        healthy_runner, healthy_url = await start_fake()
+        client = OllamaClient(backends=[failing_url, healthy_url], health_interval=0)
+        pin_order(monkeypatch, client)
+        try:
+            chunks = [content async for content in client.stream_with_retry(
+                {"model": "fake", "messages": [{"role": "user", "content": "你好"}], "stream": True}, 5)]
+        finally:
+            await client.close()
+            await failing_runner.cleanup()
+            await healthy_runner.cleanup()
+        return chunks, client
+
+    chunks, client = asyncio.run(run())
+    assert len(chunks) == 10
+    assert client.retries == 1
+    assert client.backends[0].consecutive_failures == 1
+
+
+def test_stream_ollama_falls_back_when_every_backend_fails(monkeypatch):
+    async def run():
+        runner, base_url = await start_fake(error_rate=1.0)
+        client = use_pool(monkeypatch, base_url)
+        try:
+            return [content async for content in stream_ollama([{"role": "user", "content": "你好"}], model="fake")]
+        finally:
+            await client.close()
+            await runner.cleanup()
+
+    assert asyncio.run(run()) == ["抱歉，我暂时无法回答您的问题。"]
+
+
+def test_stream_ollama_complete_stream(monkeypatch):
+    async def run():
+        runner, base_url = await start_fake()
+        client = use_pool(monkeypatch, base_url)
+        try:
+            return [content async for content in stream_ollama([{"role": "user", "content": "你好"}], model="fake")]
+        finally:
+            await client.close()
+            await runner.cleanup()
+
+    assert len(asyncio.run(run())) == 10
+
+
+def test_interrupted_stream_is_not_persisted(monkeypatch):
+    pytest.importorskip("sentence_transformers")
+    main = pytest.importorskip("main")
+    persisted = []
+
+    async def fake_persist(*args, **kwargs):
+        persisted.append(args)
+
+    monkeypatch.setattr(main, "persist_exchange", fake_persist)
+
+    async def run():
+        runner, base_url = await start_fake(disconnect_after=3)
+        client = use_pool(monkeypatch, base_url)
+        request = main.ChatRequest(model="fake", messages=[main.Message(role="user", content="你好")],
+                                   max_tokens=10, temperature=0.7, stream=True)
+        cache_key = "chat:test:interrupted"
+        try:
+            events = [chunk async for chunk in main._stream_chat_completion(
+                request, "test", "你好", [{"role": "user", "content": "你好"}], cache_key)]
+        finally:
+            await client.close()
+            await runner.cleanup()
+        return events, main.single_flight.inflight(cache_key)
+
+    events, inflight = asyncio.run(run())
+    payloads = [json.loads(e[len("data: "):]) for e in events if e.startswith("data: {")]
+    finish_reasons = [p["choices"][0]["finish_reason"] for p in payloads if "choices" in p]
+    assert "stop" not in finish_reasons
+    assert "error" in finish_reasons
+    assert any("error" in p for p in payloads)
+    assert "data: [DONE]\n\n" not in events
+    assert persisted == []
+    assert inflight is None
@@ -2,3 +2,12 @@ from datetime import datetime
 
 def get_current_date():
     return datetime.now().strftime("%Y年%m月%d日")
+
+
+def percentile(values, pct):
+    """
+    最近秩分位数（pct 取 0~100），压测与基准脚本共用；values 不能为空
+    """
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * (len(ordered) - 1)))))
+    return ordered[index]
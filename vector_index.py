@@ -0,0 +1,542 @@
+import hashlib
+import json
+import os
+import queue
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import faiss
+import numpy as np
+
+from file_lock import FileLock, try_lock_file
+from logger import get_logger
+
+logger = get_logger("VectorIndex")
+
+# 冷层可选的索引结构（每个向量的内存占用，以 1024 维为例）：
+# - Flat：精确检索，4096 字节
+# - IVFFlat：倒排 + 原始向量，约 4096 字节，检索只扫描 nprobe 个桶
+# - IVF-SQ8：倒排 + 8 bit 标量量化，约 1024 字节
+# - IVF-PQ：倒排 + 乘积量化（pq_m 个子空间 x 8 bit），约 pq_m 字节
+# - HNSW：图索引 + 原始向量，约 4096 + 8 * hnsw_m 字节，无需训练
+INDEX_TYPES = ("Flat", "IVFFlat", "IVF-SQ8", "IVF-PQ", "HNSW")
+# PQ 每个子空间有 256 个聚类中心，训练样本少于该数量时无法训练
+PQ_MIN_TRAINING = 256
+
+
+def cold_factory(index_type: str, dimension: int, count: int, nlist: int = 100, pq_m: int = 64,
+                 hnsw_m: int = 32) -> str:
+    """
+    返回冷层的 faiss.index_factory 字符串。IVF 的桶数随训练样本数缩小
+    （FAISS 建议每个桶至少约 39 个样本），样本不足以训练 PQ 时退化为 IVF-SQ8。
+    :param count: 训练（即入库）向量数
+    """
+    if index_type == "Flat":
+        return "Flat"
+    if index_type == "HNSW":
+        return f"HNSW{hnsw_m}"
+    nlist = max(1, min(nlist, count // 39))
+    if index_type == "IVFFlat":
+        return f"IVF{nlist},Flat"
+    if index_type == "IVF-SQ8":
+        return f"IVF{nlist},SQ8"
+    if index_type == "IVF-PQ":
+        if dimension % pq_m:
+            raise ValueError(f"维度 {dimension} 不能被 pq_m={pq_m} 整除")
+        if count < PQ_MIN_TRAINING:
+            return f"IVF{nlist},SQ8"
+        return f"IVF{nlist},PQ{pq_m}x8"
+    raise ValueError(f"未知的索引类型: {index_type}，可选: {', '.join(INDEX_TYPES)}")
+
+
+def configure_search(index, nprobe: int = 8, ef_search: int = 64):
+    """
+    设置检索参数：IVF 的 nprobe、HNSW 的 efSearch（支持外层包了 IndexIDMap2 的索引）
+    """
+    if isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+        index = faiss.downcast_index(index.index)
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.nprobe = min(nprobe, ivf.nlist)
+    elif isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = ef_search
+
+
+class UserPartition:
+    """
+    单个用户的向量分区，分为两层：
+    - 热层：精确的 Flat 索引，新向量写入后立即可检索
+    - 冷层：可配置的压缩/近似索引（见 INDEX_TYPES，默认 IVFFlat），热层超过阈值后
+      由后台线程连同热层向量一起重建，重建完成后原子替换，检索请求不会因训练而阻塞。
+      所用的索引类型与 factory 字符串记录在 .meta.json 中，配置改变后启动时会重建冷层
+    两层中都存放稳定的 64 位消息 ID。原始向量与 ID 追加写入磁盘文件，
+    是重建冷层和启动恢复热层的数据来源。
+
+    共享模式（多个 worker 进程使用同一目录）下：
+    - 追加写在跨进程文件锁内进行，写入前先补读其他进程追加的行，保证各进程的热层与磁盘行号一致
+    - 冷层以 IO_FLAG_MMAP 方式内存映射加载，倒排表由各进程通过页缓存共享
+    - 冷层文件被其他进程替换后，下次访问时自动重新加载
+    """
+
+    def __init__(self, dimension: int, base_path: str, nlist: int = 100, nprobe: int = 8,
+                 file_lock: Optional[FileLock] = None, index_type: str = "IVFFlat", pq_m: int = 64,
+                 hnsw_m: int = 32, ef_search: int = 64):
+        """
+        :param dimension: 向量维度
+        :param base_path: 分区文件路径前缀（不含扩展名）
+        :param nlist: 冷层 IVF 聚类桶数量的上限
+        :param nprobe: 冷层检索时探测的桶数
+        :param file_lock: 共享模式下协调多进程写入的文件锁，None 表示单进程模式
+        :param index_type: 冷层索引类型（INDEX_TYPES 之一）
+        :param pq_m: IVF-PQ 的子空间数（每个向量占用的字节数）
+        :param hnsw_m: HNSW 每个节点的邻居数
+        :param ef_search: HNSW 检索时的候选队列长度
+        """
+        self.dimension = dimension
+        self.vectors_path = base_path + ".vec"
+        self.ids_path = base_path + ".ids"
+        self.cold_path = base_path + ".ivf"  # 沿用旧文件名，内容可以是任意一种冷层索引
+        self.meta_path = base_path + ".meta.json"
+        self.rebuild_lock_path = base_path + ".rebuild.lock"
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.index_type = index_type
+        self.pq_m = pq_m
+        self.hnsw_m = hnsw_m
+        self.ef_search = ef_search
+        self.cold_meta = {}  # 已加载冷层的 index_type / factory
+        self.file_lock = file_lock
+        self.hot = self._new_hot()
+        self.cold = None
+        self.rebuilds = 0
+        self.reloads = 0
+        self._cold_version = None  # 已加载冷层文件的 (inode, mtime, 元数据 mtime)
+        self._lock = threading.Lock()
+        self._load()
+
+    @property
+    def shared(self) -> bool:
+        return self.file_lock is not None
+
+    def _new_hot(self):
+        return faiss.IndexIDMap2(faiss.IndexFlatL2(self.dimension))
+
+    def _cold_file_version(self):
+        try:
+            st = os.stat(self.cold_path)
+        except FileNotFoundError:
+            return None
+        try:
+            meta_mtime = os.stat(self.meta_path).st_mtime_ns
+        except FileNotFoundError:
+            meta_mtime = None
+        return st.st_ino, st.st_mtime_ns, meta_mtime
+
+    def _read_cold(self):
+        """
+        读取冷层文件，返回 (索引, 文件版本)；共享模式下内存映射倒排表
+        """
+        version = self._cold_file_version()
+        if version is None:
+            return None, None
+        try:
+            cold = faiss.read_index(self.cold_path, faiss.IO_FLAG_MMAP if self.shared else 0)
+        except Exception as e:
+            logger.error(f"读取冷层索引 {self.cold_path} 失败，将全部向量放入热层: {e}")
+            return None, None
+        configure_search(cold, self.nprobe, self.ef_search)
+        return cold, version
+
+    def _read_meta(self) -> dict:
+        try:
+            with open(self.meta_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            # 引入该文件之前的冷层都是 IVFFlat
+            return {"index_type": "IVFFlat"}
+        except Exception as e:
+            logger.warning(f"读取 {self.meta_path} 失败: {e}")
+            return {}
+
+    def _write_meta(self, meta: dict):
+        tmp_path = f"{self.meta_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, self.meta_path)
+
+    @property
+    def stale(self) -> bool:
+        """
+        冷层的索引类型与当前配置不一致，需要重建
+        """
+        return self.cold is not None and self.cold_meta.get("index_type") != self.index_type
+
+    def _install(self, cold, version):
+        """
+        替换冷层，并用冷层之后的落盘行重建热层（调用方持有分区锁）
+        """
+        hot = self._new_hot()
+        cold_ntotal = cold.ntotal if cold is not None else 0
+        vectors, ids = self.read_stored(start=cold_ntotal)
+        if len(ids):
+            hot.add_with_ids(vectors, ids)
+        self.cold = cold
+        self.hot = hot
+        self._cold_version = version
+        self.cold_meta = self._read_meta() if cold is not None else {}
+
+    def _load(self):
+        # 冷层覆盖的是落盘向量的前 cold.ntotal 行，其余行恢复到热层
+        cold, version = self._read_cold()
+        with self._lock:
+            self._install(cold, version)
+
+    def sync(self):
+        """
+        共享模式：加载其他进程替换的冷层与追加的向量行，开销为几次 stat
+        """
+        if not self.shared:
+            return
+        version = self._cold_file_version()
+        if version is not None and version != self._cold_version:
+            cold, version = self._read_cold()
+            if cold is not None:
+                with self._lock:
+                    if version != self._cold_version:
+                        self._install(cold, version)
+                        self.reloads += 1
+                        logger.info(f"重新加载冷层索引 {self.cold_path}：{cold.ntotal} 个向量")
+        with self._lock:
+            self._read_appended()
+
+    def _disk_rows(self) -> int:
+        try:
+            return min(os.path.getsize(self.ids_path) // 8,
+                       os.path.getsize(self.vectors_path) // (self.dimension * 4))
+        except FileNotFoundError:
+            return 0
+
+    def _read_appended(self):
+        """
+        把磁盘上尚未加载的行加入热层（调用方持有分区锁）
+        """
+        if self._disk_rows() <= self.ntotal:
+            return
+        vectors, ids = self.read_stored(start=self.ntotal)
+        if len(ids):
+            self.hot.add_with_ids(vectors, ids)
+
+    def read_stored(self, start: int = 0, stop: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        读取已落盘的向量与 ID 的 [start, stop) 行（两个文件长度不一致时以较短者为准）
+        """
+        empty = np.zeros((0, self.dimension), dtype="float32"), np.zeros(0, dtype="int64")
+        if not os.path.exists(self.ids_path) or not os.path.exists(self.vectors_path):
+            return empty
+        row_bytes = self.dimension * 4
+        total = self._disk_rows()
+        stop = total if stop is None else min(stop, total)
+        count = stop - start
+        if count <= 0:
+            return empty
+        ids = np.fromfile(self.ids_path, dtype="int64", count=count, offset=start * 8)
+        vectors = np.fromfile(self.vectors_path, dtype="float32", count=count * self.dimension,
+                              offset=start * row_bytes)
+        return vectors.reshape(count, self.dimension), ids
+
+    def add(self, ids: np.ndarray, vectors: np.ndarray):
+        ids = np.ascontiguousarray(ids, dtype="int64")
+        vectors = np.ascontiguousarray(vectors, dtype="float32").reshape(-1, self.dimension)
+        if self.shared:
+            self.sync()
+            with self.file_lock, self._lock:
+                # 先补读其他进程的追加，本次写入的行号才与热层一致
+                self._read_appended()
+                self._append(ids, vectors)
+        else:
+            with self._lock:
+                self._append(ids, vectors)
+
+    def _append(self, ids: np.ndarray, vectors: np.ndarray):
+        # 先写向量再写 ID，崩溃时多出的半条向量会在加载时被丢弃
+        with open(self.vectors_path, "ab") as f:
+            f.write(vectors.tobytes())
+        with open(self.ids_path, "ab") as f:
+            f.write(ids.tobytes())
+        self.hot.add_with_ids(vectors, ids)
+
+    def search(self, query: np.ndarray, top_k: int) -> List[Tuple[int, float]]:
+        """
+        同时检索热层与冷层并按距离合并
+        """
+        self.sync()
+        hits = []
+        with self._lock:
+            cold = self.cold  # 冷层替换后旧对象不再被修改，可在锁外检索
+            k = min(top_k, self.hot.ntotal)
+            if k > 0:
+                distances, ids = self.hot.search(query, k)
+                hits.extend(zip(ids[0], distances[0]))
+        if cold is not None and cold.ntotal > 0:
+            distances, ids = cold.search(query, min(top_k, cold.ntotal))
+            hits.extend(zip(ids[0], distances[0]))
+        hits = [(int(i), float(d)) for i, d in hits if i != -1]
+        hits.sort(key=lambda hit: hit[1])
+        return hits[:top_k]
+
+    @property
+    def cold_ntotal(self) -> int:
+        return self.cold.ntotal if self.cold is not None else 0
+
+    @property
+    def ntotal(self) -> int:
+        return self.hot.ntotal + self.cold_ntotal
+
+    def rebuild_cold(self, hot_threshold: int = 0):
+        """
+        用落盘的全部向量训练新的冷层 IVF 索引，然后原子替换冷层与热层。
+        训练在调用线程（后台重建线程）中进行，不持有分区锁。
+        共享模式下同一分区同时只有一个进程重建，其他进程随后通过 sync() 加载结果。
+        :param hot_threshold: 热层（同步之后）仍少于该数量时跳过重建
+        """
+        if not self.shared:
+            self._rebuild_cold()
+            return
+        lock_fd = try_lock_file(self.rebuild_lock_path)
+        if lock_fd is None:
+            logger.info(f"其他进程正在重建 {self.cold_path}，跳过")
+            return
+        try:
+            # 其他进程可能刚刚完成重建
+            self.sync()
+            if self.hot.ntotal < hot_threshold and not self.stale:
+                return
+            self._rebuild_cold()
+        finally:
+            os.close(lock_fd)
+
+    def _rebuild_cold(self):
+        with self._lock:
+            target = self.ntotal
+        vectors, ids = self.read_stored(stop=target)
+        count = len(ids)
+        if count == 0:
+            return
+        factory = cold_factory(self.index_type, self.dimension, count, nlist=self.nlist, pq_m=self.pq_m,
+                               hnsw_m=self.hnsw_m)
+        index = faiss.index_factory(self.dimension, factory, faiss.METRIC_L2)
+        if not index.is_trained:
+            index.train(vectors)
+        configure_search(index, self.nprobe, self.ef_search)
+        cold = faiss.IndexIDMap2(index)
+        cold.add_with_ids(vectors, ids)
+
+        tmp_path = self.cold_path + ".tmp"
+        faiss.write_index(cold, tmp_path)
+        os.replace(tmp_path, self.cold_path)
+        # 后写元数据：两者之间崩溃只会让下次启动多做一次重建
+        self._write_meta({"index_type": self.index_type, "factory": factory, "ntotal": count})
+        version = self._cold_file_version()
+        if self.shared:
+            # 改为内存映射的版本，与其他进程共享页缓存
+            cold, version = self._read_cold()
+
+        with self._lock:
+            # 重建期间新写入的向量保留在新的热层中
+            self._install(cold, version)
+            self.rebuilds += 1
+        logger.info(f"冷层索引重建完成：{count} 个向量，{factory}，热层剩余 {self.hot.ntotal}")
+
+
+class PartitionedIndex:
+    """
+    按用户分区的向量索引：检索只触及调用者自己的向量，
+    延迟与系统中的总用户数无关。
+    shared=True 时多个 worker 进程共享同一目录（见 UserPartition）。
+    """
+
+    def __init__(self, dimension: int, path: str, nlist: int = 100, hot_threshold: int = 100,
+                 nprobe: int = 8, shared: bool = False, index_type: str = "IVFFlat", pq_m: int = 64,
+                 hnsw_m: int = 32, ef_search: int = 64):
+        """
+        :param dimension: 向量维度
+        :param path: 分区文件目录
+        :param nlist: 冷层 IVF 聚类桶数量的上限
+        :param hot_threshold: 热层向量数达到该阈值后，在后台重建该分区的冷层
+        :param nprobe: 冷层检索时探测的桶数
+        :param shared: 是否与其他进程共享索引目录
+        :param index_type: 冷层索引类型（INDEX_TYPES 之一），可用 index_tuning.py 按召回率/内存选择
+        :param pq_m: IVF-PQ 的子空间数
+        :param hnsw_m: HNSW 每个节点的邻居数
+        :param ef_search: HNSW 检索时的候选队列长度
+        """
+        if index_type not in INDEX_TYPES:
+            raise ValueError(f"未知的索引类型: {index_type}，可选: {', '.join(INDEX_TYPES)}")
+        self.dimension = dimension
+        self.path = path
+        self.nlist = nlist
+        self.hot_threshold = hot_threshold
+        self.nprobe = nprobe
+        self.index_type = index_type
+        self.pq_m = pq_m
+        self.hnsw_m = hnsw_m
+        self.ef_search = ef_search
+        self.manifest_path = os.path.join(path, "partitions.json")
+        self.partitions: Dict[str, UserPartition] = {}
+        self._lock = threading.Lock()
+        self._rebuild_queue = queue.Queue()
+        self._rebuild_pending = set()
+        self._rebuild_thread = None
+        self._pid = os.getpid()
+        os.makedirs(path, exist_ok=True)
+        self.file_lock = FileLock(os.path.join(path, "partitions.lock")) if shared else None
+
+    @staticmethod
+    def partition_key(user_id: str) -> str:
+        return hashlib.sha1(user_id.encode("utf-8")).hexdigest()[:20]
+
+    def _new_partition(self, user_id: str) -> UserPartition:
+        base_path = os.path.join(self.path, self.partition_key(user_id))
+        return UserPartition(self.dimension, base_path, nlist=self.nlist, nprobe=self.nprobe,
+                             file_lock=self.file_lock, index_type=self.index_type, pq_m=self.pq_m,
+                             hnsw_m=self.hnsw_m, ef_search=self.ef_search)
+
+    def _read_manifest(self) -> Dict[str, str]:
+        if not os.path.exists(self.manifest_path):
+            return {}
+        with open(self.manifest_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def load(self):
+        """
+        根据清单加载全部用户分区
+        """
+        partitions = {}
+        if os.path.exists(self.manifest_path):
+            manifest = self._read_manifest()
+            for user_id in manifest:
+                partitions[user_id] = self._new_partition(user_id)
+        with self._lock:
+            self.partitions = partitions
+        logger.info(f"加载向量分区 {len(partitions)} 个，向量总数 {self.ntotal}")
+        for user_id, partition in partitions.items():
+            self._maybe_schedule_rebuild(user_id, partition)
+
+    def reset(self):
+        """
+        删除全部分区及其文件（消息 ID 重新编号后重建索引时使用，需在 load() 之前调用，此时没有后台重建）
+        """
+        with self._lock:
+            self.partitions = {}
+            for name in os.listdir(self.path):
+                # 锁文件可能正被其他进程持有，保留
+                if name != "partitions.lock":
+                    os.remove(os.path.join(self.path, name))
+        logger.info(f"已清空向量分区目录 {self.path}")
+
+    def _save_manifest(self):
+        manifest = {user_id: self.partition_key(user_id) for user_id in self.partitions}
+        if self.file_lock is not None:
+            # 合并其他进程创建的分区
+            manifest = {**self._read_manifest(), **manifest}
+        tmp_path = f"{self.manifest_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False)
+        os.replace(tmp_path, self.manifest_path)
+
+    def get_partition(self, user_id: str, create: bool = False):
+        partition = self.partitions.get(user_id)
+        if partition is None and self.file_lock is not None and not create:
+            # 共享模式：分区可能由其他进程创建
+            base_path = os.path.join(self.path, self.partition_key(user_id))
+            if os.path.exists(base_path + ".ids"):
+                create = True
+        if partition is None and create:
+            with self._lock:
+                partition = self.partitions.get(user_id)
+                if partition is None:
+                    if self.file_lock is not None:
+                        with self.file_lock:
+                            partition = self._new_partition(user_id)
+                            self.partitions[user_id] = partition
+                            self._save_manifest()
+                    else:
+                        partition = self._new_partition(user_id)
+                        self.partitions[user_id] = partition
+                        self._save_manifest()
+        return partition
+
+    def add(self, user_id: str, ids: np.ndarray, vectors: np.ndarray):
+        """
+        向用户分区添加带 ID 的向量（写入热层，立即可检索）
+        """
+        partition = self.get_partition(user_id, create=True)
+        partition.add(ids, vectors)
+        self._maybe_schedule_rebuild(user_id, partition)
+
+    def search(self, user_id: str, query: np.ndarray, top_k: int) -> List[Tuple[int, float]]:
+        """
+        在用户分区内检索，返回 [(消息 ID, 距离), ...]，按距离升序
+        """
+        partition = self.get_partition(user_id)
+        if partition is None:
+            return []
+        query = np.ascontiguousarray(query, dtype="float32").reshape(1, self.dimension)
+        return partition.search(query, top_k)
+
+    def _maybe_schedule_rebuild(self, user_id: str, partition: UserPartition):
+        # 热层超过阈值，或冷层的索引类型与配置不一致（配置改变后迁移）
+        if partition.hot.ntotal < self.hot_threshold and not partition.stale:
+            return
+        if self._pid != os.getpid():
+            # fork 之后（preload_app=True）父进程的重建线程不存在于子进程中，重新初始化
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._rebuild_queue = queue.Queue()
+                    self._rebuild_pending = set()
+                    self._rebuild_thread = None
+                    self._pid = os.getpid()
+        with self._lock:
+            if user_id in self._rebuild_pending:
+                return
+            self._rebuild_pending.add(user_id)
+            if self._rebuild_thread is None or not self._rebuild_thread.is_alive():
+                self._rebuild_thread = threading.Thread(
+                    target=self._rebuild_worker, name="index-rebuild", daemon=True
+                )
+                self._rebuild_thread.start()
+        self._rebuild_queue.put(user_id)
+
+    def _rebuild_worker(self):
+        while True:
+            user_id = self._rebuild_queue.get()
+            try:
+                partition = self.partitions.get(user_id)
+                if partition is not None:
+                    partition.rebuild_cold(hot_threshold=self.hot_threshold)
+            except Exception as e:
+                logger.error(f"重建用户 {user_id} 的冷层索引时出错: {e}")
+            finally:
+                with self._lock:
+                    self._rebuild_pending.discard(user_id)
+
+    @property
+    def ntotal(self) -> int:
+        return sum(partition.ntotal for partition in list(self.partitions.values()))
+
+    def stats(self) -> dict:
+        partitions = list(self.partitions.values())
+        return {
+            "partitions": len(partitions),
+            "hot_vectors": sum(p.hot.ntotal for p in partitions),
+            "cold_vectors": sum(p.cold_ntotal for p in partitions),
+            "rebuilds": sum(p.rebuilds for p in partitions),
+            "rebuilds_pending": len(self._rebuild_pending),
+            "hot_threshold": self.hot_threshold,
+            "reloads": sum(p.reloads for p in partitions),
+            "shared": self.file_lock is not None,
+            "index_type": self.index_type,
+            "stale_partitions": sum(1 for p in partitions if p.stale),
+            "cold_index_bytes": sum(os.path.getsize(p.cold_path) for p in partitions if p.cold is not None
+                                    and os.path.exists(p.cold_path)),
+        }
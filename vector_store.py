@@ -1,127 +1,838 @@
-import faiss
 import numpy as np
-from sentence_transformers import SentenceTransformer, models
+from embedding_backend import create_backend
+from embedding_cache import EmbeddingCache
+from vector_index import PartitionedIndex
+from file_lock import FileLock, try_lock_file
+from metrics import stage_timer
+from logger import get_logger, preview, sample
 import os
+import json
 import pickle
-import logging
+import hashlib
+import contextlib
+import queue
+import shutil
+import time
+import threading
+from concurrent.futures import Future
+from typing import List
 
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger("VectorStore")
+logger = get_logger("VectorStore")
+
+# 迁移旧版数据时重建索引的标记文件，以及每批计算嵌入的消息数
+REINDEX_MARKER = "reindex.pending"
+REINDEX_BATCH_SIZE = 256
 
 import os
 os.environ["CUDA_VISIBLE_DEVICES"] = "-1"  # 禁用所有 GPU，要用gpu就改这条
 
 
+def chain_digest(digest: str, role: str, content: str) -> str:
+    """
+    滚动摘要：由上一条消息后的摘要和新消息计算新的摘要，开销只与新消息大小有关
+    :param digest: 上一条消息后的摘要（空对话为空字符串）
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(digest.encode("ascii"))
+    h.update(b"\x00")
+    h.update(role.encode("utf-8"))
+    h.update(b"\x00")
+    h.update(content.encode("utf-8"))
+    return h.hexdigest()
+
+
+class ConversationJournal:
+    """
+    对话数据的追加写日志：每条消息只追加一行 JSON（O(消息大小)），
+    定期在后台压缩为快照，启动时先加载快照再重放日志尾部。
+    共享模式（多个 worker 进程使用同一目录）下，追加与压缩都在跨进程文件锁内进行，
+    各进程通过 read_new() 尾随日志文件读取其他进程追加的条目，序号全局唯一且连续。
+    每个日志文件以一行 {"base_seq": N} 开头，表示该文件之前的条目（序号不超过 N）已轮换出去，
+    序号落后于 N 的进程据此发现自己错过了一次轮换。
+    """
+
+    SNAPSHOT_VERSION = 1
+
+    def __init__(self, save_path, compact_every=1000, fsync=False, shared=False):
+        """
+        :param save_path: 数据保存路径
+        :param compact_every: 追加多少条日志后压缩一次快照
+        :param fsync: 每次追加后是否 fsync（更安全，但写入更慢）
+        :param shared: 是否与其他进程共享同一份日志
+        """
+        self.snapshot_path = os.path.join(save_path, "conversation_data.pkl")
+        self.journal_path = os.path.join(save_path, "conversation_journal.jsonl")
+        self.rotated_path = self.journal_path + ".old"  # 压缩进行中时的旧日志
+        self.compact_lock_path = os.path.join(save_path, "conversation_compact.lock")
+        self.compact_every = compact_every
+        self.fsync = fsync
+        self.seq = 0  # 最近一条日志的序号，快照中记录已覆盖到的序号
+        self.entries_since_compact = 0
+        self.file_lock = FileLock(os.path.join(save_path, "conversation.lock")) if shared else None
+        self._file = None
+        self._tail = None  # 共享模式下尾随读取日志的句柄
+        self._lock = threading.Lock()
+        self._compacting = None  # 正在运行的压缩线程
+        self._pid = os.getpid()
+
+    def locked(self):
+        """
+        共享模式下返回跨进程文件锁，否则返回空的上下文管理器
+        """
+        return self.file_lock if self.file_lock is not None else contextlib.nullcontext()
+
+    def _check_fork(self):
+        if self._pid == os.getpid():
+            return
+        # fork 之后（preload_app=True）父进程的文件句柄共享文件偏移，压缩线程也不存在于子进程中
+        for f in (self._file, self._tail):
+            if f is not None:
+                f.close()
+        self._file = None
+        self._tail = None
+        self._compacting = None
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def load(self):
+        """
+        加载快照并重放其后的日志，返回恢复出的 (conversation_data, 每个用户的对话摘要)
+        """
+        self._check_fork()
+        with self.locked():
+            return self._load()
+
+    def _load(self):
+        conversation_data = {}
+        digests = None
+        snapshot_seq = 0
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, "rb") as f:
+                snapshot = pickle.load(f)
+            if isinstance(snapshot, dict) and snapshot.get("version") == self.SNAPSHOT_VERSION \
+                    and "conversation_data" in snapshot:
+                conversation_data = snapshot["conversation_data"]
+                snapshot_seq = snapshot.get("seq", 0)
+                digests = snapshot.get("digests")
+            else:
+                # 兼容旧格式：整个 conversation_data 字典直接 pickle
+                conversation_data = snapshot
+        if digests is None:
+            # 旧快照没有摘要：按快照中的对话完整计算一次
+            digests = {}
+            for user_id, messages in conversation_data.items():
+                digest = ""
+                for m in messages:
+                    digest = chain_digest(digest, m["role"], m["content"])
+                digests[user_id] = digest
+        self.seq = snapshot_seq
+
+        replayed = 0
+        for path in (self.rotated_path, self.journal_path):
+            replayed += self._replay(path, conversation_data, digests, snapshot_seq)
+        self.entries_since_compact = replayed
+        if self.file_lock is not None:
+            # 从当前日志末尾开始尾随其他进程的追加；日志不存在时先创建，之后日志缺失只可能是正在轮换
+            if self._tail is not None:
+                self._tail.close()
+                self._tail = None
+            if not os.path.exists(self.journal_path):
+                self._create_journal(self.seq)
+            self._tail = open(self.journal_path, "rb")
+            self._tail.seek(0, os.SEEK_END)
+        logger.info(f"对话数据恢复完成：快照序号 {snapshot_seq}，重放日志 {replayed} 条")
+        return conversation_data, digests
+
+    def _replay(self, path, conversation_data, digests, snapshot_seq):
+        """
+        重放单个日志文件，跳过快照已覆盖的条目；末尾不完整的行会被截断
+        """
+        if not os.path.exists(path):
+            return 0
+        replayed = 0
+        good_offset = 0
+        with open(path, "rb") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    logger.warning(f"日志 {path} 在偏移 {good_offset} 处存在不完整记录，已忽略其后内容")
+                    break
+                good_offset += len(line)
+                if "seq" not in entry:
+                    # 文件头
+                    continue
+                seq = entry["seq"]
+                if seq <= snapshot_seq:
+                    continue
+                message = entry["message"]
+                message.setdefault("id", seq)
+                user_id = entry["user_id"]
+                conversation_data.setdefault(user_id, []).append(message)
+                digests[user_id] = chain_digest(digests.get(user_id, ""), message["role"], message["content"])
+                self.seq = max(self.seq, seq)
+                replayed += 1
+        if good_offset < os.path.getsize(path):
+            with open(path, "r+b") as f:
+                f.truncate(good_offset)
+        return replayed
+
+    def _create_journal(self, base_seq):
+        """
+        原子地创建只含文件头的新日志文件（调用方持有 locked()）
+        """
+        tmp_path = self.journal_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(json.dumps({"base_seq": base_seq}) + "\n")
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        os.replace(tmp_path, self.journal_path)
+
+    def _open(self):
+        if self._file is not None and self.file_lock is not None:
+            # 日志可能已被其他进程轮换，句柄必须指向当前的日志文件
+            try:
+                current = os.stat(self.journal_path).st_ino
+            except FileNotFoundError:
+                current = None
+            if current != os.fstat(self._file.fileno()).st_ino:
+                self._file.close()
+                self._file = None
+        if self._file is None:
+            if not os.path.exists(self.journal_path):
+                self._create_journal(self.seq)
+            self._file = open(self.journal_path, "a", encoding="utf-8")
+        if self._tail is not None:
+            # 持有文件锁时没有其他写入者，尾随位置之后的内容只能是崩溃遗留的半行，截断它
+            tail_stat = os.fstat(self._tail.fileno())
+            position = self._tail.tell()
+            if tail_stat.st_ino == os.fstat(self._file.fileno()).st_ino and tail_stat.st_size > position:
+                logger.warning(f"日志 {self.journal_path} 在偏移 {position} 处存在不完整记录，已截断")
+                os.truncate(self.journal_path, position)
+        return self._file
+
+    def read_new(self):
+        """
+        共享模式：读取其他进程追加的日志条目，返回 [(user_id, message), ...]；
+        序号出现缺口、错过了一次日志轮换（文件头的 base_seq 大于本进程的序号）或日志正在轮换时返回 None，
+        调用方需完整重新加载
+        """
+        self._check_fork()
+        entries = []
+        with self._lock:
+            while True:
+                if self._tail is None:
+                    try:
+                        self._tail = open(self.journal_path, "rb")
+                    except FileNotFoundError:
+                        # 加载后日志总是存在：缺失说明其他进程正在轮换，不能当作没有新条目
+                        return None
+                while True:
+                    line = self._tail.readline()
+                    if not line:
+                        break
+                    if not line.endswith(b"\n"):
+                        # 其他进程尚未写完这一行
+                        self._tail.seek(-len(line), os.SEEK_CUR)
+                        break
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        return None
+                    if "seq" not in entry:
+                        if entry["base_seq"] > self.seq:
+                            # 本进程还没读到的条目已被轮换进快照
+                            return None
+                        continue
+                    seq = entry["seq"]
+                    if seq <= self.seq:
+                        continue
+                    if seq != self.seq + 1:
+                        return None
+                    message = entry["message"]
+                    message.setdefault("id", seq)
+                    entries.append((entry["user_id"], message))
+                    self.seq = seq
+                    self.entries_since_compact += 1
+                try:
+                    current = os.stat(self.journal_path).st_ino
+                except FileNotFoundError:
+                    break
+                if current == os.fstat(self._tail.fileno()).st_ino:
+                    break
+                # 日志已被轮换（某个进程做了压缩）：读完旧文件后切换到新文件
+                self._tail.close()
+                self._tail = None
+                self.entries_since_compact = 0
+        return entries
+
+    def append(self, user_id, message):
+        """
+        追加一条消息到日志，返回该条日志的序号（同时作为稳定的消息 ID）。
+        共享模式下调用方需持有 locked() 并先调用 read_new() 追上其他进程的追加。
+        """
+        self._check_fork()
+        with self._lock:
+            f = self._open()
+            self.seq += 1
+            message["id"] = self.seq
+            entry = {"seq": self.seq, "user_id": user_id, "message": message}
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+            self.entries_since_compact += 1
+            return self.seq
+
+    def should_compact(self):
+        return self.entries_since_compact >= self.compact_every and self._compacting is None
+
+    def compact(self, conversation_data, digests, background=True):
+        """
+        将当前对话数据（及每个用户的对话摘要）压缩为快照。
+        调用方需持有保护 conversation_data 的锁（共享模式下还需持有 locked()）：
+        这里只做浅拷贝并轮换日志文件，真正的序列化和写盘在后台线程中完成。
+        """
+        self._check_fork()
+        with self._lock:
+            if self._compacting is not None:
+                return
+            compact_fd = None
+            if self.file_lock is not None:
+                # 同一时间只允许一个进程压缩，锁随压缩线程结束（或进程崩溃）释放
+                compact_fd = try_lock_file(self.compact_lock_path)
+                if compact_fd is None:
+                    return
+            data = {user_id: list(messages) for user_id, messages in conversation_data.items()}
+            digests = dict(digests)
+            seq = self.seq
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            if os.path.exists(self.journal_path):
+                if os.path.exists(self.rotated_path):
+                    # 上次压缩失败遗留的旧日志：合并后再轮换，避免丢失未进入快照的条目
+                    with open(self.rotated_path, "ab") as dst, open(self.journal_path, "rb") as src:
+                        shutil.copyfileobj(src, dst)
+                    os.remove(self.journal_path)
+                else:
+                    os.replace(self.journal_path, self.rotated_path)
+            # 新日志以文件头记下轮换位置，序号落后的进程读到它时会重新加载
+            self._create_journal(seq)
+            self.entries_since_compact = 0
+            self._compacting = threading.Thread(
+                target=self._write_snapshot, args=(data, digests, seq, compact_fd), name="journal-compact",
+                daemon=True
+            )
+            thread = self._compacting
+        if background:
+            thread.start()
+        else:
+            thread.run()
+
+    def _dump_snapshot(self, data, digests, seq):
+        """
+        把快照写入临时文件并落盘，返回临时文件路径（由调用方替换为正式快照）
+        """
+        tmp_path = self.snapshot_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(
+                {"version": self.SNAPSHOT_VERSION, "seq": seq, "conversation_data": data, "digests": digests}, f
+            )
+            f.flush()
+            os.fsync(f.fileno())
+        return tmp_path
+
+    def _write_snapshot(self, data, digests, seq, compact_fd=None):
+        try:
+            with stage_timer("snapshot"):
+                tmp_path = self._dump_snapshot(data, digests, seq)
+            # 替换快照与删除旧日志需与其他进程的加载互斥
+            with self.locked():
+                os.replace(tmp_path, self.snapshot_path)
+                # 快照落盘后旧日志已被覆盖，可以删除
+                if os.path.exists(self.rotated_path):
+                    os.remove(self.rotated_path)
+            logger.info(f"对话数据快照保存到 {self.snapshot_path}，覆盖序号 {seq}")
+        except Exception as e:
+            # 旧日志仍保留，下次启动可继续重放
+            logger.error(f"压缩对话日志时出错: {e}")
+        finally:
+            with self._lock:
+                self._compacting = None
+            if compact_fd is not None:
+                os.close(compact_fd)
+
+    def renumber(self, conversation_data, digests):
+        """
+        一次性迁移：按各用户对话中的先后顺序为全部消息重新分配连续的 ID，立即写入快照并丢弃旧日志，
+        返回新的最大序号（调用方持有保护 conversation_data 的锁与 locked()）。
+        旧版快照中的消息没有 ID，而升级后追加的日志已占用了从 1 开始的序号，只能整体重新编号
+        """
+        self._check_fork()
+        self.wait()
+        with self._lock:
+            seq = 0
+            for messages in conversation_data.values():
+                for message in messages:
+                    seq += 1
+                    message["id"] = seq
+            data = {user_id: list(messages) for user_id, messages in conversation_data.items()}
+            # 快照先落盘，之后旧日志中的条目（序号都不超过 seq）重放时会被跳过
+            os.replace(self._dump_snapshot(data, dict(digests), seq), self.snapshot_path)
+            for f in (self._file, self._tail):
+                if f is not None:
+                    f.close()
+            self._file = None
+            self._tail = None
+            for path in (self.rotated_path, self.journal_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            self._create_journal(seq)
+            if self.file_lock is not None:
+                self._tail = open(self.journal_path, "rb")
+                self._tail.seek(0, os.SEEK_END)
+            self.seq = seq
+            self.entries_since_compact = 0
+        logger.info(f"对话消息已重新编号：{seq} 条，快照保存到 {self.snapshot_path}")
+        return seq
+
+    def wait(self):
+        """
+        等待正在进行的压缩完成
+        """
+        thread = self._compacting
+        if thread is not None and thread.is_alive():
+            thread.join()
+
+    def close(self):
+        self.wait()
+        with self._lock:
+            for f in (self._file, self._tail):
+                if f is not None:
+                    f.close()
+            self._file = None
+            self._tail = None
+
+
+class EmbeddingBatcher:
+    """
+    嵌入微批处理引擎：把并发到达的 encode 请求排队，合并为一次批量 encode，
+    每个调用方通过各自的 Future 拿回自己的向量。
+    """
+
+    def __init__(self, encode_fn, max_batch_size=32, max_wait_ms=5.0):
+        """
+        :param encode_fn: 批量编码函数，输入文本列表，返回 (n, dim) 的向量数组
+        :param max_batch_size: 单批最多合并的文本数
+        :param max_wait_ms: 收到第一条请求后最多等待多少毫秒来凑批
+        """
+        self.encode_fn = encode_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        # 统计信息
+        self.total_batches = 0
+        self.total_items = 0
+        self.last_batch_size = 0
+        self.largest_batch_size = 0
+
+    def _ensure_worker(self):
+        if self._pid != os.getpid():
+            # fork 之后（preload_app=True）父进程的批处理线程不存在于子进程中，重新初始化
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._queue = queue.Queue()
+                    self._thread = None
+                    self._pid = os.getpid()
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+                self._thread.start()
+
+    def submit(self, text: str) -> Future:
+        """
+        提交单条文本，返回在批处理完成后可取得向量的 Future
+        """
+        future = Future()
+        self._ensure_worker()
+        self._queue.put((text, future))
+        return future
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        """
+        同步编码一组文本（批量路径），结果顺序与输入一致
+        """
+        futures = [self.submit(text) for text in texts]
+        if not futures:
+            return np.zeros((0, 0), dtype='float32')
+        return np.stack([f.result() for f in futures])
+
+    def _collect(self):
+        """
+        阻塞等待第一条请求，然后在 max_wait 内尽量凑满一批
+        """
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            try:
+                # 已在排队的请求直接取走，不必等待
+                batch.append(self._queue.get_nowait())
+                continue
+            except queue.Empty:
+                pass
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            # 调用方可能已经放弃（取消）等待
+            batch = [(text, future) for text, future in batch if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            texts = [text for text, _ in batch]
+            try:
+                with stage_timer("embedding"):
+                    vectors = np.asarray(self.encode_fn(texts), dtype='float32')
+                for (_, future), vector in zip(batch, vectors):
+                    future.set_result(vector)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+            self.total_batches += 1
+            self.total_items += len(batch)
+            self.last_batch_size = len(batch)
+            self.largest_batch_size = max(self.largest_batch_size, len(batch))
+
+    def stats(self) -> dict:
+        """
+        队列深度与批大小统计
+        """
+        return {
+            "queue_depth": self._queue.qsize(),
+            "total_batches": self.total_batches,
+            "total_items": self.total_items,
+            "avg_batch_size": self.total_items / self.total_batches if self.total_batches else 0.0,
+            "last_batch_size": self.last_batch_size,
+            "largest_batch_size": self.largest_batch_size,
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000.0,
+        }
+
+
 class VectorStore:
-    def __init__(self, dimension=1024, save_path="./vector_store", nlist=100, buffer_size=100):
+    def __init__(self, dimension=1024, save_path="./vector_store", nlist=100, buffer_size=100,
+                 compact_every=1000, embed_batch_size=32, embed_max_wait_ms=5.0,
+                 embedding_cache_size=50000, embedding_cache_lru=4096, shared=False,
+                 embedding_backend="torch", preload_model=True, index_type="IVFFlat", pq_m=64):
         """
         初始化向量存储
         :param dimension: 向量的维度
         :param save_path: 数据保存路径
-        :param nlist: 聚类桶的数量
-        :param buffer_size: 缓存区大小，用于索引训练
+        :param nlist: 冷层 IVF 索引聚类桶数量的上限
+        :param buffer_size: 热层（精确 Flat）缓冲的向量数，超过后在后台重建该用户的冷层索引
+        :param compact_every: 对话日志追加多少条后压缩为快照
+        :param embed_batch_size: 嵌入微批处理的最大批大小
+        :param embed_max_wait_ms: 嵌入微批处理的最大凑批等待时间（毫秒）
+        :param embedding_cache_size: 磁盘嵌入缓存的容量（向量数），0 表示关闭缓存
+        :param embedding_cache_lru: 进程内嵌入 LRU 缓存的容量
+        :param shared: 多 worker 共享模式：多个进程共用同一目录，写入由文件锁协调，
+                       各进程通过 refresh() 加载其他进程的写入（支持 gunicorn preload_app=True）
+        :param embedding_backend: 嵌入后端名称（torch / onnx，见 embedding_backend.py）
+        :param preload_model: 是否在构造时加载模型；False 时由 start_embedding_backend() 在后台加载，
+                              或在第一次编码时加载
+        :param index_type: 冷层索引类型：Flat / IVFFlat / IVF-SQ8 / IVF-PQ / HNSW（见 vector_index.INDEX_TYPES）
+        :param pq_m: IVF-PQ 每个向量的字节数（子空间数，需整除维度）
         """
         self.dimension = dimension
         self.save_path = save_path
+        self.shared = shared
         self.nlist = nlist
         self.buffer_size = buffer_size
-        self.embedding_buffer = []  # 缓存区，用于批量训练索引
         self.conversation_data = {}
+        self.message_locations = {}  # 消息 ID -> (用户 ID, 在该用户对话列表中的位置)
+        self.conversation_digests = {}  # 用户 ID -> 对话滚动摘要（用于构造缓存键）
+        self.conversation_lock = threading.RLock()  # 保护 conversation_data 与日志的一致性
 
         # 确保保存路径存在
         os.makedirs(self.save_path, exist_ok=True)
+        self.journal = ConversationJournal(self.save_path, compact_every=compact_every, shared=shared)
 
-        # FAISS index 初始化
-        quantizer = faiss.IndexFlatL2(self.dimension)  # 使用 L2 距离的量化器
-        self.index = faiss.IndexIVFFlat(quantizer, self.dimension, self.nlist, faiss.METRIC_L2)
+        # FAISS 索引初始化：按用户分区，存放稳定的 64 位消息 ID；
+        # 每个分区由热层 Flat + 冷层（可配置的压缩/近似索引）组成，新向量立即可检索
+        self.index = PartitionedIndex(self.dimension, os.path.join(self.save_path, "partitions"),
+                                      nlist=self.nlist, hot_threshold=self.buffer_size, shared=shared,
+                                      index_type=index_type, pq_m=pq_m)
 
-        # 加载模型
-        self.model = self.load_model()
+        # 嵌入后端（可延迟加载），预热与就绪状态见 EmbeddingBackend
+        self.model_path = "./text2vec-large-chinese"
+        self.max_seq_length = 128
+        self.embedding_backend = create_backend(embedding_backend, self.model_path, self.max_seq_length)
+        if preload_model:
+            self.load_model()
+        self.embedding_batcher = EmbeddingBatcher(
+            self._encode_batch, max_batch_size=embed_batch_size, max_wait_ms=embed_max_wait_ms
+        )
 
-        # 加载已保存的索引和对话数据
-        self.load_index()
+        # 嵌入缓存：相同文本不再重复做前向计算
+        self.embedding_cache = None
+        if embedding_cache_size > 0:
+            model_id = f"{os.path.basename(os.path.normpath(self.model_path))}:{self.max_seq_length}"
+            if self.embedding_backend.cache_tag:
+                model_id += f":{self.embedding_backend.cache_tag}"
+            cache_path = os.path.join(self.save_path, "embedding_cache")
+            try:
+                self.embedding_cache = EmbeddingCache(
+                    cache_path, self.dimension, model_id,
+                    capacity=embedding_cache_size, lru_size=embedding_cache_lru,
+                    write_lock=FileLock(os.path.join(cache_path, "embedding_cache.lock")) if shared else None
+                )
+            except Exception as e:
+                logger.error(f"初始化嵌入缓存失败，将不使用缓存: {e}")
+
+        # 加载已保存的对话数据和索引；旧版数据先迁移（重建分区），再加载分区
         self.load_conversation_data()
+        self.migrate_legacy_data()
+        self.load_index()
 
     def load_model(self):
         """
-        加载 SentenceTransformer 模型
+        同步加载嵌入模型（不预热）
         """
-        model_path = "./text2vec-large-chinese"
+        backend = self.embedding_backend
         try:
-            logger.info(f"加载模型 from: {model_path}")
-            transformer = models.Transformer(model_path, max_seq_length=128)
-            pooling = models.Pooling(transformer.get_word_embedding_dimension())
-            model = SentenceTransformer(modules=[transformer, pooling])
-            logger.info(f"模型加载成功. 嵌入维度: {model.get_sentence_embedding_dimension()}")
-            return model
+            logger.info(f"加载模型 from: {self.model_path}，后端: {backend.name}")
+            backend.prepare(warm_up=False)
+            logger.info(f"模型加载成功. 嵌入维度: {backend.dimension}")
+            if backend.dimension != self.dimension:
+                logger.error(f"模型维度 {backend.dimension} 与索引维度 {self.dimension} 不一致")
         except Exception as e:
             logger.error(f"模型加载失败: {e}")
-            return None
-    
 
-    def train_index(self):
+    def start_embedding_backend(self):
         """
-        训练 FAISS 索引
+        在后台线程中加载并预热嵌入后端（在 worker 进程中调用，例如 startup 钩子），
+        完成前 embedding_backend.ready 为 False
         """
-        if len(self.embedding_buffer) < self.buffer_size:
-            logger.warning(f"嵌入缓冲区数据不足，无法训练索引。当前缓冲区大小: {len(self.embedding_buffer)}")
-            return
-        buffer_array = np.stack(self.embedding_buffer).astype('float32')
-        try:
-            self.index.train(buffer_array)
-            self.add_embeddings_to_index(buffer_array)
-            self.embedding_buffer = []  # 清空缓冲区
-            logger.info("索引训练完成")
-        except Exception as e:
-            logger.error(f"训练索引时出错: {e}")
+        self.embedding_backend.start()
 
-    def add_embeddings_to_index(self, embeddings):
+
+    def add_embeddings_to_index(self, user_id: str, ids, embeddings):
         """
-        添加嵌入到 FAISS 索引
+        添加带消息 ID 的嵌入到用户分区索引
         """
         try:
-            self.index.add(embeddings)
-            logger.info(f"添加嵌入到索引，当前索引总数: {self.index.ntotal}")
+            with stage_timer("faiss_add"):
+                self.index.add(user_id, np.asarray(ids, dtype='int64'), embeddings)
+            # 只读取本分区的向量数：index.ntotal 需遍历全部分区，每次写入都会随用户数增长
+            logger.info(f"添加嵌入到用户 {user_id} 的分区索引，该分区向量数: {self.index.get_partition(user_id).ntotal}")
         except Exception as e:
             logger.error(f"添加嵌入到索引时出错: {e}")
 
+    def _encode_batch(self, texts: List[str]) -> np.ndarray:
+        """
+        由微批处理线程调用：一次前向计算编码整批文本
+        """
+        return self.embedding_backend.encode(texts)
+
     def get_embedding(self, text: str) -> np.ndarray:
         """
-        获取文本的嵌入表示
+        获取文本的嵌入表示（经由微批处理引擎，与并发请求合并编码）
         """
-        if self.model is None:
+        if self.embedding_cache is not None:
+            cached = self.embedding_cache.get(text)
+            if cached is not None:
+                return cached
+        if self.embedding_batcher is None:
             raise RuntimeError("模型未正确加载。")
         try:
-            embedding = self.model.encode([text])[0].astype('float32')
-            logger.info(f"成功生成文本嵌入: {text}")
+            embedding = self.embedding_batcher.submit(text).result()
+            if self.embedding_cache is not None:
+                self.embedding_cache.put(text, embedding)
+            if sample("embedding"):
+                logger.info(f"成功生成文本嵌入: {preview(text, 50)}", extra={"category": "embedding"})
             return embedding
         except Exception as e:
             logger.error(f"生成文本嵌入时出错: {e}")
             raise RuntimeError("生成嵌入失败")
 
+    def get_embeddings(self, texts: List[str]) -> np.ndarray:
+        """
+        批量获取文本的嵌入表示，返回 (len(texts), dimension) 的数组
+        """
+        texts = list(texts)
+        embeddings = np.zeros((len(texts), self.dimension), dtype='float32')
+        missing = []
+        for i, text in enumerate(texts):
+            cached = self.embedding_cache.get(text) if self.embedding_cache is not None else None
+            if cached is None:
+                missing.append(i)
+            else:
+                embeddings[i] = cached
+        if not missing:
+            return embeddings
+        if self.embedding_batcher is None:
+            raise RuntimeError("模型未正确加载。")
+        try:
+            encoded = self.embedding_batcher.encode([texts[i] for i in missing])
+            for i, embedding in zip(missing, encoded):
+                embeddings[i] = embedding
+                if self.embedding_cache is not None:
+                    self.embedding_cache.put(texts[i], embedding)
+            return embeddings
+        except Exception as e:
+            logger.error(f"批量生成文本嵌入时出错: {e}")
+            raise RuntimeError("生成嵌入失败")
+
+    def embedding_stats(self) -> dict:
+        """
+        返回嵌入微批处理的队列深度与批大小统计、嵌入后端状态，以及嵌入缓存的命中统计
+        """
+        stats = self.embedding_batcher.stats() if self.embedding_batcher is not None else {}
+        stats["backend"] = self.embedding_backend.stats()
+        if self.embedding_cache is not None:
+            stats["cache"] = self.embedding_cache.stats()
+        return stats
+
+    def index_stats(self) -> dict:
+        """
+        返回分区索引的热层/冷层规模与后台重建统计
+        """
+        return self.index.stats()
+
     def add_to_conversation(self, user_id: str, role: str, content: str):
         """
         添加对话记录到指定用户的对话历史，并更新嵌入索引
         """
         try:
-            # 添加对话记录
-            if user_id not in self.conversation_data:
-                self.conversation_data[user_id] = []
-            self.conversation_data[user_id].append({"role": role, "content": content})
-
-            # 保存对话数据
-            self.save_conversation_data()
-
-            # 添加嵌入（仅对用户消息进行嵌入）
-            if role == "user":
-                embedding = self.get_embedding(content)
-                self.embedding_buffer.append(embedding)
-
-                # 如果缓冲区满，则训练索引
-                if len(self.embedding_buffer) >= self.buffer_size:
-                    self.train_index()
+            message_id = self.append_message(user_id, role, content)
+            self.index_message(user_id, message_id, role, content)
         except Exception as e:
-            logger.error(f"添加对话记录时出错，用户 {user_id}，角色: {role}，内容: {content}，错误: {e}")
+            logger.error(f"添加对话记录时出错，用户 {user_id}，角色: {role}，内容: {preview(content)}，错误: {e}")
+
+    def append_message(self, user_id: str, role: str, content: str) -> int:
+        """
+        只添加对话记录（内存 + 追加写日志），返回消息 ID；开销与消息大小成正比
+        """
+        # 添加对话记录，并追加写入日志（不再整体重写 pickle）
+        message = {"role": role, "content": content}
+        with self.conversation_lock, self.journal.locked():
+            if self.shared:
+                # 先追上其他进程的追加，保证本进程的消息顺序与日志一致
+                self._apply_journal()
+            with stage_timer("journal_append"):
+                message_id = self.journal.append(user_id, message)
+            self._record(user_id, message)
+            if self.journal.should_compact():
+                self.journal.compact(self.conversation_data, self.conversation_digests)
+        return message_id
+
+    def _record(self, user_id: str, message: dict):
+        """
+        把已写入日志的消息加入内存中的对话数据（调用方持有 conversation_lock）
+        """
+        messages = self.conversation_data.setdefault(user_id, [])
+        self.message_locations[message["id"]] = (user_id, len(messages))
+        messages.append(message)
+        self.conversation_digests[user_id] = chain_digest(
+            self.conversation_digests.get(user_id, ""), message["role"], message["content"]
+        )
+
+    def _apply_journal(self):
+        """
+        共享模式：应用其他进程追加的日志条目，无法增量追上时完整重新加载（调用方持有 conversation_lock）
+        """
+        entries = self.journal.read_new()
+        if entries is None:
+            logger.warning("对话日志出现序号缺口，重新加载对话数据")
+            self.load_conversation_data()
+            return
+        for user_id, message in entries:
+            self._record(user_id, message)
+
+    def refresh(self):
+        """
+        共享模式：加载其他 worker 进程写入的对话记录（每个请求开始时调用；
+        没有新记录时只有几次系统调用）。向量分区在检索时自行同步。
+        """
+        if not self.shared:
+            return
+        with self.conversation_lock:
+            self._apply_journal()
+
+    def index_message(self, user_id: str, message_id: int, role: str, content: str):
+        """
+        为已添加的消息计算嵌入并写入索引（仅对用户消息进行嵌入）
+        """
+        if role == "user":
+            embedding = self.get_embedding(content)
+            self.add_embeddings_to_index(user_id, [message_id], embedding.reshape(1, -1))
+
+    def index_messages(self, entries: List[tuple]):
+        """
+        批量为已添加的用户消息计算嵌入（一次批量编码），并按用户分区写入索引
+        :param entries: (user_id, message_id, content) 列表
+        """
+        if not entries:
+            return
+        embeddings = self.get_embeddings([content for _, _, content in entries])
+        by_user = {}
+        for (user_id, message_id, _), embedding in zip(entries, embeddings):
+            ids, vectors = by_user.setdefault(user_id, ([], []))
+            ids.append(message_id)
+            vectors.append(embedding)
+        for user_id, (ids, vectors) in by_user.items():
+            self.add_embeddings_to_index(user_id, ids, np.vstack(vectors))
+
+    def conversation_digest(self, user_id: str) -> str:
+        """
+        获取用户对话的滚动摘要（随每条消息增量更新，重启后保持不变），空对话返回空字符串
+        """
+        return self.conversation_digests.get(user_id, "")
+
+    def get_message(self, message_id: int):
+        """
+        按消息 ID 取回消息记录，不存在时返回 None
+        """
+        location = self.message_locations.get(message_id)
+        if location is None:
+            return None
+        user_id, position = location
+        return self.conversation_data[user_id][position]
+
+    def get_turn(self, message_id: int):
+        """
+        取回消息 ID 所在的一轮对话：该消息及紧随其后的助手回复（如果有）
+        """
+        location = self.message_locations.get(message_id)
+        if location is None:
+            return []
+        user_id, position = location
+        messages = self.conversation_data[user_id]
+        turn = [messages[position]]
+        if position + 1 < len(messages) and messages[position + 1]["role"] == "assistant":
+            turn.append(messages[position + 1])
+        return turn
+
+    def get_recent_messages(self, user_id: str, count: int):
+        """
+        获取用户最近的 count 条消息记录（含 id），开销与 count 成正比而非与历史长度成正比
+        """
+        messages = self.conversation_data.get(user_id, [])
+        return messages[-count:] if count > 0 else []
 
     def get_conversation_history(self, user_id: str):
         """
@@ -130,7 +841,9 @@ class VectorStore:
         try:
             if not isinstance(user_id, str):
                 raise TypeError(f"user_id 必须是字符串类型，但接收到的是 {type(user_id)}")
-            history = self.conversation_data.get(user_id, [])
+            history = [
+                {"role": m["role"], "content": m["content"]} for m in self.conversation_data.get(user_id, [])
+            ]
             logger.info(f"获取用户 {user_id} 的对话历史，记录数量: {len(history)}")
             return history
         except Exception as e:
@@ -139,22 +852,26 @@ class VectorStore:
 
     def search(self, user_id: str, query: str, top_k=3):
         """
-        根据查询语句检索与用户对话相关的记忆
+        根据查询语句检索与用户对话相关的记忆，只在该用户的分区内检索，
+        返回命中的消息记录（含 id、role、content），按相似度降序
         """
         try:
-            if self.index.ntotal == 0:
-                logger.warning(f"索引为空，用户 {user_id} 无法检索。")
+            partition = self.index.get_partition(user_id)
+            if partition is None or partition.ntotal == 0:
+                logger.warning(f"用户 {user_id} 的索引为空，无法检索。")
                 return []
-            query_embedding = self.get_embedding(query).reshape(1, -1)
-            distances, indices = self.index.search(query_embedding, top_k)
+            query_embedding = self.get_embedding(query)
+            with stage_timer("faiss_search"):
+                hits = self.index.search(user_id, query_embedding, top_k)
 
-            # 获取对应用户的对话历史
-            user_conversation = self.conversation_data.get(user_id, [])
             results = []
-            for idx in indices[0]:
-                if 0 <= idx < len(user_conversation):
-                    results.append(user_conversation[idx]["content"])
-            logger.info(f"检索结果，用户 {user_id}，查询: {query}，结果: {results}")
+            for message_id, distance in hits:
+                message = self.get_message(message_id)
+                if message is not None:
+                    results.append(message)
+            if sample("retrieval"):
+                logger.info(f"检索结果，用户 {user_id}，查询: {preview(query, 50)}，"
+                            f"结果: {preview([m['content'] for m in results])}", extra={"category": "retrieval"})
             return results
         except Exception as e:
             logger.error(f"检索过程中出错: {e}")
@@ -162,52 +879,90 @@ class VectorStore:
 
     def save_index(self):
         """
-        保存 FAISS 索引到磁盘
+        分区向量在添加时已追加落盘，这里无需整体重写索引
         """
-        faiss_index_path = os.path.join(self.save_path, "faiss_index.index")
-        try:
-            faiss.write_index(self.index, faiss_index_path)
-            logger.info(f"FAISS 索引保存到 {faiss_index_path}")
-        except Exception as e:
-            logger.error(f"保存 FAISS 索引时出错: {e}")
+        logger.info(f"分区索引已持久化，分区数: {len(self.index.partitions)}")
 
     def load_index(self):
         """
-        从磁盘加载 FAISS 索引
+        从磁盘加载各用户分区的向量索引
         """
-        faiss_index_path = os.path.join(self.save_path, "faiss_index.index")
         try:
-            if os.path.exists(faiss_index_path):
-                self.index = faiss.read_index(faiss_index_path)
-                logger.info(f"索引从 {faiss_index_path} 加载成功。")
-            else:
-                logger.warning(f"未找到索引文件，初始化新的索引。")
+            self.index.load()
         except Exception as e:
             logger.error(f"加载 FAISS 索引时出错: {e}")
 
     def save_conversation_data(self):
         """
-        保存对话数据到磁盘
+        立即将对话数据压缩为快照并写入磁盘（同步完成）
         """
-        conversation_path = os.path.join(self.save_path, "conversation_data.pkl")
         try:
-            with open(conversation_path, "wb") as f:
-                pickle.dump(self.conversation_data, f)
-            logger.info(f"对话数据保存到 {conversation_path}")
+            self.journal.wait()
+            with self.conversation_lock, self.journal.locked():
+                if self.shared:
+                    self._apply_journal()
+                self.journal.compact(self.conversation_data, self.conversation_digests, background=False)
         except Exception as e:
             logger.error(f"保存对话数据时出错: {e}")
 
     def load_conversation_data(self):
         """
-        从磁盘加载对话数据
+        从磁盘加载对话数据：快照 + 日志重放
         """
-        conversation_path = os.path.join(self.save_path, "conversation_data.pkl")
         try:
-            if os.path.exists(conversation_path):
-                with open(conversation_path, "rb") as f:
-                    self.conversation_data = pickle.load(f)
-                logger.info("对话数据加载成功")
-            else:
-                self.conversation_data = {}
+            with self.conversation_lock:
+                self.conversation_data, self.conversation_digests = self.journal.load()
+                self._build_locations()
+            logger.info("对话数据加载成功")
         except Exception as e:
             logger.error(f"加载对话数据时出错: {e}")
+
+    def _build_locations(self):
+        self.message_locations = {
+            m["id"]: (user_id, position)
+            for user_id, messages in self.conversation_data.items()
+            for position, m in enumerate(messages) if "id" in m
+        }
+
+    def migrate_legacy_data(self):
+        """
+        一次性迁移旧版数据：旧版快照中的消息没有 ID，既不在 message_locations 中，也没有写入任何分区，无法被检索。
+        为全部消息重新编号并写入快照，然后清空分区、为全部用户消息重新计算嵌入。
+        重建完成前保留标记文件，中途退出后下次启动会继续重建
+        """
+        marker_path = os.path.join(self.save_path, REINDEX_MARKER)
+        try:
+            with self.conversation_lock, self.journal.locked():
+                if any("id" not in m for messages in self.conversation_data.values() for m in messages):
+                    logger.warning("检测到旧版对话数据（消息没有 ID），重新编号并重建向量索引")
+                    open(marker_path, "w").close()
+                    self.journal.renumber(self.conversation_data, self.conversation_digests)
+                    self._build_locations()
+                if not os.path.exists(marker_path):
+                    return
+                self.index.reset()
+                entries = [(user_id, m["id"], m["content"]) for user_id, messages in self.conversation_data.items()
+                           for m in messages if m["role"] == "user"]
+                for start in range(0, len(entries), REINDEX_BATCH_SIZE):
+                    self.index_messages(entries[start:start + REINDEX_BATCH_SIZE])
+                # 写入分区的错误只记录日志，这里核对数量，不完整时保留标记
+                if self.index.ntotal != len(entries):
+                    raise RuntimeError(f"分区中的向量数 {self.index.ntotal} 与用户消息数 {len(entries)} 不一致")
+                os.remove(marker_path)
+            logger.info(f"旧版对话数据迁移完成：{len(entries)} 条用户消息已写入分区索引")
+        except Exception as e:
+            logger.error(f"迁移旧版对话数据时出错，下次启动将重试重建索引: {e}")
+
+    def close(self):
+        """
+        关闭日志文件，等待后台压缩完成
+        """
+        try:
+            self.journal.close()
+        except Exception as e:
+            logger.error(f"关闭对话日志时出错: {e}")
+        if self.embedding_cache is not None:
+            try:
+                self.embedding_cache.flush()
+            except Exception as e:
+                logger.error(f"刷新嵌入缓存时出错: {e}")